@@ -0,0 +1,3 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmarks of grafana-inviter against a local fake Grafana and an in-memory LDAP directory."""
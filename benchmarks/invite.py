@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+"""Measures an invite run end to end for growing numbers of accounts.
+
+The accounts are served by an ldap3 ``MOCK_SYNC`` directory and invited into the in-process fake Grafana of the tests, so
+the run covers the LDAP search, the reconciliation, the throttled HTTP requests and the output. Each number of accounts is
+measured in a fresh interpreter, the memory is reported as the growth of the RSS during the run, excluding the seeded
+directory::
+
+    python -m benchmarks.invite --accounts 1000 10000 100000 --latency 0.002 --error-rate 0.01
+"""
+
+import argparse
+from contextlib import redirect_stderr, redirect_stdout
+from functools import partial
+import json
+import math
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from unittest.mock import patch
+
+import ldap3
+
+from grafana_inviter.accounts import AccountManager
+from grafana_inviter.cli import sync
+from grafana_inviter.grafana import Grafana
+from tests.fake_grafana import FakeGrafana
+
+
+DEFAULT_ACCOUNTS = [1000, 10000, 100000]
+
+BASE_DN = "ou=people,o=acme"
+GROUP_DN = "cn=grafana,ou=groups,o=acme"
+SERVICE_USER = "cn=inviter,o=acme"
+SERVICE_PASSWORD = "benchmark"
+
+
+def seed_directory(accounts):
+    """Returns an ldap3 server whose in-memory directory holds the service user and the given number of group members.
+    """
+
+    server = ldap3.Server("ldap://benchmark")
+    connection = ldap3.Connection(server, user=SERVICE_USER, password=SERVICE_PASSWORD, client_strategy=ldap3.MOCK_SYNC)
+    connection.strategy.add_entry(SERVICE_USER, {"objectClass": "person", "userPassword": SERVICE_PASSWORD})
+    for index in range(accounts):
+        connection.strategy.add_entry("uid=user%d,%s" % (index, BASE_DN), {
+            "objectClass": "person", "uid": "user%d" % index, "name": "User %d" % index,
+            "mail": "user%d@acme.org" % index, "memberOf": GROUP_DN
+        })
+    return server
+
+
+def benchmark_config(grafana_url, concurrency, page_size):
+    """Returns the configuration of a run against the fake directory and Grafana.
+    """
+
+    return {
+        "ldap": {
+            "url": "ldap://benchmark",
+            "user": SERVICE_USER,
+            "password": SERVICE_PASSWORD,
+            "query": {
+                "group_base_dn": BASE_DN,
+                "search_filter": "(memberOf=%s)" % GROUP_DN,
+                "retrieve_attributes": ["uid", "mail", "name"],
+                "page_size": page_size
+            }
+        },
+        "grafana": {
+            "url": grafana_url,
+            "token": "benchmark",
+            "orgId": 1,
+            "send_invite_mail": False,
+            "concurrency": concurrency,
+            "rate_limit": {"max_retries": 10, "backoff_base": 0.001, "backoff_max": 0.01}
+        }
+    }
+
+
+class TimedGrafana(Grafana):
+    """Grafana client recording the duration of each invite, including its retries.
+    """
+
+    def __init__(self, grafana_config):
+        super().__init__(grafana_config)
+        self.durations = []
+        self.__lock = threading.Lock()
+
+
+    def invite(self, account, send_mail=False):
+        started = time.perf_counter()
+        result = super().invite(account, send_mail=send_mail)
+        with self.__lock:
+            self.durations.append(time.perf_counter() - started)
+        return result
+
+
+def percentile(values, share):
+    """Returns the nearest-rank percentile of the values, e.g. 0.99 for p99.
+    """
+
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(math.ceil(share * len(ordered))) - 1))] if ordered else 0.0
+
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process in MiB.
+    """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def rss_mb():
+    """Returns the current resident set size of this process in MiB, the peak where the current one isn't available.
+    """
+
+    try:
+        with open("/proc/self/statm", encoding="ascii") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / (1024 * 1024)
+    except OSError:
+        return peak_rss_mb()
+
+
+# pylint: disable=too-many-arguments
+def run_benchmark(accounts, latency=0.0, error_rate=0.0, invites=0, concurrency=8, page_size=1000):
+    """Invites the given number of accounts and returns the measurements of the run.
+
+    Arguments:
+        accounts {int} -- Number of accounts in the LDAP group.
+        latency {float} -- Seconds each Grafana request takes.
+        error_rate {float} -- Share of Grafana requests answered with 503.
+        invites {int} -- Number of unrelated invites pending in Grafana before the run.
+
+    Returns:
+        [dict] -- Returns the number of accounts and requests, the duration, throughput, p50/p99 invite latency and the
+        growth of the peak RSS from just before the run.
+    """
+
+    pending = [{"email": "pending%d@acme.org" % index, "name": "Pending %d" % index, "code": "pending%d" % index,
+                "url": "http://grafana/invite/pending%d" % index} for index in range(invites)]
+    server = seed_directory(accounts)
+
+    with FakeGrafana(latency=latency, error_rate=error_rate, invites=pending) as fake_grafana, \
+            patch("ldap3.Server", return_value=server), \
+            patch("ldap3.Connection", partial(ldap3.Connection, client_strategy=ldap3.MOCK_SYNC)):
+        config = benchmark_config(fake_grafana.url, concurrency, page_size)
+        manager = AccountManager(ldap_query_config=config["ldap"]["query"], ldap_user=SERVICE_USER, ldap_password=SERVICE_PASSWORD,
+                                 ldap_url=config["ldap"]["url"])
+        grafana = TimedGrafana(config["grafana"])
+        rss_before = rss_mb()
+        started = time.perf_counter()
+        with open(os.devnull, "w", encoding="utf-8") as devnull, redirect_stdout(devnull), redirect_stderr(devnull):
+            sync(config, manager, grafana, None)
+        elapsed = time.perf_counter() - started
+        rss_growth = peak_rss_mb() - rss_before
+        grafana.close()
+        manager.close()
+
+    return {
+        "accounts": accounts,
+        "invited": len(fake_grafana.invites) - invites,
+        "requests": len(fake_grafana.requests),
+        "seconds": elapsed,
+        "accounts_per_second": accounts / elapsed,
+        "p50_ms": percentile(grafana.durations, 0.5) * 1000,
+        "p99_ms": percentile(grafana.durations, 0.99) * 1000,
+        "rss_growth_mb": rss_growth
+    }
+
+
+def parse_args(args):
+    """Returns parsed commandline arguments.
+    """
+
+    parser = argparse.ArgumentParser(description="Measures throughput, invite latency and memory growth of invite runs.")
+    parser.add_argument("--accounts", type=int, nargs="+", default=DEFAULT_ACCOUNTS, help="Numbers of accounts to measure")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds each Grafana request takes")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of Grafana requests answered with 503")
+    parser.add_argument("--invites", type=int, default=1000, help="Number of unrelated invites pending in Grafana")
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum number of invites in flight")
+    parser.add_argument("--page-size", type=int, default=1000, help="LDAP page size")
+    parser.add_argument("--in-process", action="store_true", help="Measure in this interpreter and print JSON instead of a table")
+    return parser.parse_args(args)
+
+
+def main():
+    """Main entrypoint
+    """
+
+    args = parse_args(sys.argv[1:])
+    options = {"latency": args.latency, "error_rate": args.error_rate, "invites": args.invites, "concurrency": args.concurrency,
+               "page_size": args.page_size}
+    if args.in_process:
+        for accounts in args.accounts:
+            print(json.dumps(run_benchmark(accounts, **options)))
+        return 0
+
+    print("%9s %8s %9s %9s %9s %9s %9s" % ("accounts", "requests", "seconds", "acc/s", "p50 ms", "p99 ms", "+RSS MiB"))
+    for accounts in args.accounts:
+        command = [sys.executable, "-m", "benchmarks.invite", "--in-process", "--accounts", str(accounts)]
+        command += ["--%s=%s" % (option.replace("_", "-"), value) for option, value in sorted(options.items())]
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        result = json.loads(output.splitlines()[-1])
+        print("%9d %8d %9.2f %9.0f %9.2f %9.2f %9.1f" % (result["accounts"], result["requests"], result["seconds"],
+                                                        result["accounts_per_second"], result["p50_ms"], result["p99_ms"],
+                                                        result["rss_growth_mb"]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
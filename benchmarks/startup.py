@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+"""Measures how long the command line takes to print its help and to validate a configuration.
+
+Each case runs in fresh interpreters and the best run is reported next to a bare interpreter, so the numbers of different
+machines can be compared by their ratio. The exit status is 1 if a case takes longer than its budget, given as a multiple
+of the bare interpreter::
+
+    python -m benchmarks.startup --runs 10 --help-budget 3 --validate-budget 8
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+BARE = "pass"
+HELP = ("import sys\nimport grafana_inviter.cli\nsys.argv = ['grafana-inviter', '--help']\n"
+        "try:\n    grafana_inviter.cli.main()\nexcept SystemExit:\n    pass")
+VALIDATE = "from grafana_inviter.cli import load_config, validate\nvalidate(load_config('example_config.json'))"
+
+# Multiples of a bare interpreter the cases may take
+DEFAULT_HELP_BUDGET = 3.0
+DEFAULT_VALIDATE_BUDGET = 8.0
+
+
+def startup_seconds(code, runs):
+    """Returns the shortest wall time of the code in the given number of fresh interpreters, including their startup.
+    """
+
+    durations = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True, stdout=subprocess.DEVNULL, cwd=ROOT)
+        durations.append(time.perf_counter() - started)
+    return min(durations)
+
+
+def parse_args(args):
+    """Returns parsed commandline arguments.
+    """
+
+    parser = argparse.ArgumentParser(description="Measures the startup time of the command line.")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters per case, the best run is reported")
+    parser.add_argument("--help-budget", type=float, default=DEFAULT_HELP_BUDGET,
+                        help="Multiple of a bare interpreter --help may take")
+    parser.add_argument("--validate-budget", type=float, default=DEFAULT_VALIDATE_BUDGET,
+                        help="Multiple of a bare interpreter validating the example configuration may take")
+    return parser.parse_args(args)
+
+
+def over_budget(cases, runs):
+    """Measures the cases and prints them relative to a bare interpreter.
+
+    Arguments:
+        cases {list[tuple(str, str, float)]} -- Name, code and budget of each case, as a multiple of a bare interpreter.
+        runs {int} -- Fresh interpreters per case.
+
+    Returns:
+        [list[str]] -- Returns the names of the cases exceeding their budget.
+    """
+
+    baseline = startup_seconds(BARE, runs)
+    print("%-30s %9s %9s %9s" % ("case", "ms", "x bare", "budget"))
+    print("%-30s %9.1f %9.2f" % ("python -c pass", baseline * 1000, 1.0))
+    exceeded = []
+    for name, code, budget in cases:
+        seconds = startup_seconds(code, runs)
+        print("%-30s %9.1f %9.2f %9.2f" % (name, seconds * 1000, seconds / baseline, budget))
+        if seconds / baseline > budget:
+            exceeded.append(name)
+    return exceeded
+
+
+def main():
+    """Main entrypoint
+    """
+
+    args = parse_args(sys.argv[1:])
+    exceeded = over_budget([("grafana-inviter --help", HELP, args.help_budget),
+                            ("validate example_config.json", VALIDATE, args.validate_budget)], args.runs)
+    if exceeded:
+        print("Over budget: %s" % ", ".join(exceeded))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,8 +3,210 @@
 """Module responsible for fetching accounts from LDAP.
 """
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+import hashlib
 import json
-import ldap3
+import logging
+import os
+import queue
+import threading
+import time
+
+from .metrics import REGISTRY
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Number of values combined into one OR filter, small enough for the filter size limits of common directory servers
+DEFAULT_LOOKUP_CHUNK_SIZE = 100
+# Value of ldap3.SUBTREE, spelled out so ldap3 is only imported once LDAP is used
+SUBTREE = "SUBTREE"
+
+
+def lookup_filter(search_filter, terms):
+    """Returns a filter matching the accounts of the search filter which have any of the given attribute values.
+
+    Arguments:
+        search_filter {str} -- The configured search filter.
+        terms {list[tuple(str, str)]} -- Pairs of attribute and value, the values are escaped.
+    """
+
+    from ldap3.utils.conv import escape_filter_chars  # pylint: disable=import-outside-toplevel
+
+    return "(&%s(|%s))" % (search_filter, "".join("(%s=%s)" % (attribute, escape_filter_chars(value)) for attribute, value in terms))
+
+
+# Number of accounts found by concurrent searches which may wait for being consumed
+MERGE_BUFFER_SIZE = 1000
+MAX_PARALLEL_SEARCHES = 8
+
+DEFAULT_GROUP_FILTER = "(objectClass=group)"
+DEFAULT_GROUP_CACHE_SIZE = 10000
+DEFAULT_GROUP_CACHE_TTL = 3600
+
+DEFAULT_POOL_STRATEGY = "FIRST"
+# Seconds an unreachable server of a pool is skipped before it is tried again
+DEFAULT_SERVER_BACKOFF = 60
+
+
+def create_server(ldap_url, pool_config):
+    """Returns the ldap3 server of a single URL or a server pool failing over between several URLs.
+
+    The servers of a pool are checked for availability before being used, each server is tried once before giving up and
+    unreachable servers are skipped for ``DEFAULT_SERVER_BACKOFF`` seconds.
+
+    Arguments:
+        ldap_url {str|list[str]} -- LDAP URL or URLs.
+        pool_config {dict} -- The "ldap.pool" section of the configuration.
+    """
+
+    # ldap3 is only imported once LDAP is used, so the command line starts without it
+    import ldap3  # pylint: disable=import-outside-toplevel
+
+    server_options = {"connect_timeout": pool_config["connect_timeout"]} if "connect_timeout" in pool_config else {}
+    if isinstance(ldap_url, str):
+        return ldap3.Server(ldap_url, **server_options)
+    return ldap3.ServerPool([ldap3.Server(url, **server_options) for url in ldap_url],
+                            pool_strategy=getattr(ldap3, pool_config.get("strategy", DEFAULT_POOL_STRATEGY)),
+                            active=1, exhaust=DEFAULT_SERVER_BACKOFF)
+
+
+class ConnectionPool:
+    """Hands out bound LDAP connections to at most ``size`` concurrent users, binding additional connections on demand.
+
+    Connections which raised an error are discarded instead of being handed out again.
+    """
+
+    def __init__(self, connect, size=1):
+        """Constructor
+
+        Arguments:
+            connect {callable} -- Returns a new bound connection, the first one is created right away.
+            size {int} -- Maximum number of connections.
+        """
+        self.__connect = connect
+        self.__slots = threading.BoundedSemaphore(size)
+        self.__idle = queue.LifoQueue()
+        self.__idle.put(connect())
+
+
+    @contextmanager
+    def connection(self):
+        """Context manager holding a connection of the pool, blocks while all connections are in use.
+        """
+
+        with self.__slots:
+            try:
+                connection = self.__idle.get_nowait()
+            except queue.Empty:
+                connection = self.__connect()
+            broken = False
+            try:
+                yield connection
+            except Exception:
+                broken = True
+                raise
+            finally:
+                if broken:
+                    connection.unbind()
+                else:
+                    self.__idle.put(connection)
+
+
+    def close(self):
+        """Unbinds the idle connections.
+        """
+
+        while True:
+            try:
+                self.__idle.get_nowait().unbind()
+            except queue.Empty:
+                return
+
+
+def chunks(values, size):
+    """Yields consecutive slices of at most ``size`` values.
+    """
+
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+class GroupCache:
+    """LRU cache of the groups directly nested in each group, entries expire after ``ttl`` seconds.
+
+    Group DNs are compared case-insensitively. If a path is given the cache is loaded from and saved to a JSON file, so
+    subsequent runs don't need to walk the hierarchy again. The cache can be shared by the threads of concurrent searches.
+    """
+
+    def __init__(self, size=DEFAULT_GROUP_CACHE_SIZE, ttl=DEFAULT_GROUP_CACHE_TTL, path=None, clock=time.time):
+        self.__size = size
+        self.__ttl = ttl
+        self.__path = path
+        self.__clock = clock
+        self.__entries = OrderedDict()
+        self.__changed = False
+        self.__lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as cache_file:
+                for group, (stored_at, subgroups) in json.load(cache_file).items():
+                    self.__entries[group] = (stored_at, subgroups)
+
+
+    def get(self, group):
+        """Returns the DNs of the groups directly nested in the group or None if unknown or expired.
+        """
+
+        with self.__lock:
+            entry = self.__entries.get(group.lower())
+            if entry is None:
+                return None
+            if self.__clock() - entry[0] >= self.__ttl:
+                del self.__entries[group.lower()]
+                return None
+            self.__entries.move_to_end(group.lower())
+            return entry[1]
+
+
+    def put(self, group, subgroups):
+        """Remembers the DNs of the groups directly nested in the group, evicting the least recently used groups if full.
+        """
+
+        with self.__lock:
+            self.__entries[group.lower()] = (self.__clock(), subgroups)
+            self.__entries.move_to_end(group.lower())
+            self.__changed = True
+            while len(self.__entries) > self.__size:
+                self.__entries.popitem(last=False)
+
+
+    def save(self):
+        """Writes the cache to its file, if any and if it changed, replacing the file atomically.
+        """
+
+        with self.__lock:
+            if self.__path and self.__changed:
+                # Unique per process, so runs sharing the cache file don't write into each other's temporary file
+                temporary_path = "%s.%d.tmp" % (self.__path, os.getpid())
+                with open(temporary_path, "w", encoding="utf-8") as cache_file:
+                    json.dump(self.__entries, cache_file)
+                os.replace(temporary_path, self.__path)
+                self.__changed = False
+
+
+def newer_value(current, candidate):
+    """Returns the more recent of two values of a change tracking attribute such as ``modifyTimestamp`` or ``uSNChanged``.
+
+    Update sequence numbers are compared numerically, generalized time values lexicographically.
+    """
+
+    if current is None:
+        return candidate
+    if current.isdigit() and candidate.isdigit():
+        return candidate if int(candidate) > int(current) else current
+    return max(current, candidate)
 
 
 # pylint: disable=too-few-public-methods
@@ -15,45 +217,347 @@ class AccountManager:
     # pylint: disable=too-few-public-methods
     class Account:
         """Represents a user account filled with information obtained from LDAP.
+
+        Only the attributes used for inviting (``name`` and ``mail``) are decoded up front, all other requested attributes
+        are decoded from the raw LDAP values when accessed.
         """
 
+        CORE_ATTRIBUTES = ("name", "mail")
+
+        __slots__ = CORE_ATTRIBUTES + ("grafanaInviteLink", "__raw_attributes", "__attribute_names", "__decoded")
+
         def __init__(self, ldap_account, ldap_account_attributes):
-            account = ldap_account["raw_attributes"]
-            for ldap_attribute in ldap_account_attributes:
-                attribute_values = account[ldap_attribute]
-                attribute_values_size = len(attribute_values)
-                if attribute_values_size == 1:
-                    attr_value = attribute_values[0].decode("utf-8")
-                    setattr(self, ldap_attribute, attr_value)
-                elif attribute_values_size > 1:
-                    inner_attribute_list = []
-                    for attribute_value in attribute_values:
-                        inner_attribute_list.append(attribute_value.decode("utf-8"))
-                    setattr(self, ldap_attribute, inner_attribute_list)
+            self.__raw_attributes = ldap_account["raw_attributes"]
+            self.__attribute_names = ldap_account_attributes
+            self.__decoded = None
+            for ldap_attribute in AccountManager.Account.CORE_ATTRIBUTES:
+                if ldap_attribute in ldap_account_attributes:
+                    attr_value = self.__decode(ldap_attribute)
+                    if attr_value is not None:
+                        setattr(self, ldap_attribute, attr_value)
+
+
+        def __decode(self, ldap_attribute):
+            """Decodes the raw values of the attribute.
+
+            Returns:
+                [str|list] -- Returns the value if the attribute has a single value, a list if it is multi-valued or None if it is empty.
+            """
+
+            attribute_values = self.__raw_attributes.get(ldap_attribute, [])
+            if len(attribute_values) == 1:
+                return attribute_values[0].decode("utf-8")
+            if len(attribute_values) > 1:
+                return [attribute_value.decode("utf-8") for attribute_value in attribute_values]
+            return None
+
+
+        def fingerprint(self):
+            """Returns a hash of the raw LDAP values of the requested attributes, used to detect changed accounts.
+            """
+
+            digest = hashlib.sha1()
+            for ldap_attribute in sorted(self.__attribute_names):
+                digest.update(ldap_attribute.encode("utf-8") + b"\0")
+                for attribute_value in sorted(self.__raw_attributes.get(ldap_attribute, [])):
+                    digest.update(attribute_value + b"\0")
+                digest.update(b"\1")
+            return digest.hexdigest()
+
+
+        def __getattr__(self, name):
+            # Only called if the regular lookup failed, i.e. for unset slots and the lazily decoded attributes.
+            if name.startswith("_") or name in AccountManager.Account.CORE_ATTRIBUTES or name not in self.__attribute_names:
+                raise AttributeError(name)
+
+            if self.__decoded is None:
+                self.__decoded = {}
+            if name not in self.__decoded:
+                self.__decoded[name] = self.__decode(name)
+            if self.__decoded[name] is None:
+                raise AttributeError(name)
+            return self.__decoded[name]
 
 
         def __repr__(self):
-            return "%s" % json.dumps(self.__dict__)
+            attributes = {}
+            for name in list(self.__attribute_names) + ["grafanaInviteLink"]:
+                if hasattr(self, name):
+                    attributes[name] = getattr(self, name)
+            return "%s" % json.dumps(attributes)
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, ldap_query_config, ldap_user, ldap_password, ldap_url, pool_config=None):
+        """Constructor
 
-    def __init__(self, ldap_query_config, ldap_user, ldap_password, ldap_url):
+        Arguments:
+            ldap_query_config {dict} -- The "ldap.query" section of the configuration.
+            ldap_user {str} -- LDAP service account username.
+            ldap_password {str} -- LDAP service account password.
+            ldap_url {str|list[str]} -- LDAP URL, several URLs are used as a pool of servers failing over to each other.
+            pool_config {dict} -- The "ldap.pool" section of the configuration.
+        """
+        pool_config = pool_config or {}
         self.__ldap_query_config = ldap_query_config
-        server = ldap3.Server(ldap_url)
-        self.__connection = ldap3.Connection(server=server, user=ldap_user, password=ldap_password)
-        self.__connection.bind()
+        self.__high_water_mark = None
+        self.__high_water_mark_lock = threading.Lock()
+        nested_groups = ldap_query_config.get("nested_groups", {})
+        self.__group_cache = GroupCache(nested_groups.get("cache_size", DEFAULT_GROUP_CACHE_SIZE),
+                                        nested_groups.get("cache_ttl", DEFAULT_GROUP_CACHE_TTL), nested_groups.get("cache_path"))
+        server = create_server(ldap_url, pool_config)
+
+        def connect():
+            import ldap3  # pylint: disable=import-outside-toplevel
+
+            connection = ldap3.Connection(server=server, user=ldap_user, password=ldap_password)
+            with REGISTRY.timer("ldap_bind"):
+                connection.bind()
+            return connection
+
+        # By default each of several searches gets a connection of its own
+        self.__pool = ConnectionPool(connect, pool_config.get("connections", len(ldap_query_config.get("searches", [])) or 1))
+
+
+    def close(self):
+        """Unbinds from LDAP.
+        """
+
+        self.__pool.close()
+
+
+    def expand_groups(self, groups):
+        """Returns the given groups together with all groups nested in them.
+
+        The hierarchy is walked breadth-first. The subgroups of all groups of a level which aren't cached yet are fetched
+        with OR filters of at most ``query.lookup_chunk_size`` groups, so each group costs a share of one query at most.
+
+        Arguments:
+            groups {list[str]} -- DNs of the groups to expand.
+
+        Returns:
+            [list[str]] -- Returns the DNs of the groups, each only once.
+        """
+
+        nested_groups = self.__ldap_query_config["nested_groups"]
+        group_filter = nested_groups.get("filter", DEFAULT_GROUP_FILTER)
+        chunk_size = self.__ldap_query_config.get("lookup_chunk_size", DEFAULT_LOOKUP_CHUNK_SIZE)
+        expanded = OrderedDict((group.lower(), group) for group in groups)
+        level = list(expanded.values())
 
+        while level:
+            subgroups = {group.lower(): self.__group_cache.get(group) for group in level}
+            for chunk in chunks([group for group in level if subgroups[group.lower()] is None], chunk_size):
+                found = {group.lower(): [] for group in chunk}
+                with self.__pool.connection() as connection:
+                    connection.search(search_base=nested_groups["base_dn"], search_filter=lookup_filter(group_filter, [("memberOf", group) for group in chunk]),
+                                      search_scope=SUBTREE, attributes=["memberOf"])
+                    for entry in connection.response:
+                        for parent in entry.get("raw_attributes", {}).get("memberOf", []):
+                            if parent.decode("utf-8").lower() in found:
+                                found[parent.decode("utf-8").lower()].append(entry["dn"])
+                for group, members in found.items():
+                    self.__group_cache.put(group, members)
+                subgroups.update(found)
 
-    def get_accounts(self):
+            level = []
+            for members in subgroups.values():
+                for group in members:
+                    if group.lower() not in expanded:
+                        expanded[group.lower()] = group
+                        level.append(group)
+
+        self.__group_cache.save()
+        return list(expanded.values())
+
+
+    def get_accounts(self, modified_since=None, search_filter=None):
         """Connects to LDAP, searches for user accounts and generates a list of :class:`grafana_inviter.accounts.AccountManager.Account`
 
+        Arguments:
+            modified_since {str} -- Only search for accounts whose ``delta.attribute`` is at least this value.
+            search_filter {str} -- Filter used instead of the configured ``search_filter``.
+
         Returns:
             [list] -- Returns a list of :class:`grafana_inviter.accounts.AccountManager.Account`
         """
 
-        group_base_dn = self.__ldap_query_config["group_base_dn"]
-        search_filter = self.__ldap_query_config["search_filter"]
+        with REGISTRY.timer("ldap_get_accounts"):
+            return list(self.iter_accounts(modified_since=modified_since, search_filter=search_filter))
+
+
+    def find_account(self, attribute, value):
+        """Searches for a single account by the value of an attribute such as ``uid`` or ``mail``, within the configured searches.
+
+        Returns:
+            [AccountManager.Account] -- Returns the account or None if no account matches.
+        """
+
+        accounts = list(self.__iter_searches(self.__searches(terms=[(attribute, value)])))
+        return accounts[0] if accounts else None
+
+
+    def get_accounts_by(self, uids=(), mails=()):
+        """Looks up the accounts with the given uids or mails within the configured searches, instead of scanning the whole group.
+
+        The values are combined into OR filters of at most ``query.lookup_chunk_size`` values each.
+
+        Arguments:
+            uids {iterable[str]} -- Values of the ``uid`` attribute.
+            mails {iterable[str]} -- Values of the ``mail`` attribute.
+
+        Returns:
+            [list] -- Returns the found accounts, each only once, in the order of the searches.
+        """
+
+        terms = [("uid", uid) for uid in uids] + [("mail", mail) for mail in mails]
+        chunk_size = self.__ldap_query_config.get("lookup_chunk_size", DEFAULT_LOOKUP_CHUNK_SIZE)
+        accounts, seen = [], set()
+        for chunk in chunks(terms, chunk_size):
+            for account in self.__iter_searches(self.__searches(terms=chunk)):
+                mail = getattr(account, "mail", "").lower()
+                if mail not in seen:
+                    seen.add(mail)
+                    accounts.append(account)
+        return accounts
+
+
+    @property
+    def high_water_mark(self):
+        """Returns the most recent value of the ``delta.attribute`` seen by the searches so far or None.
+        """
+
+        return self.__high_water_mark
+
+
+    def iter_accounts(self, modified_since=None, search_filter=None):
+        """Searches for user accounts and yields them as :class:`grafana_inviter.accounts.AccountManager.Account`
+
+        If a ``page_size`` is configured the search uses the paged results control (RFC 2696), so accounts are yielded
+        while the search is still running and server side size limits don't apply. Several configured ``searches`` run
+        concurrently, their accounts are yielded as they arrive and only once per mail.
+
+        Arguments:
+            modified_since {str} -- Only search for accounts whose ``delta.attribute`` is at least this value.
+            search_filter {str} -- Filter used instead of the configured ``search_filter`` of each search.
+
+        Returns:
+            [generator] -- Yields :class:`grafana_inviter.accounts.AccountManager.Account`
+        """
+
+        return self.__iter_searches(self.__searches(search_filter=search_filter), modified_since)
+
+
+    def __searches(self, search_filter=None, terms=None):
+        """Returns the pairs of base DN and filter to search.
+
+        Arguments:
+            search_filter {str} -- Filter used instead of the configured ones.
+            terms {list[tuple(str, str)]} -- Restricts the searches to accounts with any of these attribute values.
+        """
+
+        searches = [(search["group_base_dn"], search["search_filter"]) for search in self.__ldap_query_config.get("searches", [])]
+        if not searches:
+            searches = [(self.__ldap_query_config["group_base_dn"], self.__ldap_query_config["search_filter"])]
+        searches = [(search_base, search_filter or configured_filter) for search_base, configured_filter in searches]
+        nested_groups = self.__ldap_query_config.get("nested_groups")
+        if nested_groups:
+            chunk_size = self.__ldap_query_config.get("lookup_chunk_size", DEFAULT_LOOKUP_CHUNK_SIZE)
+            groups = [("memberOf", group) for group in self.expand_groups(nested_groups["groups"])]
+            searches = [(search_base, lookup_filter(configured_filter, chunk))
+                        for search_base, configured_filter in searches for chunk in chunks(groups, chunk_size)]
+        if terms:
+            searches = [(search_base, lookup_filter(configured_filter, terms)) for search_base, configured_filter in searches]
+        return searches
+
+
+    def __iter_searches(self, searches, modified_since=None):
+        """Yields the accounts of a single search or merges the accounts of several concurrent searches, each mail only once.
+        """
+
+        if len(searches) == 1:
+            yield from self.__search(searches[0][0], searches[0][1], modified_since)
+            return
+
+        results = queue.Queue(maxsize=MERGE_BUFFER_SIZE)
+        stopped = threading.Event()
+
+        def offer(item):
+            while not stopped.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce(search_base, search_filter):
+            try:
+                with closing(self.__search(search_base, search_filter, modified_since)) as accounts:
+                    for account in accounts:
+                        if not offer(account):
+                            return
+                offer(None)
+            except Exception as error:  # pylint: disable=broad-except
+                offer(error)
+
+        with ThreadPoolExecutor(max_workers=min(len(searches), MAX_PARALLEL_SEARCHES)) as executor:
+            for search_base, search_filter in searches:
+                executor.submit(produce, search_base, search_filter)
+            try:
+                running, seen = len(searches), set()
+                while running:
+                    item = results.get()
+                    if item is None:
+                        running -= 1
+                    elif isinstance(item, Exception):
+                        raise item
+                    elif item.mail.lower() not in seen:
+                        seen.add(item.mail.lower())
+                        yield item
+            finally:
+                stopped.set()
+
+
+    def __search(self, search_base, search_filter, modified_since):
+        """Runs a single search over a pooled connection and yields its accounts, timing the search but not its consumer.
+        """
+
+        return REGISTRY.timed("ldap_search", self.__search_entries(search_base, search_filter, modified_since))
+
+
+    def __search_entries(self, search_base, search_filter, modified_since):
+        """Runs a single search over a pooled connection and yields its accounts.
+        """
+
+        from ldap3.utils.conv import escape_filter_chars  # pylint: disable=import-outside-toplevel
+
         retrieve_attributes = self.__ldap_query_config["retrieve_attributes"]
+        page_size = self.__ldap_query_config.get("page_size")
+        delta_attribute = self.__ldap_query_config.get("delta", {}).get("attribute")
+
+        search_attributes = retrieve_attributes
+        if delta_attribute:
+            if delta_attribute not in retrieve_attributes:
+                search_attributes = retrieve_attributes + [delta_attribute]
+            if modified_since is not None:
+                search_filter = "(&%s(%s>=%s))" % (search_filter, delta_attribute, escape_filter_chars(modified_since))
+
+        with self.__pool.connection() as connection:
+            if page_size:
+                group_members = connection.extend.standard.paged_search(search_base=search_base, search_filter=search_filter,
+                                                                        search_scope=SUBTREE, attributes=search_attributes,
+                                                                        paged_size=page_size, generator=True)
+            else:
+                connection.search(search_base=search_base, search_filter=search_filter, search_scope=SUBTREE, attributes=search_attributes)
+                group_members = connection.response
+                LOGGER.debug("Search of %s with %s returned %s", search_base, search_filter, group_members)
 
-        self.__connection.search(search_base=group_base_dn, search_filter=search_filter, search_scope=ldap3.SUBTREE, attributes=retrieve_attributes)
-        group_members = self.__connection.response
-        print(group_members)
-        return [AccountManager.Account(member, retrieve_attributes) for member in group_members]
+            for member in group_members:
+                # Search continuation references carry no attributes
+                if member.get("type") != "searchResRef":
+                    if delta_attribute:
+                        with self.__high_water_mark_lock:
+                            for value in member["raw_attributes"].get(delta_attribute, []):
+                                self.__high_water_mark = newer_value(self.__high_water_mark, value.decode("utf-8"))
+                    REGISTRY.increment("ldap_entries")
+                    yield AccountManager.Account(member, retrieve_attributes)
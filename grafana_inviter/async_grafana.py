@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+"""Module providing an asyncio counterpart of :class:`grafana_inviter.grafana.Grafana`.
+
+Requires the ``async`` extra (``pip install grafana-inviter[async]``).
+"""
+
+import asyncio
+import json
+import aiohttp
+
+from .grafana import (ALREADY_INVITED, DEFAULT_POOL_SIZE, DEFAULT_ROLE, HttpMethod, InviteResult, assign_invite_links, index_invites, invite_payload,
+                      missing_invite_links, response_message)
+from .throttle import Throttle
+
+
+class AdaptiveSlots:
+    """Asynchronous context manager limiting the requests in flight within an event loop to the adaptive limit of a throttle.
+
+    The limit is checked again whenever a request completes, so it follows the throttle as Grafana starts or stops throttling.
+    """
+
+    def __init__(self, throttle):
+        """Constructor
+
+        Arguments:
+            throttle {grafana_inviter.throttle.Throttle} -- Throttle providing the current number of requests allowed in flight.
+        """
+        self.__throttle = throttle
+        self.__in_flight = 0
+        self.__condition = asyncio.Condition()
+
+
+    async def __aenter__(self):
+        async with self.__condition:
+            await self.__condition.wait_for(lambda: self.__in_flight < self.__throttle.concurrency)
+            self.__in_flight += 1
+
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        async with self.__condition:
+            self.__in_flight -= 1
+            self.__condition.notify_all()
+
+
+class AsyncGrafana:
+    """Simple class wrapping the Grafana HTTP API for use within an asyncio event loop.
+
+    All requests share one connection pool. At most ``concurrency`` requests are in flight at a time, fewer while Grafana
+    throttles the requests as with :class:`grafana_inviter.grafana.Grafana`.
+    The client should be closed with :meth:`close` or used as an asynchronous context manager.
+    """
+
+    def __init__(self, grafana_config):
+        """Constructor
+
+        Arguments:
+            grafana_config {dict} -- The "grafana" section of the configuration.
+        """
+        self.__grafana_config = grafana_config
+        self.__grafana_server = grafana_config["url"]
+        self.__throttle = Throttle(grafana_config)
+        self.__session = None
+        self.__slots = None
+        self.__invites = None
+        self.__invites_lock = None
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+    def __get_session(self):
+        """Returns the HTTP session, creating it on first use.
+
+        The session and the synchronization primitives are created lazily so they are bound to the running event loop.
+        """
+
+        if self.__session is None:
+            concurrency = self.__grafana_config.get("concurrency", 1)
+            pool_size = self.__grafana_config.get("pool_size", max(DEFAULT_POOL_SIZE, concurrency))
+            connector = aiohttp.TCPConnector(limit=pool_size, force_close=not self.__grafana_config.get("keep_alive", True))
+            self.__session = aiohttp.ClientSession(connector=connector,
+                                                   headers={"Authorization": "Bearer %s" % self.__grafana_config["token"],
+                                                            "X-Grafana-Org-Id": str(self.__grafana_config["orgId"])})
+            self.__slots = AdaptiveSlots(self.__throttle)
+            self.__invites_lock = asyncio.Lock()
+        return self.__session
+
+
+    async def close(self):
+        """Closes all pooled connections to Grafana.
+        """
+
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+
+    async def __query(self, method, api_endpoint, raise_for_status=False, **kwargs):
+        """Sends a request to the given endpoint once a concurrency slot is available.
+
+        Requests are rate limited and retried with a backoff if Grafana signals it is overloaded.
+
+        Arguments:
+            method {HttpMethod} -- HTTP method.
+            endpoint {str} -- Grafana API endpoint (eg. org/users).
+            raise_for_status {bool} -- Raise an aiohttp.ClientResponseError if the final response is an error.
+
+        Returns:
+            [tuple(int, object)] -- Returns the HTTP status code and the decoded JSON body.
+        """
+
+        session = self.__get_session()
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.__throttle.delay_before_request())
+            async with self.__slots:
+                async with session.request(method.name, "%s/api/%s" % (self.__grafana_server, api_endpoint), **kwargs) as response:
+                    delay = self.__throttle.retry_delay(attempt, response.status, response.headers,
+                                                        idempotent=method == HttpMethod.GET)
+                    if delay is None:
+                        if raise_for_status:
+                            response.raise_for_status()
+                        body = await response.text()
+                        try:
+                            return response.status, json.loads(body)
+                        except ValueError:
+                            return response.status, body
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+    async def refresh_invites(self):
+        """Fetches the pending invites of the organization and indexes them by their lowercased email.
+
+        Returns:
+            [dict] -- Pending invites keyed by lowercased email.
+        """
+
+        _, invites = await self.__query(HttpMethod.GET, "org/invites", raise_for_status=True)
+        self.__invites = index_invites(invites)
+        return self.__invites
+
+
+    async def __pending_invites(self):
+        """Returns the index of pending invites, fetching it from Grafana on first use.
+        """
+
+        self.__get_session()
+        async with self.__invites_lock:
+            if self.__invites is None:
+                await self.refresh_invites()
+            return self.__invites
+
+
+    async def invite(self, account, send_mail=False):
+        """Generates an invite for given account in Grafana.
+
+        Args:
+            account {AccountManager.Account} -- Account to be used to generate invite for.
+
+        Returns:
+            [InviteResult] -- True if succeeded otherwise False including a message.
+        """
+
+        invites = await self.__pending_invites()
+        if account.mail.lower() in invites:
+            return InviteResult(False, ALREADY_INVITED)
+
+        payload = invite_payload(account, send_mail, self.__grafana_config["orgId"], self.__grafana_config.get("role", DEFAULT_ROLE))
+        status, body = await self.__query(HttpMethod.POST, "org/invites", json=payload)
+        succeeded = status == 200
+        if succeeded:
+            invites[account.mail.lower()] = {"email": account.mail, "name": account.name}
+        return InviteResult(succeeded, response_message(status, body))
+
+
+    async def invite_all(self, accounts, send_mail=False):
+        """Generates invites for all given accounts concurrently.
+
+        Arguments:
+            accounts {list[AccountManager.Account]} -- Accounts to be invited.
+
+        Returns:
+            [list[InviteResult]] -- The invite results in the order of the accounts.
+        """
+
+        return await asyncio.gather(*[self.invite(account, send_mail=send_mail) for account in accounts])
+
+
+    async def populate_accounts_with_invite_links(self, accounts):
+        """Populates the accounts with a Grafana invite link in case an invitation is found.
+
+        The pending invites are only fetched again if invites were created since the index was built.
+
+        Arguments:
+            accounts {list[grafana_inviter.AccountManager.Account]} -- Accounts we want to obtain the invite link for
+        """
+
+        invites = await self.__pending_invites()
+        if missing_invite_links(invites, accounts):
+            invites = await self.refresh_invites()
+        assign_invite_links(invites, accounts)
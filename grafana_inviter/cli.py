@@ -4,13 +4,43 @@
 """
 
 import argparse
+from collections import deque, namedtuple
+import copy
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from getpass import getpass
+import os
+import signal
 import sys
-import anyconfig
+import threading
+import time
 
 from .accounts import AccountManager
-from .grafana import Grafana
-from .config_schema import json_config_schema
+from .grafana import ALREADY_INVITED, Grafana
+from .metrics import REGISTRY, export
+from .output import ACTION_INVITE, ACTION_LINK, ACTION_REVOKE, ACTION_SKIP, FORMAT_TEXT, FORMATS, Result, create_writer
+from .reconcile import ALREADY_MEMBER, estimate_duration, reconcile
+from .state import STATUS_ALREADY_INVITED, STATUS_FAILED, STATUS_INVITED, STATUS_MEMBER, StateStore
+from .throttle import Throttle
+from .config_schema import config_validator
+
+
+HIGH_WATER_MARK_KEY = "ldap_high_water_mark"
+LAST_FULL_SYNC_KEY = "ldap_last_full_sync"
+DEFAULT_FULL_RESYNC_INTERVAL = 86400
+DEFAULT_INTERVAL = 300
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+DEFAULT_LOG_LEVEL = "INFO"
+
+LOGGER = logging.getLogger(__name__)
+
+# Parsed configuration files keyed by path, with the modification time and size they were parsed at
+CONFIG_CACHE = {}
+
+OrgReport = namedtuple("OrgReport", ["url", "org_id", "invited", "skipped", "failed", "revoked", "invite_urls"])
+OrgReport.__doc__ = """Outcome of inviting into one organization of a Grafana instance.
+"""
 
 
 def parse_args(args):
@@ -18,6 +48,9 @@ def parse_args(args):
     """
 
     parser = argparse.ArgumentParser(description="Script for generating/sending Grafana invite URLs. By default only invite URLs are generated.")
+    parser.add_argument("command", nargs="?", choices=["invite", "plan", "serve"], default="invite",
+                        help="Send the invites (default), only print the planned actions without changing anything in Grafana "
+                        "or serve invites of single accounts over HTTP")
     parser.add_argument("--ldap-url", type=str, help="LDAP URL")
     parser.add_argument("--ldap-user", type=str, help="LDAP service account username")
     parser.add_argument("--ldap-password", type=str, help="LDAP service account password")
@@ -26,15 +59,40 @@ def parse_args(args):
     parser.add_argument("--grafana-token", type=str, help="Grafana API token")
     parser.add_argument("--ask-grafana-token", action="store_true", help="Ask for the Grafana API token")
     parser.add_argument("--send-invite-mail", action="store_true", help="Send mail with Grafana invite URL.")
+    parser.add_argument("--concurrency", type=int, help="Maximum number of invites sent to Grafana in parallel")
+    parser.add_argument("--stream", action="store_true",
+                        help="Send invites while the LDAP search is still running instead of collecting all accounts first")
+    parser.add_argument("--revoke-invites", action="store_true", help="Revoke pending invites of users not found in LDAP")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Keep running and send the invites every --interval seconds, SIGHUP reloads the configuration")
+    parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL, help="Seconds between the runs in --daemon mode")
+    parser.add_argument("--host", type=str, default=DEFAULT_HOST, help="Address the serve command listens on")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port the serve command listens on")
+    parser.add_argument("--user", action="append", dest="users", metavar="UID_OR_MAIL",
+                        help="Only invite the account with this uid or mail instead of the whole group, can be repeated")
+    parser.add_argument("--users-file", type=str, help="Only invite the accounts listed in this file, one uid or mail per line")
+    parser.add_argument("--output-format", choices=FORMATS, help="Write the result of each account as text (default), NDJSON or CSV")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default=DEFAULT_LOG_LEVEL,
+                        help="Log messages of this level and above to standard error, DEBUG includes the requests and LDAP responses")
+    parser.add_argument("--metrics-textfile", type=str, help="Write the metrics of the run to this file for the Prometheus node exporter")
+    parser.add_argument("--metrics-summary", action="store_true", help="Print the timings and counts of the run to standard error at the end")
+    parser.add_argument("--state-file", type=str, help="Location of a SQLite database remembering processed accounts between runs")
     parser.add_argument("--config", required=True, type=str, help="Location of configuration file")
     return parser.parse_args(args)
 
 
+def grafana_instances(config):
+    """Returns the "grafana" configuration of each Grafana instance, the "grafana" section may be a single instance or a list of them.
+    """
+
+    return config["grafana"] if isinstance(config["grafana"], list) else [config["grafana"]]
+
+
 def configure(args):
     """Load the configuration and alter it based on the passed argparse arguments which take presedence over the configuration file.
     """
 
-    config = anyconfig.load(args.config)
+    config = load_config(args.config)
 
     if args.ldap_url:
         config["ldap"]["url"] = args.ldap_url
@@ -47,58 +105,750 @@ def configure(args):
     if args.ask_ldap_password:
         config["ldap"]["password"] = getpass("LDAP password: ")
 
+    grafana_token = getpass("Grafana token: ") if args.ask_grafana_token else args.grafana_token
+    for grafana_config in grafana_instances(config):
+        override_grafana(grafana_config, args, grafana_token)
+    if args.state_file:
+        config.setdefault("state", {})["path"] = args.state_file
+    if args.output_format:
+        config.setdefault("output", {})["format"] = args.output_format
+    if args.metrics_textfile:
+        config.setdefault("metrics", {})["textfile"] = args.metrics_textfile
+    if args.metrics_summary:
+        config.setdefault("metrics", {})["summary"] = True
+    if args.users or args.users_file:
+        config["ldap"]["users"] = (args.users or []) + (read_users(args.users_file) if args.users_file else [])
+
+    return config
+
+
+def override_grafana(grafana_config, args, grafana_token):
+    """Alters the "grafana" configuration of an instance based on the passed argparse arguments.
+    """
+
     if args.grafana_url:
-        config["grafana"]["url"] = args.grafana_url
-    if args.grafana_token:
-        config["grafana"]["token"] = args.grafana_token
-    if args.ask_grafana_token:
-        config["grafana"]["token"] = getpass("Grafana token: ")
+        grafana_config["url"] = args.grafana_url
+    if grafana_token:
+        grafana_config["token"] = grafana_token
     if args.send_invite_mail:
-        config["grafana"]["send_invite_mail"] = True
+        grafana_config["send_invite_mail"] = True
+    if args.revoke_invites:
+        grafana_config["revoke_invites"] = True
+    if args.concurrency:
+        grafana_config["concurrency"] = args.concurrency
 
-    return config
+
+def read_users(path):
+    """Returns the uids and mails listed in a file, one per line, skipping empty lines and comments starting with ``#``.
+    """
+
+    with open(path, encoding="utf-8") as users_file:
+        return [line.strip() for line in users_file if line.strip() and not line.strip().startswith("#")]
+
+
+def split_users(users):
+    """Splits the selected users into the ``uids`` and ``mails`` arguments of :meth:`AccountManager.get_accounts_by`.
+    """
+
+    return {"uids": [user for user in users if "@" not in user], "mails": [user for user in users if "@" in user]}
+
+
+def load_config(path):
+    """Returns a copy of the parsed configuration file, which is only parsed again if its modification time or size changed.
+    """
+
+    try:
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        key = None
+
+    cached = CONFIG_CACHE.get(path)
+    if key is None or cached is None or cached[0] != key:
+        # anyconfig and jsonschema are only imported when needed, so --help doesn't pay for them
+        import anyconfig  # pylint: disable=import-outside-toplevel
+
+        cached = (key, anyconfig.load(path))
+        if key is not None:
+            CONFIG_CACHE[path] = cached
+    return copy.deepcopy(cached[1])
 
 
 def validate(config):
     """Validate the configuration
     """
 
-    schema = anyconfig.loads(json_config_schema(), ac_parser="json")
-    result, message = anyconfig.validate(config, schema)
-    if not result:
-        raise SystemExit(message)
+    import jsonschema  # pylint: disable=import-outside-toplevel
+
+    error = jsonschema.exceptions.best_match(config_validator().iter_errors(config))
+    if error is not None:
+        raise SystemExit("Invalid configuration at %s: %s" % ("/".join(str(part) for part in error.absolute_path) or "top level", error.message))
+
+
+def invite_accounts(grafana, accounts, send_mail, concurrency=1):
+    """Sends invites to the given accounts, at most ``concurrency`` at a time.
+
+    Accounts are consumed lazily, only a bounded window of accounts is waiting for its invite at any time.
+
+    Arguments:
+        grafana {grafana_inviter.grafana.Grafana} -- Grafana client used to send the invites.
+        accounts {iterable[grafana_inviter.accounts.AccountManager.Account]} -- Accounts to invite.
+        send_mail {bool} -- Whether Grafana should send the invite mail.
+        concurrency {int} -- Maximum number of invites in flight.
+
+    Returns:
+        [iterator[tuple(Account, InviteResult)]] -- Yields each account with its invite result, in the order of the accounts.
+    """
+
+    def invite(account):
+        return account, grafana.invite(account=account, send_mail=send_mail)
+
+    if concurrency <= 1:
+        yield from map(invite, accounts)
+        return
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = deque()
+        for account in accounts:
+            pending.append(executor.submit(invite, account))
+            if len(pending) >= 2 * concurrency:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def invite_status(succeeded, message):
+    """Maps an invite result to the status stored in the :class:`grafana_inviter.state.StateStore`.
+    """
+
+    if succeeded:
+        return STATUS_INVITED
+    if message == ALREADY_INVITED:
+        return STATUS_ALREADY_INVITED
+    if message == ALREADY_MEMBER:
+        return STATUS_MEMBER
+    return STATUS_FAILED
+
+
+def changed_accounts(state, accounts, skipped):
+    """Yields the accounts which weren't processed before or changed since, counting the others.
+
+    Arguments:
+        state {grafana_inviter.state.StateStore} -- State of previous runs or None to yield all accounts.
+        accounts {iterable[grafana_inviter.accounts.AccountManager.Account]} -- Accounts found in LDAP.
+        skipped {list} -- Receives the number of skipped accounts as its only element.
+    """
+
+    for account in accounts:
+        if state is not None and state.is_unchanged(account):
+            skipped[0] += 1
+        else:
+            yield account
+
+
+def open_state(config):
+    """Returns the state store configured in the "state" section or None if not configured.
+    """
+
+    return StateStore(config["state"]["path"]) if "state" in config else None
+
+
+def delta_start(config, state):
+    """Returns the high-water mark an incremental LDAP sync continues from or None if a full sync is due.
+
+    A full sync is done if ``ldap.query.delta`` isn't configured, there is no state of a previous run or the last full sync is
+    older than ``delta.full_resync_interval`` seconds.
+    """
+
+    delta = config["ldap"]["query"].get("delta")
+    if not delta or config["ldap"].get("users"):
+        return None
+    if state is None:
+        LOGGER.warning("Incremental LDAP sync requires a state file, doing a full sync")
+        return None
+
+    last_full_sync = state.get_meta(LAST_FULL_SYNC_KEY)
+    if last_full_sync is None or time.time() - float(last_full_sync) >= delta.get("full_resync_interval", DEFAULT_FULL_RESYNC_INTERVAL):
+        return None
+    return state.get_meta(HIGH_WATER_MARK_KEY)
+
+
+# pylint: disable=too-many-arguments
+def delta_finish(config, state, manager, modified_since, started, *, failed=False):
+    """Stores the high-water mark reached by the LDAP search of a completed run.
+
+    If invites failed nothing is stored, so the next run searches the same entries again and retries them.
+
+    Arguments:
+        modified_since {str} -- High-water mark the run started from or None if it was a full sync.
+        started {float} -- Time the run started at.
+        failed {bool} -- Whether any invite of the run failed.
+    """
+
+    if not config["ldap"]["query"].get("delta") or config["ldap"].get("users") or state is None:
+        return
+    if failed:
+        LOGGER.warning("Invites failed, the next incremental LDAP sync continues from the previous high-water mark")
+        return
+    if manager.high_water_mark is not None:
+        state.set_meta(HIGH_WATER_MARK_KEY, manager.high_water_mark)
+    if modified_since is None:
+        state.set_meta(LAST_FULL_SYNC_KEY, started)
+
+
+def skip_members(accounts, members, writer):
+    """Yields the accounts which aren't members of the organization yet, reporting the others.
+    """
+
+    for account in accounts:
+        if account.mail.lower() in members:
+            writer.write(Result(ACTION_SKIP, account.name, account.mail, False, ALREADY_MEMBER))
+        else:
+            yield account
+
+
+def revoke_invites(grafana, invites, writer):
+    """Revokes the given pending invites.
+    """
+
+    for invite in invites:
+        succeeded, message = grafana.revoke_invite(invite)
+        writer.write(Result(ACTION_REVOKE, invite.get("name"), invite["email"], succeeded, message))
+
+
+def open_writer(config, line_buffered=False):
+    """Returns the writer of the results in the configured "output.format", text by default.
+
+    Arguments:
+        line_buffered {bool} -- Whether each result is written right away instead of in blocks.
+    """
+
+    return create_writer(config.get("output", {}).get("format", FORMAT_TEXT), line_buffered=line_buffered)
+
+
+def write_links(writer, accounts):
+    """Writes the invite URLs of the given accounts known at the end of a run.
+
+    Arguments:
+        accounts {list[grafana_inviter.accounts.AccountManager.Account]} -- Accounts processed during the run.
+
+    Returns:
+        [list[str]] -- Returns the invite URLs.
+    """
+
+    linked = [account for account in accounts if hasattr(account, "grafanaInviteLink")]
+    for account in linked:
+        writer.write(Result(ACTION_LINK, account.name, account.mail, True, None, account.grafanaInviteLink))
+    return [account.grafanaInviteLink for account in linked]
+
+
+def create_account_manager(config):
+    """Returns an :class:`grafana_inviter.accounts.AccountManager` for the "ldap" section of the configuration.
+    """
+
+    return AccountManager(ldap_query_config=config["ldap"]["query"],
+                          ldap_user=config["ldap"]["user"], ldap_password=config["ldap"]["password"],
+                          ldap_url=config["ldap"]["url"], pool_config=config["ldap"].get("pool"))
+
+
+def read_plan(grafana, manager, state, modified_since, users=None):
+    """Searches LDAP and reads the state of the Grafana organization to plan the actions needed, without changing anything.
+
+    Arguments:
+        users {list[str]} -- Uids and mails of the selected accounts to look up instead of searching the whole group.
+
+    Returns:
+        [tuple(list, Plan, int)] -- Returns the accounts to process, the plan for them and the number of accounts skipped
+        as they are unchanged since the last run.
+    """
+
+    skipped = [0]
+    if users:
+        found_accounts = manager.get_accounts_by(**split_users(users))
+    else:
+        found_accounts = manager.get_accounts(modified_since=modified_since)
+    accounts = list(changed_accounts(state, found_accounts, skipped))
+    plan = reconcile(accounts, grafana.org_members(), grafana.pending_invites(),
+                     directory_mails={account.mail.lower() for account in found_accounts})
+    return accounts, plan, skipped[0]
+
+
+def sync(config, manager, grafana, state):
+    """Sends the invites of one run using already connected clients, which stay open afterwards.
+
+    Arguments:
+        config {dict} -- The configuration.
+        manager {grafana_inviter.accounts.AccountManager} -- Bound LDAP client.
+        grafana {grafana_inviter.grafana.Grafana} -- Grafana client of the organization.
+        state {grafana_inviter.state.StateStore} -- State of previous runs or None.
+    """
+
+    started = time.time()
+    statuses = []
+    writer = open_writer(config)
+
+    try:
+        with REGISTRY.timer("phase", phase="plan"):
+            modified_since = delta_start(config, state)
+            accounts, plan, skipped = read_plan(grafana, manager, state, modified_since, config["ldap"].get("users"))
+        for account, message in plan.skip:
+            writer.write(Result(ACTION_SKIP, account.name, account.mail, False, message))
+            statuses.append((account, invite_status(False, message)))
+
+        with REGISTRY.timer("phase", phase="invite"):
+            for account, (succeeded, message) in invite_accounts(grafana, plan.add, send_mail=config["grafana"]["send_invite_mail"],
+                                                                 concurrency=config["grafana"].get("concurrency", 1)):
+                writer.write(Result(ACTION_INVITE, account.name, account.mail, succeeded, message))
+                statuses.append((account, invite_status(succeeded, message)))
+
+        if config["grafana"].get("revoke_invites"):
+            if config["ldap"].get("users"):
+                writer.note("Not revoking invites when inviting selected users")
+            elif modified_since is None:
+                with REGISTRY.timer("phase", phase="revoke"):
+                    revoke_invites(grafana, plan.revoke, writer)
+            else:
+                writer.note("Not revoking invites during an incremental LDAP sync")
+
+        with REGISTRY.timer("phase", phase="invite_links"):
+            grafana.populate_accounts_with_invite_links(accounts)
+        with REGISTRY.timer("phase", phase="state"):
+            if state is not None:
+                for account, status in statuses:
+                    state.record(account, status, getattr(account, "grafanaInviteLink", None))
+            delta_finish(config, state, manager, modified_since, started,
+                         failed=any(status == STATUS_FAILED for _, status in statuses))
+            if state is not None:
+                state.commit()
+        for _, status in statuses:
+            REGISTRY.increment("accounts", status=status)
+        REGISTRY.increment("accounts", skipped, status="unchanged")
+
+        if skipped:
+            writer.note("Skipped %d accounts unchanged since the last run" % skipped)
+        writer.note("Available invite URLs: %s" % write_links(writer, accounts))
+    finally:
+        writer.flush()
 
 
 def assemble(config):
     """Assembles all pieces together and sends invites to users.
     """
 
-    manager = AccountManager(ldap_query_config=config["ldap"]["query"],
-                             ldap_user=config["ldap"]["user"], ldap_password=config["ldap"]["password"],
-                             ldap_url=config["ldap"]["url"])
-    accounts = manager.get_accounts()
+    manager = create_account_manager(config)
+    grafana = Grafana(grafana_config=config["grafana"])
+    state = open_state(config)
+
+    try:
+        sync(config, manager, grafana, state)
+    finally:
+        manager.close()
+        grafana.close()
+        if state is not None:
+            state.close()
+
+    return 0
+
+
+def daemon(args, config):
+    """Runs :func:`sync` every ``--interval`` seconds until SIGTERM or SIGINT is received.
+
+    The LDAP bind, the Grafana session and the state file stay open between runs, so with ``ldap.query.delta`` configured
+    a run only costs the changed accounts. SIGHUP reloads the configuration file before the next run, secrets asked for at
+    startup are kept. An invalid configuration file is logged and the previous configuration is kept. The clients are reconnected after a failed run.
+
+    Arguments:
+        args {argparse.Namespace} -- Parsed commandline arguments, used to reload the configuration.
+        config {dict} -- The validated configuration.
+    """
+
+    if args.ask_ldap_password:
+        args.ldap_password, args.ask_ldap_password = config["ldap"]["password"], False
+    if args.ask_grafana_token:
+        args.grafana_token, args.ask_grafana_token = config["grafana"]["token"], False
+
+    received = []
+    wakeup = threading.Event()
+
+    def handle_signal(signum, _):
+        received.append(signum)
+        wakeup.set()
+
+    previous_handlers = {signum: signal.signal(signum, handle_signal) for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)}
+    clients = None
+    try:
+        while True:
+            wakeup.clear()
+            if signal.SIGTERM in received or signal.SIGINT in received:
+                break
+            if signal.SIGHUP in received:
+                received.remove(signal.SIGHUP)
+                try:
+                    reloaded_config = configure(args)
+                    validate(reloaded_config)
+                except (Exception, SystemExit) as error:  # pylint: disable=broad-except
+                    LOGGER.error("Reloading the configuration failed, keeping the previous one: %s", error)
+                else:
+                    config = reloaded_config
+                    close_clients(clients)
+                    clients = None
+                    LOGGER.info("Reloaded the configuration")
+
+            started = time.time()
+            try:
+                clients = clients or open_clients(config)
+                clients[1].clear_cache()
+                sync(config, *clients)
+            except Exception as error:  # pylint: disable=broad-except
+                LOGGER.error("Run failed, reconnecting before the next run: %s", error)
+                close_clients(clients)
+                clients = None
+            export(REGISTRY, config.get("metrics", {}))
+            wakeup.wait(max(0.0, args.interval - (time.time() - started)))
+    finally:
+        close_clients(clients)
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+
+    return 0
+
+
+def open_clients(config):
+    """Returns the LDAP client, the Grafana client and the state store used by :func:`sync`.
+    """
 
+    return create_account_manager(config), Grafana(grafana_config=config["grafana"]), open_state(config)
+
+
+def close_clients(clients):
+    """Closes the clients returned by :func:`open_clients`, if any.
+    """
+
+    if clients is not None:
+        manager, grafana, state = clients
+        manager.close()
+        grafana.close()
+        if state is not None:
+            state.close()
+
+
+def stream(config):
+    """Pipes the accounts found in LDAP straight into the invites and prints each result as soon as it is available.
+
+    Only the accounts invited during this run are kept to print their invite URLs at the end. Members of the organization
+    are skipped, pending invites are never revoked as the complete set of accounts isn't known before the end.
+    """
+
+    manager = create_account_manager(config)
     grafana = Grafana(grafana_config=config["grafana"])
+    started = time.time()
+    state = None
+    skipped = [0]
+    invited_accounts = []
+    failed = False
+    # Results are shown as they complete
+    writer = open_writer(config, line_buffered=True)
 
-    for account in accounts:
-        print("Sending invite to %s (%s)" % (account.name, account.mail))
-        _, message = grafana.invite(account=account, send_mail=config["grafana"]["send_invite_mail"])
-        print(" > %s" % (message))
+    try:
+        state = open_state(config)
+        modified_since = delta_start(config, state)
+        with REGISTRY.timer("phase", phase="plan"):
+            accounts = skip_members(changed_accounts(state, manager.iter_accounts(modified_since=modified_since), skipped),
+                                    grafana.org_members(), writer)
+        # Includes the LDAP search, which is consumed while inviting, the ldap_search timer tells it apart
+        with REGISTRY.timer("phase", phase="invite"):
+            for account, (succeeded, message) in invite_accounts(grafana, accounts, send_mail=config["grafana"]["send_invite_mail"],
+                                                                 concurrency=config["grafana"].get("concurrency", 1)):
+                invite_link = grafana.invite_link(account)
+                writer.write(Result(ACTION_INVITE, account.name, account.mail, succeeded, message, invite_link))
+                if succeeded:
+                    invited_accounts.append(account)
+                if invite_status(succeeded, message) == STATUS_FAILED:
+                    failed = True
+                if state is not None:
+                    state.record(account, invite_status(succeeded, message), invite_link)
+
+        with REGISTRY.timer("phase", phase="invite_links"):
+            grafana.populate_accounts_with_invite_links(invited_accounts)
+        with REGISTRY.timer("phase", phase="state"):
+            if state is not None:
+                for account in invited_accounts:
+                    state.record(account, STATUS_INVITED, getattr(account, "grafanaInviteLink", None))
+            delta_finish(config, state, manager, modified_since, started, failed=failed)
+        if skipped[0]:
+            writer.note("Skipped %d accounts unchanged since the last run" % skipped[0])
+        writer.note("Created invite URLs: %s" % write_links(writer, invited_accounts))
+    finally:
+        writer.flush()
+        manager.close()
+        grafana.close()
+        if state is not None:
+            state.close()
+
+    return 0
+
+
+def org_configs(grafana_config):
+    """Returns the "grafana" configuration of each organization to invite into.
+
+    Each entry of ``orgs`` overrides the ``orgId`` and optionally the ``role``, ``token`` and ``search_filter`` of the
+    "grafana" section. Without ``orgs`` the "grafana" section itself is the only organization.
+    """
+
+    if "orgs" not in grafana_config:
+        return [grafana_config]
+    shared_config = {key: value for key, value in grafana_config.items() if key != "orgs"}
+    return [dict(shared_config, **org) for org in grafana_config["orgs"]]
+
+
+def invite_org(grafana_config, accounts, writer, throttle=None):
+    """Invites the accounts into the organization of the given "grafana" configuration and writes the results tagged with the organization.
+
+    Arguments:
+        grafana_config {dict} -- The "grafana" configuration of the organization.
+        accounts {list[grafana_inviter.accounts.AccountManager.Account]} -- Accounts found in LDAP.
+        writer {grafana_inviter.output.ResultWriter} -- Writer of the results, shared with the other organizations of the instance.
+        throttle {grafana_inviter.throttle.Throttle} -- Throttle shared with the other organizations of the instance.
+
+    Returns:
+        [OrgReport] -- Returns the outcome of the invites.
+    """
+
+    org = {"grafana": grafana_config["url"], "org": grafana_config["orgId"]}
+    grafana = Grafana(grafana_config=grafana_config, throttle=throttle)
+    failed, revoked = 0, 0
+
+    try:
+        plan = reconcile(accounts, grafana.org_members(), grafana.pending_invites())
+        for account, message in plan.skip:
+            writer.write(Result(ACTION_SKIP, account.name, account.mail, False, message, **org))
 
-    grafana.populate_accounts_with_invite_links(accounts)
-    print("Available invite URLs: %s" % [account.grafanaInviteLink for account in accounts if hasattr(account, "grafanaInviteLink")])
+        for account, (succeeded, message) in invite_accounts(grafana, plan.add, send_mail=grafana_config["send_invite_mail"],
+                                                             concurrency=grafana_config.get("concurrency", 1)):
+            writer.write(Result(ACTION_INVITE, account.name, account.mail, succeeded, message, **org))
+            failed += 0 if succeeded else 1
 
+        if grafana_config.get("revoke_invites"):
+            for invite in plan.revoke:
+                succeeded, message = grafana.revoke_invite(invite)
+                writer.write(Result(ACTION_REVOKE, invite.get("name"), invite["email"], succeeded, message, **org))
+                revoked += 1 if succeeded else 0
+
+        # Each organization has its own invite URLs, the accounts may be shared with other organizations
+        links = [grafana.invite_link(account) for account in accounts]
+        if None in links:
+            grafana.refresh_invites()
+            links = [grafana.invite_link(account) for account in accounts]
+        for account, link in zip(accounts, links):
+            if link:
+                writer.write(Result(ACTION_LINK, account.name, account.mail, True, None, link, **org))
+    finally:
+        grafana.close()
+
+    return OrgReport(grafana_config["url"], grafana_config["orgId"], len(plan.add) - failed, len(plan.skip), failed, revoked,
+                     [link for link in links if link])
+
+
+def invite_instance(grafana_config, searches, default_filter, output_format=FORMAT_TEXT):
+    """Invites the accounts into all organizations of a Grafana instance concurrently.
+
+    The organizations have their own sessions and connection pools but share the throttle, so the configured rate limit
+    applies to the instance as a whole. They also share a writer, which is created here as the instance may be processed
+    in a worker process of its own.
+
+    Arguments:
+        grafana_config {dict} -- The "grafana" configuration of the instance.
+        searches {dict} -- Accounts found in LDAP keyed by the search filter.
+        default_filter {str} -- Search filter of organizations without their own ``search_filter``.
+        output_format {str} -- One of ``grafana_inviter.output.FORMATS``.
+
+    Returns:
+        [list[OrgReport]] -- Returns the outcome of each organization.
+    """
+
+    orgs = org_configs(grafana_config)
+    throttle = Throttle(grafana_config)
+    writer = create_writer(output_format)
+    try:
+        with ThreadPoolExecutor(max_workers=len(orgs)) as executor:
+            futures = [executor.submit(invite_org, org_config, searches[org_config.get("search_filter", default_filter)], writer,
+                                       throttle) for org_config in orgs]
+            return [future.result() for future in futures]
+    finally:
+        writer.flush()
+
+
+def fan_out(config):
+    """Invites the accounts found in LDAP into all Grafana instances and organizations configured.
+
+    LDAP is searched once per distinct search filter. Several Grafana instances are processed in separate worker processes,
+    so a slow instance doesn't hold up the others, the organizations of an instance are processed concurrently. The state
+    file and incremental LDAP syncs are only supported for a single organization.
+    """
+
+    if "state" in config:
+        LOGGER.warning("The state file isn't used when inviting into several organizations")
+
+    instances = grafana_instances(config)
+    default_filter = config["ldap"]["query"].get("search_filter")
+    manager = create_account_manager(config)
+    searches = {}
+    try:
+        for grafana_config in instances:
+            for org_config in org_configs(grafana_config):
+                search_filter = org_config.get("search_filter", default_filter)
+                if search_filter not in searches:
+                    searches[search_filter] = manager.get_accounts(search_filter=search_filter)
+    finally:
+        manager.close()
+
+    output_format = config.get("output", {}).get("format", FORMAT_TEXT)
+    if len(instances) == 1:
+        reports = invite_instance(instances[0], searches, default_filter, output_format)
+    else:
+        from concurrent.futures import ProcessPoolExecutor  # pylint: disable=import-outside-toplevel
+
+        with ProcessPoolExecutor(max_workers=min(len(instances), os.cpu_count() or 1)) as executor:
+            futures = [executor.submit(invite_instance, grafana_config, instance_searches(grafana_config, searches, default_filter),
+                                       default_filter, output_format) for grafana_config in instances]
+            reports = [report for future in futures for report in future.result()]
+
+    writer = open_writer(config)
+    try:
+        report_orgs(reports, writer)
+    finally:
+        writer.flush()
     return 0
 
 
+def instance_searches(grafana_config, searches, default_filter):
+    """Returns the searches needed by the organizations of an instance, so only their accounts are sent to its worker process.
+    """
+
+    return {search_filter: searches[search_filter]
+            for search_filter in {org_config.get("search_filter", default_filter) for org_config in org_configs(grafana_config)}}
+
+
+def report_orgs(reports, writer):
+    """Writes the merged outcome of all Grafana instances and organizations as notes of the writer.
+    """
+
+    writer.note("%-40s %6s %8s %8s %7s %8s" % ("Grafana", "org", "invited", "skipped", "failed", "revoked"))
+    for report in reports:
+        writer.note("%-40s %6d %8d %8d %7d %8d" % (report.url, report.org_id, report.invited, report.skipped, report.failed,
+                                                   report.revoked))
+    for report in reports:
+        writer.note("Available invite URLs of %s org %d: %s" % (report.url, report.org_id, report.invite_urls))
+
+
+def serve(config, server_address):
+    """Serves invites of single accounts over HTTP until interrupted, see :class:`grafana_inviter.server.InviteServer`.
+    """
+
+    from .server import InviteServer  # pylint: disable=import-outside-toplevel
+
+    manager = create_account_manager(config)
+    grafana = Grafana(grafana_config=config["grafana"])
+    server = InviteServer(server_address, manager, grafana, send_mail=config["grafana"]["send_invite_mail"])
+    print("Serving invites on http://%s:%d/invite" % server.server_address[:2])
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        grafana.close()
+        manager.close()
+
+    return 0
+
+
+def dry_run(config):
+    """Prints the invites which would be created, skipped or revoked together with an estimation of the API calls and duration.
+
+    Only reads from LDAP and Grafana, the state file isn't updated either.
+    """
+
+    manager = create_account_manager(config)
+    grafana = Grafana(grafana_config=config["grafana"])
+    state = open_state(config)
+
+    try:
+        modified_since = delta_start(config, state)
+        started = time.time()
+        grafana.org_members()
+        grafana.pending_invites()
+        latency = (time.time() - started) / 2
+        _, plan, skipped = read_plan(grafana, manager, state, modified_since, config["ldap"].get("users"))
+    finally:
+        manager.close()
+        grafana.close()
+        if state is not None:
+            state.close()
+
+    revoking = config["grafana"].get("revoke_invites", False) and modified_since is None and not config["ldap"].get("users")
+    report_plan(config, plan, skipped, revoking=revoking, latency=latency)
+    return 0
+
+
+def report_plan(config, plan, skipped, revoking, latency):
+    """Prints the planned actions with the number of API calls needed and the estimated duration.
+
+    Arguments:
+        plan {grafana_inviter.reconcile.Plan} -- The planned actions.
+        skipped {int} -- Number of accounts skipped as they are unchanged since the last run.
+        revoking {bool} -- Whether the planned revokes would be done.
+        latency {float} -- Observed duration of a single request to Grafana in seconds.
+    """
+
+    for account in plan.add:
+        print(" + invite %s (%s)" % (account.name, account.mail))
+    for account, message in plan.skip:
+        print(" = skip %s (%s): %s" % (account.name, account.mail, message))
+    for invite in plan.revoke:
+        print(" - revoke %s" % invite["email"])
+
+    writes = len(plan.add) + (len(plan.revoke) if revoking else 0)
+    # Populating the invite links of created invites needs another GET of the pending invites
+    requests = writes + (1 if plan.add else 0)
+    concurrency = config["grafana"].get("concurrency", 1)
+    requests_per_second = config["grafana"].get("rate_limit", {}).get("requests_per_second")
+
+    print("Invites to create: %d" % len(plan.add))
+    print("Accounts to skip: %d (%d unchanged since the last run)" % (len(plan.skip) + skipped, skipped))
+    print("Invites to revoke: %d%s" % (len(plan.revoke), "" if revoking else " (not revoked, requires --revoke-invites and a full LDAP sync)"))
+    print("API calls: 2 reads done, %d writes and %d reads to go" % (writes, requests - writes))
+    print("Estimated duration: %.1fs (%.0fms per request, concurrency %d%s)" %
+          (estimate_duration(requests, latency, concurrency, requests_per_second), latency * 1000, concurrency,
+           ", %s requests per second" % requests_per_second if requests_per_second else ""))
+
+
 def main():
     """Main entrypoint
     """
 
     args = parse_args(sys.argv[1:])
+    logging.basicConfig(level=args.log_level, format="%(levelname)s %(message)s")
     config = configure(args)
     validate(config)
-    assemble(config)
+    try:
+        if isinstance(config["grafana"], list) or "orgs" in config["grafana"]:
+            if args.command != "invite" or args.stream or args.daemon or "users" in config["ldap"]:
+                raise SystemExit("The plan and serve commands, --stream, --daemon and --user support a single Grafana organization only")
+            fan_out(config)
+        elif args.command == "plan":
+            dry_run(config)
+        elif args.command == "serve":
+            serve(config, (args.host, args.port))
+        elif args.daemon:
+            daemon(args, config)
+        elif args.stream and "users" not in config["ldap"]:
+            stream(config)
+        else:
+            assemble(config)
+    finally:
+        export(REGISTRY, config.get("metrics", {}))
 
 
 if __name__ == "__main__":
@@ -3,6 +3,22 @@
 """Module that store the JSON configuration schema.
 """
 
+from functools import lru_cache
+import json
+
+
+@lru_cache(maxsize=1)
+def config_validator():
+    """Returns a validator of the JSON configuration schema, the schema is parsed and checked only once per process.
+    """
+    import jsonschema  # pylint: disable=import-outside-toplevel
+
+    schema = json.loads(json_config_schema())
+    validator_class = jsonschema.validators.validator_for(schema)
+    validator_class.check_schema(schema)
+    return validator_class(schema)
+
+
 def json_config_schema():
     """Returns the JSON configuration schema
     """
@@ -14,7 +30,31 @@ def json_config_schema():
       "type": "object",
       "properties": {
         "url": {
-          "type": "string"
+          "anyOf": [
+            { "type": "string" },
+            {
+              "type": "array",
+              "minItems": 1,
+              "items": { "type": "string" }
+            }
+          ]
+        },
+        "pool": {
+          "type": "object",
+          "properties": {
+            "strategy": {
+              "type": "string",
+              "enum": [ "FIRST", "ROUND_ROBIN" ]
+            },
+            "connect_timeout": {
+              "type": "number",
+              "exclusiveMinimum": 0
+            },
+            "connections": {
+              "type": "integer",
+              "minimum": 1
+            }
+          }
         },
         "user": {
           "type": "string"
@@ -22,6 +62,12 @@ def json_config_schema():
         "password": {
           "type": "string"
         },
+        "users": {
+          "type": "array",
+          "items": {
+            "type": "string"
+          }
+        },
         "query": {
           "type": "object",
           "properties": {
@@ -31,18 +77,138 @@ def json_config_schema():
             "search_filter": {
               "type": "string"
             },
+            "searches": {
+              "type": "array",
+              "minItems": 1,
+              "items": {
+                "type": "object",
+                "properties": {
+                  "group_base_dn": {
+                    "type": "string"
+                  },
+                  "search_filter": {
+                    "type": "string"
+                  }
+                },
+                "required": [ "group_base_dn", "search_filter" ]
+              }
+            },
             "retrieve_attributes": {
               "type": "array",
               "items": {
                 "type": "string"
               }
+            },
+            "page_size": {
+              "type": "integer",
+              "minimum": 1
+            },
+            "lookup_chunk_size": {
+              "type": "integer",
+              "minimum": 1
+            },
+            "nested_groups": {
+              "type": "object",
+              "properties": {
+                "groups": {
+                  "type": "array",
+                  "minItems": 1,
+                  "items": {
+                    "type": "string"
+                  }
+                },
+                "base_dn": {
+                  "type": "string"
+                },
+                "filter": {
+                  "type": "string"
+                },
+                "cache_size": {
+                  "type": "integer",
+                  "minimum": 1
+                },
+                "cache_ttl": {
+                  "type": "number",
+                  "minimum": 0
+                },
+                "cache_path": {
+                  "type": "string"
+                }
+              },
+              "required": [ "groups", "base_dn" ]
+            },
+            "delta": {
+              "type": "object",
+              "properties": {
+                "attribute": {
+                  "type": "string"
+                },
+                "full_resync_interval": {
+                  "type": "number",
+                  "minimum": 0
+                }
+              },
+              "required": [ "attribute" ]
             }
           },
-          "required": [ "group_base_dn", "search_filter", "retrieve_attributes" ]
+          "required": [ "retrieve_attributes" ],
+          "anyOf": [ { "required": [ "group_base_dn", "search_filter" ] }, { "required": [ "searches" ] } ]
         }
       },
       "required": [ "url", "user", "password", "query" ]
     },
+    "grafana": {
+      "anyOf": [
+        { "$ref": "#/definitions/grafana" },
+        {
+          "type": "array",
+          "minItems": 1,
+          "items": { "$ref": "#/definitions/grafana" }
+        }
+      ]
+    },
+    "state": {
+      "type": "object",
+      "properties": {
+        "path": {
+          "type": "string"
+        }
+      },
+      "required": [ "path" ]
+    },
+    "output": {
+      "type": "object",
+      "properties": {
+        "format": {
+          "type": "string",
+          "enum": [ "text", "ndjson", "csv" ]
+        }
+      }
+    },
+    "metrics": {
+      "type": "object",
+      "properties": {
+        "textfile": {
+          "type": "string"
+        },
+        "pushgateway": {
+          "type": "string"
+        },
+        "job": {
+          "type": "string"
+        },
+        "statsd": {
+          "type": "string",
+          "pattern": ":[0-9]+$"
+        },
+        "summary": {
+          "type": "boolean"
+        }
+      }
+    }
+  },
+  "required": [ "ldap", "grafana" ],
+  "definitions": {
     "grafana": {
       "type": "object",
       "properties": {
@@ -55,12 +221,82 @@ def json_config_schema():
         "send_invite_mail": {
           "type": "boolean"
         },
+        "revoke_invites": {
+          "type": "boolean"
+        },
         "orgId": {
           "type": "integer"
+        },
+        "role": {
+          "type": "string",
+          "enum": [ "Viewer", "Editor", "Admin" ]
+        },
+        "orgs": {
+          "type": "array",
+          "minItems": 1,
+          "items": {
+            "type": "object",
+            "properties": {
+              "orgId": {
+                "type": "integer"
+              },
+              "role": {
+                "type": "string",
+                "enum": [ "Viewer", "Editor", "Admin" ]
+              },
+              "token": {
+                "type": "string"
+              },
+              "search_filter": {
+                "type": "string"
+              }
+            },
+            "required": [ "orgId" ]
+          }
+        },
+        "pool_size": {
+          "type": "integer",
+          "minimum": 1
+        },
+        "keep_alive": {
+          "type": "boolean"
+        },
+        "concurrency": {
+          "type": "integer",
+          "minimum": 1
+        },
+        "rate_limit": {
+          "type": "object",
+          "properties": {
+            "requests_per_second": {
+              "type": "number",
+              "exclusiveMinimum": 0
+            },
+            "burst": {
+              "type": "integer",
+              "minimum": 1
+            },
+            "max_retries": {
+              "type": "integer",
+              "minimum": 0
+            },
+            "backoff_base": {
+              "type": "number",
+              "minimum": 0
+            },
+            "backoff_max": {
+              "type": "number",
+              "minimum": 0
+            },
+            "max_retry_after": {
+              "type": "number",
+              "minimum": 0
+            }
+          }
         }
       },
-      "required": [ "url", "token", "orgId" ]
+      "required": [ "url", "token" ],
+      "anyOf": [ { "required": [ "orgId" ] }, { "required": [ "orgs" ] } ]
     }
-  },
-  "required": [ "ldap", "grafana" ]
+  }
 }"""
@@ -3,8 +3,31 @@
 """Module responsible for generating a Grafana invite.
 """
 
+from collections import namedtuple
 from enum import Enum
-import requests
+from http import HTTPStatus
+import logging
+import re
+import threading
+import time
+
+from .metrics import REGISTRY
+from .throttle import Throttle
+
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_ROLE = "Viewer"
+
+ALREADY_INVITED = "User already invited"
+
+LOGGER = logging.getLogger(__name__)
+
+# Invite codes are left out of the endpoint label of the metrics
+INVITE_CODE = re.compile(r"(?<=^org/invites/)[^/]+")
+
+InviteResult = namedtuple("InviteResult", ["succeeded", "message"])
+InviteResult.__doc__ = """Outcome of an invite or revoke request, the message is the one of Grafana or the reason no request was sent.
+"""
 
 
 class HttpMethod(Enum):
@@ -13,27 +36,155 @@ class HttpMethod(Enum):
 
     GET = 1
     POST = 2
+    PATCH = 3
+
+
+def invite_payload(account, send_mail, org_id, role=DEFAULT_ROLE):
+    """Returns the payload of an invite request for the given account.
+
+    Arguments:
+        account {AccountManager.Account} -- Account to be invited.
+        send_mail {bool} -- Whether Grafana should send the invite mail.
+        org_id {int} -- Grafana organization the account is invited to.
+        role {str} -- Role of the account in the organization.
+
+    Returns:
+        [dict] -- Returns the JSON payload of ``POST org/invites``.
+    """
+
+    return {
+        "name": account.name,
+        "loginOrEmail": account.mail,
+        "role": role,
+        "sendEmail": send_mail,
+        "orgId": org_id
+    }
+
+
+def response_message(status_code, body):
+    """Returns the message of a Grafana API response.
+
+    Error responses of a reverse proxy in front of Grafana are not necessarily JSON encoded, in that case the status code and
+    the raw body are returned.
+
+    Arguments:
+        status_code {int} -- HTTP status code of the response.
+        body {object} -- Decoded JSON body of the response or the raw body if it isn't JSON.
+
+    Returns:
+        [str] -- Returns the message of the response.
+    """
+
+    if isinstance(body, dict) and "message" in body:
+        return body["message"]
+    return "HTTP %s: %s" % (status_code, body)
+
+
+def decode_body(response):
+    """Returns the decoded JSON body of a requests.Response or its raw text if it isn't JSON.
+    """
 
+    try:
+        return response.json()
+    except ValueError:
+        return response.text
 
+
+def index_invites(invites):
+    """Indexes the invites returned by ``GET org/invites`` by their lowercased email.
+    """
+
+    return {invite["email"].lower(): invite for invite in invites}
+
+
+def missing_invite_links(invites, accounts):
+    """Returns True if any of the accounts was invited without the invite URL being known yet.
+
+    Grafana doesn't return the invite (and thus its URL) on creation, such invites are recorded in the index without an URL.
+    """
+
+    return any(account.mail.lower() in invites and "url" not in invites[account.mail.lower()] for account in accounts)
+
+
+def assign_invite_links(invites, accounts):
+    """Sets the ``grafanaInviteLink`` attribute of all accounts having a pending invite with a known URL.
+    """
+
+    for account in accounts:
+        invite = invites.get(account.mail.lower())
+        if invite is not None and "url" in invite:
+            account.grafanaInviteLink = invite["url"]
+
+
+# pylint: disable=too-many-instance-attributes
 class Grafana:
     """Simple class wrapping the Grafana HTTP API.
     """
 
-    def __init__(self, grafana_config):
+    def __init__(self, grafana_config, throttle=None):
         """Constructor
 
         Arguments:
-            grafana_server {str} -- Grafana URL.
-            grafana_token {str} -- Admin token for authentication in Grafana.
+            grafana_config {dict} -- The "grafana" section of the configuration.
+            throttle {grafana_inviter.throttle.Throttle} -- Throttle shared with other clients of the same instance, a throttle
+                                                           of its own is created from the configuration by default.
         """
         self.__grafana_config = grafana_config
         self.__grafana_server = grafana_config["url"]
-        self.__grafana_token = grafana_config["token"]
+        self.__session = self.__create_session()
+        self.__throttle = throttle or Throttle(grafana_config)
+        self.__invites = None
+        self.__invites_lock = threading.Lock()
+        self.__members = None
+        self.__members_lock = threading.Lock()
+
+
+    def __create_session(self):
+        """Creates a HTTP session which keeps a pool of connections to Grafana alive between requests.
+
+        Returns:
+            [requests.Session] -- Returns a session carrying the authorization header.
+        """
+
+        # requests is only imported once a client is created, so the command line starts without it
+        import requests  # pylint: disable=import-outside-toplevel
+        from requests.adapters import HTTPAdapter  # pylint: disable=import-outside-toplevel
+
+        pool_size = self.__grafana_config.get("pool_size", max(DEFAULT_POOL_SIZE, self.__grafana_config.get("concurrency", 1)))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update({"Authorization": "Bearer %s" % self.__grafana_config["token"],
+                                "X-Grafana-Org-Id": str(self.__grafana_config["orgId"])})
+        if not self.__grafana_config.get("keep_alive", True):
+            session.headers.update({"Connection": "close"})
+        return session
+
+
+    def close(self):
+        """Closes all pooled connections to Grafana.
+        """
+
+        self.__session.close()
+
+
+    def clear_cache(self):
+        """Forgets the pending invites and members fetched so far, so the next run sees the current state of the organization.
+        """
+
+        with self.__invites_lock:
+            self.__invites = None
+        with self.__members_lock:
+            self.__members = None
 
 
     def __query(self, method, api_endpoint, **kwargs):
         """Create a request query depending on the HTTP method and endpoint.
 
+        Requests are rate limited and retried with a backoff if Grafana signals it is overloaded.
+
         Arguments:
             method {HttpMethod} -- HTTP method.
             endpoint {str} -- Grafana API endpoint (eg. org/users).
@@ -43,11 +194,90 @@ class Grafana:
         """
 
         requests_http_methods = {
-            HttpMethod.GET: requests.get,
-            HttpMethod.POST: requests.post
+            HttpMethod.GET: self.__session.get,
+            HttpMethod.POST: self.__session.post,
+            HttpMethod.PATCH: self.__session.patch
         }
-        headers = {"Authorization": "Bearer %s" % self.__grafana_token}
-        return requests_http_methods[method]("%s/api/%s" % (self.__grafana_server, api_endpoint), headers=headers, **kwargs)
+        labels = {"method": method.name, "endpoint": INVITE_CODE.sub(":code", api_endpoint)}
+        attempt = 0
+        while True:
+            time.sleep(self.__throttle.delay_before_request())
+            with self.__throttle.slot(), REGISTRY.timer("grafana_request", **labels):
+                response = requests_http_methods[method]("%s/api/%s" % (self.__grafana_server, api_endpoint), **kwargs)
+            REGISTRY.increment("grafana_responses", status=response.status_code, **labels)
+            REGISTRY.increment("grafana_request_bytes", len(response.request.body or b""), **labels)
+            REGISTRY.increment("grafana_response_bytes", len(response.content), **labels)
+
+            delay = self.__throttle.retry_delay(attempt, response.status_code, response.headers, idempotent=method == HttpMethod.GET)
+            if delay is None:
+                return response
+            REGISTRY.increment("grafana_retries", **labels)
+            time.sleep(delay)
+            attempt += 1
+
+
+    def refresh_invites(self):
+        """Fetches the pending invites of the organization and indexes them by their lowercased email.
+
+        The index is kept for the lifetime of this object, so subsequent calls to :meth:`invite` and
+        :meth:`populate_accounts_with_invite_links` don't need to query Grafana again.
+
+        Returns:
+            [dict] -- Pending invites keyed by lowercased email.
+        """
+
+        response = self.__query(HttpMethod.GET, "org/invites")
+        response.raise_for_status()
+        self.__invites = index_invites(response.json())
+        return self.__invites
+
+
+    def pending_invites(self):
+        """Returns the index of pending invites keyed by lowercased email, fetching it from Grafana on first use.
+        """
+
+        with self.__invites_lock:
+            if self.__invites is None:
+                self.refresh_invites()
+            return self.__invites
+
+
+    def org_members(self):
+        """Returns the lowercased emails and logins of all members of the organization, fetching them from Grafana on first use.
+
+        Returns:
+            [set[str]] -- Emails and logins of the organization members.
+        """
+
+        with self.__members_lock:
+            members = self.__members
+            if members is None:
+                response = self.__query(HttpMethod.GET, "org/users")
+                response.raise_for_status()
+                members = set()
+                for user in response.json():
+                    members.update(value.lower() for value in (user.get("email"), user.get("login")) if value)
+                self.__members = members
+            return members
+
+
+    def revoke_invite(self, invite):
+        """Revokes a pending invite.
+
+        Arguments:
+            invite {dict} -- Pending invite as returned by :meth:`pending_invites`.
+
+        Returns:
+            [InviteResult] -- True if succeeded otherwise False including a message.
+        """
+
+        response = self.__query(HttpMethod.PATCH, "org/invites/%s/revoke" % invite["code"])
+        succeeded = response.status_code == HTTPStatus.OK
+        if succeeded:
+            invites = self.pending_invites()
+            with self.__invites_lock:
+                invites.pop(invite["email"].lower(), None)
+        return InviteResult(succeeded, response_message(response.status_code, decode_body(response)))
 
 
     def invite(self, account, send_mail=False):
@@ -57,42 +287,46 @@ class Grafana:
             account {AccountManager.Account} -- Account to be used to generate invite for.
 
         Returns:
-            [tuple(bool, str)] -- True if succeeded otherwise False including a message.
+            [InviteResult] -- True if succeeded otherwise False including a message.
         """
 
-        response = self.__query(HttpMethod.GET, "org/invites")
-        invites = response.json()
-
-        if any(invite["email"].lower() == account.mail.lower() for invite in invites):
-            return (False, "User already invited")
+        invites = self.pending_invites()
+        if account.mail.lower() in invites:
+            return InviteResult(False, ALREADY_INVITED)
 
-        payload = {
-            "name": account.name,
-            "loginOrEmail": account.mail,
-            "role": "Viewer",
-            "sendEmail": send_mail,
-            "orgId": self.__grafana_config["orgId"]
-        }
-        print(payload)
+        payload = invite_payload(account, send_mail, self.__grafana_config["orgId"], self.__grafana_config.get("role", DEFAULT_ROLE))
+        LOGGER.debug("Invite payload: %s", payload)
         response = self.__query(HttpMethod.POST, "org/invites", json=payload)
-        return (response.status_code == requests.codes.ok, response.json()['message'])
+        succeeded = response.status_code == HTTPStatus.OK
+        if succeeded:
+            with self.__invites_lock:
+                invites[account.mail.lower()] = {"email": account.mail, "name": account.name}
+        return InviteResult(succeeded, response_message(response.status_code, decode_body(response)))
+
+
+    def invite_link(self, account):
+        """Returns the invite URL of the account if it is already known, without querying Grafana.
+
+        Arguments:
+            account {AccountManager.Account} -- Account to return the invite URL for.
+
+        Returns:
+            [str] -- Returns the invite URL or None if the account has no pending invite with a known URL.
+        """
+
+        return self.pending_invites().get(account.mail.lower(), {}).get("url")
 
 
     def populate_accounts_with_invite_links(self, accounts):
         """Populates the accounts with a Grafana invite link in case an invitation is found.
 
+        The pending invites are only fetched again if invites were created since the index was built.
+
         Arguments:
             accounts {list[grafana_inviter.AccountManager.Account]} -- Accounts we want to obtain the invite link for
         """
 
-        response = self.__query(HttpMethod.GET, "org/invites")
-        invites = response.json()
-        accounts_copy = list(accounts)
-
-        for invite in invites:
-            # To avoid iterations over already found accounts we reverse the list (a copy) and
-            # remove an account from the copied list each time we find a corresponding account in the invites.
-            for account in reversed(accounts_copy):
-                if account.mail == invite["email"]:
-                    account.grafanaInviteLink = invite["url"]
-                    accounts_copy.remove(account)
+        invites = self.pending_invites()
+        if missing_invite_links(invites, accounts):
+            invites = self.refresh_invites()
+        assign_invite_links(invites, accounts)
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+"""Module responsible for recording the durations and counts of a run and exporting them.
+"""
+
+from contextlib import contextmanager
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+
+LOGGER = logging.getLogger(__name__)
+
+PREFIX = "grafana_inviter_"
+DEFAULT_JOB = "grafana_inviter"
+# Seconds to wait for the Pushgateway
+PUSH_TIMEOUT = 10
+
+
+def label_items(labels):
+    """Returns the labels as sorted pairs of name and value, the values converted to strings.
+    """
+
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+class Metrics:
+    """Thread-safe registry of counters and timers, each identified by a name and labels.
+
+    Timers keep the number, the sum and the maximum of the observed durations.
+    """
+
+    def __init__(self):
+        self.__counters = {}
+        self.__timers = {}
+        self.__lock = threading.Lock()
+
+
+    def increment(self, name, value=1, **labels):
+        """Adds the value to the counter.
+
+        Arguments:
+            name {str} -- Name of the counter, without the ``_total`` suffix.
+            value {int} -- Value to add.
+        """
+
+        key = (name, label_items(labels))
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+
+    def observe(self, name, seconds, **labels):
+        """Records a duration of the timer.
+
+        Arguments:
+            name {str} -- Name of the timer, without the ``_seconds`` suffix.
+            seconds {float} -- Observed duration.
+        """
+
+        key = (name, label_items(labels))
+        with self.__lock:
+            count, total, maximum = self.__timers.get(key, (0, 0.0, 0.0))
+            self.__timers[key] = (count + 1, total + seconds, max(maximum, seconds))
+
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Context manager recording the time spent within as a duration of the timer.
+        """
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+
+    def timed(self, name, iterable, **labels):
+        """Yields the items of the iterable, recording the time spent producing them as a duration of the timer.
+
+        Unlike :meth:`timer` the time the consumer spends between the items isn't recorded, so a generator consumed by
+        slow requests is timed on its own.
+        """
+
+        iterator = iter(iterable)
+        busy = 0.0
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    busy += time.perf_counter() - started
+                yield item
+        finally:
+            # Releases the resources of a generator which wasn't consumed completely
+            if hasattr(iterator, "close"):
+                iterator.close()
+            self.observe(name, busy, **labels)
+
+
+    def counters(self):
+        """Returns the counters sorted by name and labels.
+
+        Returns:
+            [list[tuple(str, tuple, int)]] -- Returns the name, the labels and the value of each counter.
+        """
+
+        with self.__lock:
+            return sorted((name, labels, value) for (name, labels), value in self.__counters.items())
+
+
+    def timers(self):
+        """Returns the timers sorted by name and labels.
+
+        Returns:
+            [list[tuple(str, tuple, int, float, float)]] -- Returns the name, the labels, the count, the sum and the maximum of each timer.
+        """
+
+        with self.__lock:
+            return sorted((name, labels) + values for (name, labels), values in self.__timers.items())
+
+
+    def reset(self):
+        """Forgets all recorded values.
+        """
+
+        with self.__lock:
+            self.__counters.clear()
+            self.__timers.clear()
+
+
+# Registry of the process, filled by the LDAP and Grafana clients and the invite runs
+REGISTRY = Metrics()
+
+
+def format_labels(labels):
+    """Returns the labels in the Prometheus exposition format, e.g. ``{method="GET",status="200"}``.
+    """
+
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in labels)
+
+
+def prometheus_text(metrics):
+    """Returns the metrics in the Prometheus text exposition format, timers are exposed as summaries without quantiles.
+    """
+
+    lines = []
+    for name, labels, value in metrics.counters():
+        lines.append("%s%s_total%s %d" % (PREFIX, name, format_labels(labels), value))
+    for name, labels, count, total, _ in metrics.timers():
+        lines.append("%s%s_seconds_count%s %d" % (PREFIX, name, format_labels(labels), count))
+        lines.append("%s%s_seconds_sum%s %f" % (PREFIX, name, format_labels(labels), total))
+    return "".join("%s\n" % line for line in lines)
+
+
+def write_textfile(metrics, path):
+    """Writes the metrics for the textfile collector of the Prometheus node exporter, replacing the file atomically.
+    """
+
+    temporary_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(temporary_path, "w", encoding="utf-8") as textfile:
+        textfile.write(prometheus_text(metrics))
+    os.replace(temporary_path, path)
+
+
+def push(metrics, url, job=DEFAULT_JOB):
+    """Replaces the metrics of the job on a Prometheus Pushgateway.
+    """
+
+    import urllib.request  # pylint: disable=import-outside-toplevel
+
+    request = urllib.request.Request("%s/metrics/job/%s" % (url.rstrip("/"), job), data=prometheus_text(metrics).encode("utf-8"),
+                                     headers={"Content-Type": "text/plain; version=0.0.4"}, method="PUT")
+    with urllib.request.urlopen(request, timeout=PUSH_TIMEOUT):
+        pass
+
+
+def statsd_lines(metrics):
+    """Returns the metrics as StatsD gauges, the labels are appended to the name as they aren't supported by plain StatsD.
+    """
+
+    def statsd_name(name, labels):
+        return ".".join(["grafana_inviter", name] + [re.sub(r"[^\w-]", "_", value) for _, value in labels])
+
+    lines = ["%s:%d|g" % (statsd_name(name + "_total", labels), value) for name, labels, value in metrics.counters()]
+    for name, labels, count, total, _ in metrics.timers():
+        lines.append("%s:%d|g" % (statsd_name(name + "_count", labels), count))
+        lines.append("%s:%f|g" % (statsd_name(name + "_seconds", labels), total))
+    return lines
+
+
+def send_statsd(metrics, address):
+    """Sends the metrics to a StatsD daemon over UDP.
+
+    Arguments:
+        address {str} -- Host and port of the daemon, e.g. ``localhost:8125``.
+    """
+
+    import socket  # pylint: disable=import-outside-toplevel
+
+    host, _, port = address.rpartition(":")
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp:
+        for line in statsd_lines(metrics):
+            udp.sendto(line.encode("utf-8"), (host, int(port)))
+
+
+def summary_table(metrics):
+    """Returns the timers and counters as a table for the end of a run.
+    """
+
+    lines = ["%-60s %8s %10s %10s %10s" % ("Timer", "count", "total s", "avg ms", "max ms")]
+    for name, labels, count, total, maximum in metrics.timers():
+        lines.append("%-60s %8d %10.3f %10.1f %10.1f" % (name + format_labels(labels), count, total, total / count * 1000, maximum * 1000))
+    lines.append("%-60s %8s" % ("Counter", "value"))
+    for name, labels, value in metrics.counters():
+        lines.append("%-60s %8d" % (name + format_labels(labels), value))
+    return "".join("%s\n" % line for line in lines)
+
+
+def export(metrics, metrics_config):
+    """Exports the metrics as configured in the "metrics" section of the configuration.
+
+    Failing exports are logged, they don't fail the run.
+
+    Arguments:
+        metrics {Metrics} -- Metrics to export.
+        metrics_config {dict} -- The "metrics" section of the configuration.
+    """
+
+    exporters = [
+        ("textfile", write_textfile),
+        ("pushgateway", lambda metrics, url: push(metrics, url, metrics_config.get("job", DEFAULT_JOB))),
+        ("statsd", send_statsd)
+    ]
+    for key, exporter in exporters:
+        if key in metrics_config:
+            try:
+                exporter(metrics, metrics_config[key])
+            except (OSError, ValueError) as error:
+                LOGGER.warning("Exporting the metrics to %s %s failed: %s", key, metrics_config[key], error)
+    if metrics_config.get("summary"):
+        sys.stderr.write(summary_table(metrics))
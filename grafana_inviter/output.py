@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+"""Module responsible for writing the results of a run as text, NDJSON or CSV.
+"""
+
+from collections import namedtuple
+import csv
+import io
+import json
+import sys
+import threading
+
+
+FORMAT_TEXT = "text"
+FORMAT_NDJSON = "ndjson"
+FORMAT_CSV = "csv"
+FORMATS = (FORMAT_TEXT, FORMAT_NDJSON, FORMAT_CSV)
+
+ACTION_SKIP = "skip"
+ACTION_INVITE = "invite"
+ACTION_REVOKE = "revoke"
+ACTION_LINK = "link"
+
+# Number of characters collected before they are written to the stream
+FLUSH_SIZE = 65536
+
+Result = namedtuple("Result", ["action", "name", "mail", "succeeded", "message", "url", "grafana", "org"])
+Result.__new__.__defaults__ = (None, None, None)
+Result.__doc__ = """Outcome of one action of a run, ``link`` results carry the invite URL of an account known at the end of the run.
+
+Runs inviting into several organizations set the URL of the Grafana instance and the id of the organization.
+"""
+
+
+class ResultWriter:
+    """Writes results to a stream, collecting up to ``FLUSH_SIZE`` characters before writing them at once unless each
+    result should be shown as soon as it is available.
+
+    Results and notes are written in the order they are received, also when written from several threads. Subclasses
+    implement :meth:`format`.
+    """
+
+    def __init__(self, stream=None, line_buffered=False):
+        """Constructor
+
+        Arguments:
+            stream {file} -- Stream receiving the results, standard output by default.
+            line_buffered {bool} -- Whether each result and note is written to the stream right away.
+        """
+        self.__stream = stream or sys.stdout
+        self.__line_buffered = line_buffered
+        self.__buffer = []
+        self.__size = 0
+        self.__lock = threading.Lock()
+
+
+    def format(self, result):
+        """Returns the given result formatted as text ending with a newline or an empty string to leave it out.
+        """
+
+        raise NotImplementedError()
+
+
+    def write(self, result):
+        """Writes the given result.
+
+        Arguments:
+            result {Result} -- Result to write.
+        """
+
+        self._append(self.format(result))
+
+
+    def note(self, message):
+        """Writes a message for the user, machine readable formats send it to standard error.
+        """
+
+        sys.stderr.write("%s\n" % message)
+
+
+    def _append(self, text):
+        with self.__lock:
+            self.__buffer.append(text)
+            self.__size += len(text)
+            if self.__line_buffered or self.__size >= FLUSH_SIZE:
+                self.__flush()
+
+
+    def flush(self):
+        """Writes the collected results to the stream.
+        """
+
+        with self.__lock:
+            self.__flush()
+
+
+    def __flush(self):
+        self.__stream.write("".join(self.__buffer))
+        self.__stream.flush()
+        self.__buffer = []
+        self.__size = 0
+
+
+class TextWriter(ResultWriter):
+    """Writes results and notes as human readable lines, invite URLs are only part of the notes.
+
+    Results of an organization are prefixed by the Grafana instance and the organization id.
+    """
+
+    def format(self, result):
+        prefix = "" if result.org is None else "[%s org %d] " % (result.grafana, result.org)
+        if result.action == ACTION_SKIP:
+            return "%sSkipping %s (%s)\n > %s\n" % (prefix, result.name, result.mail, result.message)
+        if result.action == ACTION_INVITE:
+            return "%sSending invite to %s (%s)\n > %s\n%s" % (prefix, result.name, result.mail, result.message,
+                                                               " > %s\n" % result.url if result.url else "")
+        if result.action == ACTION_REVOKE:
+            return "%sRevoking invite of %s\n > %s\n" % (prefix, result.mail, result.message)
+        return ""
+
+
+    def note(self, message):
+        self._append("%s\n" % message)
+
+
+class NdjsonWriter(ResultWriter):
+    """Writes each result as a JSON object on a line of its own.
+    """
+
+    def format(self, result):
+        return "%s\n" % json.dumps(result._asdict())
+
+
+class CsvWriter(ResultWriter):
+    """Writes the results as CSV with a header row.
+    """
+
+    def __init__(self, stream=None, line_buffered=False):
+        super().__init__(stream, line_buffered)
+        self._append("%s\n" % ",".join(Result._fields))
+
+
+    def format(self, result):
+        line = io.StringIO()
+        csv.writer(line, lineterminator="\n").writerow(result)
+        return line.getvalue()
+
+
+def create_writer(output_format=FORMAT_TEXT, stream=None, line_buffered=False):
+    """Returns the writer of the given output format.
+
+    Arguments:
+        output_format {str} -- One of ``FORMATS``.
+        stream {file} -- Stream receiving the results, standard output by default.
+        line_buffered {bool} -- Whether each result is written to the stream right away.
+    """
+
+    return {FORMAT_TEXT: TextWriter, FORMAT_NDJSON: NdjsonWriter, FORMAT_CSV: CsvWriter}[output_format](stream, line_buffered)
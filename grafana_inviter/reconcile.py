@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+"""Module responsible for comparing the accounts found in LDAP with the state of the Grafana organization.
+"""
+
+from collections import namedtuple
+
+from .grafana import ALREADY_INVITED
+
+
+ALREADY_MEMBER = "User already member of organization"
+
+Plan = namedtuple("Plan", ["add", "skip", "revoke"])
+Plan.__doc__ = """Actions needed to bring the Grafana organization in line with LDAP.
+
+    add -- Accounts to be invited.
+    skip -- Tuples of an account and the reason why it doesn't need an invite.
+    revoke -- Pending invites of emails not found in LDAP.
+"""
+
+
+def skip_reason(account, members, invites):
+    """Returns why the account doesn't need an invite or None if it does.
+
+    Arguments:
+        account {AccountManager.Account} -- Account found in LDAP.
+        members {set[str]} -- Lowercased emails and logins of the organization members.
+        invites {dict} -- Pending invites keyed by lowercased email.
+    """
+
+    mail = account.mail.lower()
+    if mail in members:
+        return ALREADY_MEMBER
+    if mail in invites:
+        return ALREADY_INVITED
+    return None
+
+
+def reconcile(accounts, members, invites, directory_mails=None):
+    """Computes which accounts to invite or skip and which pending invites to revoke in a single pass.
+
+    Arguments:
+        accounts {iterable[AccountManager.Account]} -- Accounts found in LDAP, duplicate mails are only planned once.
+        members {set[str]} -- Lowercased emails and logins of the organization members.
+        invites {dict} -- Pending invites keyed by lowercased email.
+        directory_mails {set[str]} -- Lowercased mails of all accounts in LDAP in case ``accounts`` is only a subset of them.
+
+    Returns:
+        [Plan] -- Returns the actions needed.
+    """
+
+    add, skip, seen = [], [], set()
+    for account in accounts:
+        mail = account.mail.lower()
+        if mail in seen:
+            continue
+        seen.add(mail)
+
+        reason = skip_reason(account, members, invites)
+        if reason is None:
+            add.append(account)
+        else:
+            skip.append((account, reason))
+
+    known_mails = seen if directory_mails is None else directory_mails | seen
+    revoke = [invite for email, invite in invites.items() if email not in known_mails]
+    return Plan(add, skip, revoke)
+
+
+def estimate_duration(requests, latency, concurrency, requests_per_second=None):
+    """Estimates how long sending the requests takes.
+
+    Arguments:
+        requests {int} -- Number of requests to send.
+        latency {float} -- Observed duration of a single request in seconds.
+        concurrency {int} -- Number of requests in flight.
+        requests_per_second {float} -- Configured rate limit, if any.
+
+    Returns:
+        [float] -- Returns the estimated duration in seconds.
+    """
+
+    duration = requests * latency / max(1, concurrency)
+    if requests_per_second:
+        duration = max(duration, requests / requests_per_second)
+    return duration
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+"""Module responsible for inviting single accounts on demand over HTTP.
+"""
+
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import socketserver
+import threading
+import time
+
+from .grafana import ALREADY_INVITED
+from .reconcile import ALREADY_MEMBER
+
+
+# Attributes an account can be looked up by
+LOOKUP_ATTRIBUTES = ("uid", "mail")
+# Seconds the pending invites and members of the organization are reused for before they are fetched again
+CACHE_TTL = 60
+
+
+# pylint: disable=too-few-public-methods
+class Coalescer:
+    """Runs concurrent calls with the same key only once, all callers receive the outcome of the call in flight.
+    """
+
+    def __init__(self):
+        self.__in_flight = {}
+        self.__lock = threading.Lock()
+
+
+    def run(self, key, function, *args):
+        """Calls the function unless a call with the same key is already in flight and returns its result.
+
+        Arguments:
+            key {hashable} -- Identifies calls which can share their outcome.
+            function {callable} -- Function to call.
+
+        Returns:
+            [object] -- Returns the result of the function or raises its exception.
+        """
+
+        with self.__lock:
+            future = self.__in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.__in_flight[key] = Future()
+
+        if leader:
+            try:
+                future.set_result(function(*args))
+            except Exception as error:  # pylint: disable=broad-except
+                future.set_exception(error)
+            finally:
+                with self.__lock:
+                    del self.__in_flight[key]
+        return future.result()
+
+
+class InviteServer(socketserver.ThreadingMixIn, HTTPServer):
+    """HTTP server inviting the account given by ``POST /invite`` with a JSON body like ``{"uid": "jdoe"}`` or ``{"mail": "j.doe@acme.org"}``.
+
+    The LDAP connections and the pooled Grafana session are kept open for all requests, up to ``ldap.pool.connections``
+    lookups run in parallel. Concurrent requests for the same account are coalesced into a single LDAP lookup and invite.
+    The pending invites and members of the organization are fetched again once they are older than ``CACHE_TTL`` seconds.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, server_address, manager, grafana, send_mail=False):
+        """Constructor
+
+        Arguments:
+            server_address {tuple(str, int)} -- Host and port to listen on.
+            manager {grafana_inviter.accounts.AccountManager} -- Bound LDAP client.
+            grafana {grafana_inviter.grafana.Grafana} -- Grafana client of the organization.
+            send_mail {bool} -- Whether Grafana should send the invite mail.
+        """
+        super().__init__(server_address, InviteRequestHandler)
+        self.__manager = manager
+        self.__grafana = grafana
+        self.__send_mail = send_mail
+        self.__coalescer = Coalescer()
+        self.__cache_expiry = 0.0
+        self.__cache_lock = threading.Lock()
+
+
+    def invite(self, attribute, value):
+        """Looks up the account in LDAP and invites it.
+
+        Arguments:
+            attribute {str} -- One of ``LOOKUP_ATTRIBUTES``.
+            value {str} -- Value of the attribute.
+
+        Returns:
+            [dict] -- Returns the name, mail, invite result and invite URL of the account or None if it wasn't found.
+        """
+
+        return self.__coalescer.run((attribute, value.lower()), self.__invite, attribute, value)
+
+
+    def __expire_cache(self):
+        """Forgets the pending invites and members cached by the Grafana client once they are older than ``CACHE_TTL``.
+        """
+
+        with self.__cache_lock:
+            now = time.monotonic()
+            if now >= self.__cache_expiry:
+                self.__grafana.clear_cache()
+                self.__cache_expiry = now + CACHE_TTL
+
+
+    def __invite(self, attribute, value):
+        account = self.__manager.find_account(attribute, value)
+        if account is None:
+            return None
+
+        self.__expire_cache()
+        if account.mail.lower() in self.__grafana.org_members():
+            return {"name": account.name, "mail": account.mail, "invited": False, "message": ALREADY_MEMBER, "url": None}
+        succeeded, message = self.__grafana.invite(account=account, send_mail=self.__send_mail)
+        invite_url = self.__grafana.invite_link(account)
+        if invite_url is None and (succeeded or message == ALREADY_INVITED):
+            # Grafana doesn't return the URL of a created invite
+            self.__grafana.refresh_invites()
+            invite_url = self.__grafana.invite_link(account)
+        return {"name": account.name, "mail": account.mail, "invited": succeeded, "message": message, "url": invite_url}
+
+
+class InviteRequestHandler(BaseHTTPRequestHandler):
+    """Handles the requests of the :class:`InviteServer`.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    # pylint: disable=invalid-name
+    def do_POST(self):
+        """Invites the requested account, answering 200 with the invite URL, 404 if the account isn't found or 502 if LDAP
+        or Grafana failed.
+        """
+
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path != "/invite":
+            self.__respond(404, {"message": "Not found"})
+            return
+        try:
+            request = json.loads(body.decode("utf-8"))
+            attribute = next(attribute for attribute in LOOKUP_ATTRIBUTES if isinstance(request.get(attribute), str))
+        except (AttributeError, StopIteration, ValueError):
+            self.__respond(400, {"message": "Expected a JSON object with a %s" % " or ".join(LOOKUP_ATTRIBUTES)})
+            return
+
+        try:
+            result = self.server.invite(attribute, request[attribute])
+        except Exception as error:  # pylint: disable=broad-except
+            self.__respond(502, {"message": str(error)})
+            return
+        if result is None:
+            self.__respond(404, {"message": "No account found with %s %s" % (attribute, request[attribute])})
+        else:
+            self.__respond(200, result)
+
+
+    def __respond(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
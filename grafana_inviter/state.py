@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+"""Module responsible for remembering the accounts processed by previous runs.
+"""
+
+from collections import namedtuple
+import sqlite3
+import time
+
+
+AccountState = namedtuple("AccountState", ["mail", "status", "invite_url", "fingerprint", "updated_at"])
+
+STATUS_INVITED = "invited"
+STATUS_ALREADY_INVITED = "already invited"
+STATUS_MEMBER = "member"
+STATUS_FAILED = "failed"
+
+# Accounts with one of these statuses don't need to be processed again as long as their LDAP attributes didn't change.
+FINAL_STATUSES = frozenset([STATUS_INVITED, STATUS_ALREADY_INVITED, STATUS_MEMBER])
+
+COMMIT_INTERVAL = 500
+
+
+class StateStore:
+    """SQLite backed store of the last invite status of each account, keyed by the lowercased mail.
+    """
+
+    def __init__(self, path):
+        """Constructor
+
+        Arguments:
+            path {str} -- Location of the SQLite database, created if it doesn't exist.
+        """
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        self.__connection.execute("CREATE TABLE IF NOT EXISTS accounts ("
+                                  "mail TEXT PRIMARY KEY, status TEXT NOT NULL, invite_url TEXT, "
+                                  "fingerprint TEXT NOT NULL, updated_at REAL NOT NULL)")
+        self.__connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.__connection.commit()
+        self.__uncommitted = 0
+
+
+    def commit(self):
+        """Commits all pending changes, e.g. at the end of a run of a long-running process.
+        """
+
+        self.__connection.commit()
+        self.__uncommitted = 0
+
+
+    def close(self):
+        """Commits all pending changes and closes the database.
+        """
+
+        self.commit()
+        self.__connection.close()
+
+
+    def lookup(self, account):
+        """Returns the stored state of the account.
+
+        Returns:
+            [AccountState] -- Returns the state or None if the account wasn't processed before.
+        """
+
+        row = self.__connection.execute("SELECT mail, status, invite_url, fingerprint, updated_at FROM accounts WHERE mail = ?",
+                                        (account.mail.lower(),)).fetchone()
+        return AccountState(*row) if row else None
+
+
+    def is_unchanged(self, account):
+        """Returns True if the account was successfully processed before and its LDAP attributes didn't change since.
+        """
+
+        state = self.lookup(account)
+        return state is not None and state.status in FINAL_STATUSES and state.fingerprint == account.fingerprint()
+
+
+    def record(self, account, status, invite_url=None):
+        """Stores the outcome of processing the account.
+
+        Arguments:
+            account {AccountManager.Account} -- The processed account.
+            status {str} -- One of the ``STATUS_*`` constants.
+            invite_url {str} -- Invite URL of the account if known, a previously stored URL is kept otherwise.
+        """
+
+        self.__connection.execute("INSERT OR REPLACE INTO accounts (mail, status, invite_url, fingerprint, updated_at) "
+                                  "VALUES (?, ?, COALESCE(?, (SELECT invite_url FROM accounts WHERE mail = ?)), ?, ?)",
+                                  (account.mail.lower(), status, invite_url, account.mail.lower(), account.fingerprint(), time.time()))
+        self.__uncommitted += 1
+        if self.__uncommitted >= COMMIT_INTERVAL:
+            self.__connection.commit()
+            self.__uncommitted = 0
+
+
+    def get_meta(self, key):
+        """Returns the stored value of a run wide setting such as a synchronization high-water mark, or None.
+        """
+
+        row = self.__connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+
+    def set_meta(self, key, value):
+        """Stores the value of a run wide setting.
+        """
+
+        self.__connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
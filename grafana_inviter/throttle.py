@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""Module responsible for pacing the requests sent to Grafana.
+"""
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import random
+import threading
+import time
+
+
+# Status codes returned by Grafana or a reverse proxy in front of it when it is overloaded.
+RETRY_STATUS_CODES = frozenset([429, 502, 503, 504])
+# Status codes meaning the request wasn't processed, so requests which aren't idempotent can be retried as well. After a
+# 502 or 504 an invite may have been created although the proxy gave up on it.
+UNPROCESSED_STATUS_CODES = frozenset([429, 503])
+
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_BASE = 0.5
+DEFAULT_BACKOFF_MAX = 30.0
+DEFAULT_MAX_RETRY_AFTER = 120.0
+
+
+# pylint: disable=too-few-public-methods
+class TokenBucket:
+    """Token bucket allowing ``rate`` requests per second with bursts of up to ``burst`` requests.
+    """
+
+    def __init__(self, rate, burst=1, clock=time.monotonic):
+        self.__rate = float(rate)
+        self.__burst = float(burst)
+        self.__clock = clock
+        self.__tokens = float(burst)
+        self.__updated = clock()
+        self.__lock = threading.Lock()
+
+
+    def reserve(self):
+        """Takes a token from the bucket.
+
+        Returns:
+            [float] -- Returns the number of seconds the caller has to wait before the token may be used.
+        """
+
+        with self.__lock:
+            now = self.__clock()
+            self.__tokens = min(self.__burst, self.__tokens + (now - self.__updated) * self.__rate)
+            self.__updated = now
+            self.__tokens -= 1
+            return max(0.0, -self.__tokens / self.__rate)
+
+
+class AdaptiveConcurrency:
+    """Limits the number of requests in flight and adapts the limit to the observed throttling.
+
+    The limit is halved each time a request gets throttled and grows by one per ``limit`` successful requests (AIMD),
+    never exceeding the configured maximum.
+    """
+
+    def __init__(self, maximum):
+        self.__maximum = maximum
+        self.__limit = float(maximum)
+        self.__in_flight = 0
+        self.__condition = threading.Condition()
+
+
+    @property
+    def limit(self):
+        """Returns the current number of requests allowed in flight.
+        """
+
+        return max(1, int(self.__limit))
+
+
+    def acquire(self):
+        """Blocks until a request may be sent.
+        """
+
+        with self.__condition:
+            while self.__in_flight >= self.limit:
+                self.__condition.wait()
+            self.__in_flight += 1
+
+
+    def release(self):
+        """Signals that a request has completed.
+        """
+
+        with self.__condition:
+            self.__in_flight -= 1
+            self.__condition.notify_all()
+
+
+    def record(self, throttled):
+        """Adapts the limit to the outcome of a request.
+        """
+
+        with self.__condition:
+            if throttled:
+                self.__limit = max(1.0, self.__limit / 2)
+            else:
+                self.__limit = min(float(self.__maximum), self.__limit + 1 / self.__limit)
+            self.__condition.notify_all()
+
+
+def retry_after(headers):
+    """Returns the number of seconds requested by a ``Retry-After`` header or None if not present or invalid.
+    """
+
+    value = headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    # HTTP dates are rare, so the email package is only imported for them
+    from email.utils import parsedate_to_datetime  # pylint: disable=import-outside-toplevel
+
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class Throttle:
+    """Rate limits, bounds and retries the requests sent to Grafana as configured in the ``grafana`` section.
+    """
+
+    def __init__(self, grafana_config):
+        """Constructor
+
+        Arguments:
+            grafana_config {dict} -- The "grafana" section of the configuration.
+        """
+        rate_limit = grafana_config.get("rate_limit", {})
+        rate = rate_limit.get("requests_per_second")
+        self.__bucket = TokenBucket(rate, rate_limit.get("burst", 1)) if rate else None
+        self.__concurrency = AdaptiveConcurrency(grafana_config.get("concurrency", 1))
+        self.__max_retries = rate_limit.get("max_retries", DEFAULT_MAX_RETRIES)
+        self.__backoff_base = rate_limit.get("backoff_base", DEFAULT_BACKOFF_BASE)
+        self.__backoff_max = rate_limit.get("backoff_max", DEFAULT_BACKOFF_MAX)
+        self.__max_retry_after = rate_limit.get("max_retry_after", DEFAULT_MAX_RETRY_AFTER)
+
+
+    @property
+    def concurrency(self):
+        """Returns the current number of requests allowed in flight.
+        """
+
+        return self.__concurrency.limit
+
+
+    def delay_before_request(self):
+        """Returns the number of seconds to wait before the next request may be sent.
+        """
+
+        return self.__bucket.reserve() if self.__bucket else 0.0
+
+
+    @contextmanager
+    def slot(self):
+        """Context manager holding one of the adaptively limited request slots.
+        """
+
+        self.__concurrency.acquire()
+        try:
+            yield
+        finally:
+            self.__concurrency.release()
+
+
+    def retry_delay(self, attempt, status_code, headers, idempotent=True):
+        """Records the outcome of a request and decides whether it should be retried.
+
+        The delay honours the ``Retry-After`` header up to ``max_retry_after`` seconds and otherwise uses an exponential
+        backoff with full jitter. Requests which aren't idempotent are only retried if they weren't processed.
+
+        Arguments:
+            attempt {int} -- Number of retries done so far.
+            status_code {int} -- HTTP status code of the response.
+            headers {dict} -- HTTP headers of the response.
+            idempotent {bool} -- Whether the request can be repeated without changing the outcome, e.g. a GET.
+
+        Returns:
+            [float] -- Returns the number of seconds to wait before retrying or None if the request shouldn't be retried.
+        """
+
+        throttled = status_code in RETRY_STATUS_CODES
+        self.__concurrency.record(throttled)
+        if not throttled or attempt >= self.__max_retries:
+            return None
+        if not idempotent and status_code not in UNPROCESSED_STATUS_CODES:
+            return None
+
+        delay = retry_after(headers)
+        if delay is None:
+            delay = random.uniform(0, min(self.__backoff_max, self.__backoff_base * 2 ** attempt))
+        return min(delay, self.__max_retry_after)
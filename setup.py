@@ -21,9 +21,11 @@ with open("CHANGELOG.md") as changelog_file:
 
 requirements = ["ldap3>=2.6,<3", "requests>=2.21.0,<3", "anyconfig>=0.9.8,<1", "jsonschema>=3.0.1,<4"]
 
+extra_requirements = {"async": ["aiohttp>=3.5,<4"]}
+
 setup_requirements = ["pytest-runner",]
 
-test_requirements = ["pytest", "pytest-cov", "coverage",]
+test_requirements = ["pytest", "pytest-cov", "coverage", "aiohttp>=3.5,<4",]
 
 setup(
     author=grafana_inviter.__author__,
@@ -45,6 +47,7 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require=extra_requirements,
     license="Apache Software License 2.0",
     long_description=readme + "\n\n" + changelog,
     long_description_content_type="text/markdown",
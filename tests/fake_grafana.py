@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+"""
+Minimal in-process fake of the Grafana organization API used by the tests.
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+
+
+class FakeGrafana(socketserver.ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server implementing the invite and member endpoints of a single Grafana organization.
+
+    Arguments:
+        latency {float} -- Seconds each request takes.
+        error_rate {float} -- Share of requests answered with 503 Service Unavailable.
+        members {list[dict]} -- Users already member of the organization.
+        invites {list[dict]} -- Invites pending before the first request.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, error_rate=0.0, members=None, invites=None):
+        super().__init__(("127.0.0.1", 0), FakeGrafanaHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.members = members or []
+        self.invites = list(invites or [])
+        self.requests = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server_address[:2]
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeGrafanaHandler(BaseHTTPRequestHandler):
+    """Handles the requests of the fake Grafana.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, without this each response of a kept-alive connection waits for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def handle_request(self):
+        grafana = self.server
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with grafana.lock:
+            grafana.requests.append((self.command, self.path))
+        time.sleep(grafana.latency)
+        if grafana.error_rate and random.random() < grafana.error_rate:
+            return self.respond(503, {"message": "Service Unavailable"})
+
+        with grafana.lock:
+            if self.command == "GET" and self.path == "/api/org/users":
+                return self.respond(200, grafana.members)
+            if self.command == "GET" and self.path == "/api/org/invites":
+                return self.respond(200, grafana.invites)
+            if self.command == "POST" and self.path == "/api/org/invites":
+                payload = json.loads(body.decode("utf-8"))
+                code = "code%d" % len(grafana.invites)
+                grafana.invites.append({"email": payload["loginOrEmail"], "name": payload["name"], "role": payload["role"],
+                                        "orgId": payload["orgId"], "code": code, "url": "%s/invite/%s" % (grafana.url, code)})
+                return self.respond(200, {"message": "Created invite for %s" % payload["loginOrEmail"]})
+            match = re.match(r"^/api/org/invites/(\w+)/revoke$", self.path)
+            if self.command == "PATCH" and match:
+                grafana.invites = [invite for invite in grafana.invites if invite["code"] != match.group(1)]
+                return self.respond(200, {"message": "Invite revoked"})
+        return self.respond(404, {"message": "Not found"})
+
+    do_GET = do_POST = do_PATCH = handle_request
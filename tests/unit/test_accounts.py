@@ -4,11 +4,15 @@
 Tests for the grafana_inviter.accounts module.
 """
 
+from concurrent.futures import ThreadPoolExecutor
 import json
+import os
+import re
+import ldap3
 import pytest
 
 from unittest.mock import ANY, call, patch, MagicMock
-from grafana_inviter.accounts import AccountManager
+from grafana_inviter.accounts import AccountManager, ConnectionPool, GroupCache, newer_value
 
 
 def test_config_json():
@@ -112,3 +116,341 @@ def test_should_return_expected_accounts(mock_ldap_connection, mock_ldap_server)
         assert any(json.loads(str(account)) for account in accounts)
     except json.decoder.JSONDecodeError:
         pytest.fail("Expected a JSON encoded format.")
+
+
+@patch("ldap3.Server")
+@patch("ldap3.Connection")
+def test_should_stream_accounts_with_a_paged_search(mock_ldap_connection, mock_ldap_server):
+    """Tests that accounts are yielded page by page if a page size is configured.
+    """
+    # Given
+    mock_ldap_connection_instance = mock_ldap_connection.return_value
+    search_results = iter(LDAP_ACCOUNT_SEARCH_RESULT + [{"type": "searchResRef", "uri": ["ldaps://other"]}])
+    mock_ldap_connection_instance.extend.standard.paged_search.return_value = search_results
+
+    query_config = dict(test_config_json()["ldap"]["query"], page_size=500)
+    manager = AccountManager(ldap_query_config=query_config,
+                             ldap_user="user", ldap_password="password", ldap_url="ldps://testserver")
+
+    # When
+    accounts = manager.iter_accounts()
+    first_account = next(accounts)
+
+    # Then
+    assert first_account.name == "John Doe"
+    assert [account.name for account in accounts] == ["Jane Doe"]
+    mock_ldap_connection_instance.extend.standard.paged_search.assert_called_once_with(
+        search_base="OU=AC,OU=Employees,O=acme,C=global",
+        search_filter="(&(o=SubUnit)(memberOf=CN=AnotherGroup,CN=GroupB,CN=Roles,O=acme,C=global))",
+        search_scope=ANY,
+        attributes=["uid", "mail", "name", "msDS-UserAccountDisabled", "memberOf"],
+        paged_size=500, generator=True)
+    mock_ldap_connection_instance.search.assert_not_called()
+
+
+@patch("ldap3.Server")
+@patch("ldap3.Connection")
+def test_should_find_a_single_account_within_the_search_filter(mock_ldap_connection, mock_ldap_server):
+    """Tests that a single account is looked up by an escaped attribute value combined with the configured filter.
+    """
+    # Given
+    mock_ldap_connection_instance = mock_ldap_connection.return_value
+    manager = AccountManager(ldap_query_config=test_config_json()["ldap"]["query"],
+                             ldap_user="user", ldap_password="password", ldap_url="ldps://testserver")
+
+    # When
+    mock_ldap_connection_instance.response = LDAP_ACCOUNT_SEARCH_RESULT[:1]
+    account = manager.find_account("uid", "jodoe*")
+    mock_ldap_connection_instance.response = []
+    missing_account = manager.find_account("mail", "nobody@acme.com")
+
+    # Then
+    assert account.name == "John Doe"
+    assert missing_account is None
+    assert mock_ldap_connection_instance.search.call_args_list[0][1]["search_filter"] == \
+        "(&(&(o=SubUnit)(memberOf=CN=AnotherGroup,CN=GroupB,CN=Roles,O=acme,C=global))(|(uid=jodoe\\2a)))"
+
+
+@patch("ldap3.Server")
+@patch("ldap3.Connection")
+def test_should_look_up_accounts_by_uid_and_mail_in_chunks(mock_ldap_connection, mock_ldap_server):
+    """Tests that targeted lookups combine the values into chunked OR filters and return each account once.
+    """
+    # Given
+    mock_ldap_connection_instance = mock_ldap_connection.return_value
+    mock_ldap_connection_instance.response = LDAP_ACCOUNT_SEARCH_RESULT
+    query_config = dict(test_config_json()["ldap"]["query"], lookup_chunk_size=2)
+    manager = AccountManager(ldap_query_config=query_config,
+                             ldap_user="user", ldap_password="password", ldap_url="ldps://testserver")
+
+    # When
+    accounts = manager.get_accounts_by(uids=["jodoe", "jadoe"], mails=["John.Doe@acme.com"])
+
+    # Then
+    assert [account.name for account in accounts] == ["John Doe", "Jane Doe"]
+    assert [search[1]["search_filter"] for search in mock_ldap_connection_instance.search.call_args_list] == [
+        "(&(&(o=SubUnit)(memberOf=CN=AnotherGroup,CN=GroupB,CN=Roles,O=acme,C=global))(|(uid=jodoe)(uid=jadoe)))",
+        "(&(&(o=SubUnit)(memberOf=CN=AnotherGroup,CN=GroupB,CN=Roles,O=acme,C=global))(|(mail=John.Doe@acme.com)))"]
+
+
+@patch("ldap3.ServerPool")
+@patch("ldap3.Server")
+@patch("ldap3.Connection")
+def test_should_fail_over_between_several_servers(mock_ldap_connection, mock_ldap_server, mock_ldap_server_pool):
+    """Tests that several URLs are used as an actively checked server pool with the configured strategy.
+    """
+    # When
+    AccountManager(ldap_query_config=test_config_json()["ldap"]["query"], ldap_user="user", ldap_password="password",
+                   ldap_url=["ldaps://dc1", "ldaps://dc2"], pool_config={"strategy": "ROUND_ROBIN", "connect_timeout": 0.5})
+
+    # Then
+    assert mock_ldap_server.call_args_list == [call("ldaps://dc1", connect_timeout=0.5), call("ldaps://dc2", connect_timeout=0.5)]
+    mock_ldap_server_pool.assert_called_once_with([mock_ldap_server.return_value] * 2, pool_strategy=ldap3.ROUND_ROBIN, active=1, exhaust=60)
+    mock_ldap_connection.assert_called_once_with(server=mock_ldap_server_pool.return_value, user="user", password="password")
+
+
+def test_connection_pool_should_bind_on_demand_and_discard_broken_connections():
+    """Tests that connections are reused, bound on demand up to the pool size and discarded after an error.
+    """
+    # Given
+    connect = MagicMock(side_effect=lambda: MagicMock())
+    pool = ConnectionPool(connect, size=2)
+
+    # When
+    with pool.connection() as first:
+        with pool.connection() as second:
+            pass
+    with pool.connection() as reused:
+        pass
+    with pytest.raises(RuntimeError):
+        with pool.connection() as broken:
+            raise RuntimeError("Connection reset")
+    pool.close()
+
+    # Then
+    assert connect.call_count == 2
+    assert first is not second
+    assert reused is first and broken is first
+    # Discarded after the error, the idle connection is unbound on close
+    first.unbind.assert_called_once_with()
+    second.unbind.assert_called_once_with()
+
+
+class FakeConnection:
+    """LDAP connection answering each base DN with the given entries.
+    """
+
+    def __init__(self, entries_by_base):
+        self.entries_by_base = entries_by_base
+        self.response = None
+
+    def bind(self):
+        pass
+
+    def unbind(self):
+        pass
+
+    def search(self, search_base, **_):
+        if isinstance(self.entries_by_base[search_base], Exception):
+            raise self.entries_by_base[search_base]
+        self.response = self.entries_by_base[search_base]
+
+
+@patch("ldap3.Server")
+@patch("ldap3.Connection")
+def test_should_merge_concurrent_searches_by_mail(mock_ldap_connection, mock_ldap_server):
+    """Tests that several searches run over connections of their own and their accounts are merged, each mail only once.
+    """
+    # Given
+    entries_by_base = {"OU=AC,O=acme": LDAP_ACCOUNT_SEARCH_RESULT, "OU=EU,O=acme": LDAP_ACCOUNT_SEARCH_RESULT[:1]}
+    mock_ldap_connection.side_effect = lambda **_: FakeConnection(entries_by_base)
+    query_config = dict(test_config_json()["ldap"]["query"],
+                        searches=[{"group_base_dn": "OU=AC,O=acme", "search_filter": "(o=AC)"},
+                                  {"group_base_dn": "OU=EU,O=acme", "search_filter": "(o=EU)"}])
+    manager = AccountManager(ldap_query_config=query_config,
+                             ldap_user="user", ldap_password="password", ldap_url="ldps://testserver")
+
+    # When
+    accounts = manager.get_accounts()
+    entries_by_base["OU=EU,O=acme"] = RuntimeError("Size limit exceeded")
+
+    # Then
+    assert sorted(account.name for account in accounts) == ["Jane Doe", "John Doe"]
+    with pytest.raises(RuntimeError):
+        manager.get_accounts()
+
+
+class FakeGroupDirectory:
+    """LDAP connection answering searches for the members of groups from a map of each group to its parent groups.
+    """
+
+    def __init__(self, parents):
+        self.parents = parents
+        self.searches = []
+        self.response = None
+
+    def bind(self):
+        pass
+
+    def unbind(self):
+        pass
+
+    def search(self, search_base, search_filter, **_):
+        self.searches.append(search_filter)
+        groups = re.findall(r"\(memberOf=([^)]*)\)", search_filter)
+        self.response = [{"dn": group, "raw_attributes": {"memberOf": [parent.encode("utf-8") for parent in parents]}}
+                         for group, parents in self.parents.items() if set(parents) & set(groups)]
+
+
+def test_group_cache_should_expire_evict_and_persist_entries(tmp_path):
+    """Tests the TTL, LRU eviction and persistence of the group cache.
+    """
+    # Given
+    clock = MagicMock(return_value=0.0)
+    path = str(tmp_path / "groups.json")
+    cache = GroupCache(size=2, ttl=10, path=path, clock=clock)
+
+    # When
+    cache.put("CN=A", ["CN=C"])
+    cache.put("CN=B", [])
+    cache.get("cn=a")
+    cache.put("CN=D", [])
+    cache.save()
+    clock.return_value = 10.0
+
+    # Then
+    assert cache.get("CN=B") is None
+    assert GroupCache(path=path, clock=MagicMock(return_value=5.0)).get("CN=A") == ["CN=C"]
+    assert cache.get("CN=A") is None
+    assert os.listdir(str(tmp_path)) == ["groups.json"]
+
+
+def test_group_cache_should_be_shared_by_threads(tmp_path):
+    """Tests that concurrent searches can use the group cache.
+    """
+    # Given
+    cache = GroupCache(size=50, path=str(tmp_path / "groups.json"))
+
+    def walk(thread):
+        for index in range(1000):
+            cache.put("CN=%d-%d" % (thread, index), [])
+            cache.get("CN=%d-%d" % (thread, index - 10))
+        cache.save()
+
+    # When
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(walk, range(4)))
+
+    # Then
+    assert len(json.loads((tmp_path / "groups.json").read_text())) == 50
+
+
+@patch("ldap3.Server")
+@patch("ldap3.Connection")
+def test_should_expand_nested_groups_breadth_first_with_one_query_per_level(mock_ldap_connection, mock_ldap_server):
+    """Tests that nested groups are expanded level by level with batched queries, cycles are handled and results are cached.
+    """
+    # Given
+    directory = FakeGroupDirectory({"CN=A": ["CN=Root"], "CN=B": ["CN=Root"], "CN=C": ["CN=A", "CN=B"], "CN=Root": ["CN=C"]})
+    mock_ldap_connection.return_value = directory
+    query_config = dict(test_config_json()["ldap"]["query"], nested_groups={"groups": ["CN=Root"], "base_dn": "OU=Groups"})
+    manager = AccountManager(ldap_query_config=query_config,
+                             ldap_user="user", ldap_password="password", ldap_url="ldps://testserver")
+
+    # When
+    groups = manager.expand_groups(["CN=Root"])
+    manager.expand_groups(["CN=Root"])
+    directory.parents = {}
+    manager.get_accounts()
+
+    # Then
+    assert groups == ["CN=Root", "CN=A", "CN=B", "CN=C"]
+    assert directory.searches[:3] == ["(&(objectClass=group)(|(memberOf=CN=Root)))",
+                                      "(&(objectClass=group)(|(memberOf=CN=A)(memberOf=CN=B)))",
+                                      "(&(objectClass=group)(|(memberOf=CN=C)))"]
+    # The second expansion and the one of the account search are answered from the cache
+    assert directory.searches[3:] == [
+        "(&(&(o=SubUnit)(memberOf=CN=AnotherGroup,CN=GroupB,CN=Roles,O=acme,C=global))"
+        "(|(memberOf=CN=Root)(memberOf=CN=A)(memberOf=CN=B)(memberOf=CN=C)))"]
+
+
+def test_account_should_decode_attributes_lazily():
+    """Tests that only the core attributes are decoded up front and the account carries no instance dictionary.
+    """
+    # Given
+    raw_attributes = dict(LDAP_ACCOUNT_SEARCH_RESULT[0]["raw_attributes"], description=[])
+    ldap_account = {"raw_attributes": raw_attributes}
+
+    # When
+    account = AccountManager.Account(ldap_account, ["uid", "mail", "name", "memberOf", "description"])
+
+    # Then
+    assert not hasattr(account, "__dict__")
+    assert account.name == "John Doe"
+    assert account.mail == "John.Doe@acme.com"
+    assert account.uid == "jodoe"
+    assert account.memberOf is account.memberOf
+    assert len(account.memberOf) == 4
+    assert not hasattr(account, "description")
+    assert not hasattr(account, "msDS-UserAccountDisabled")
+    assert not hasattr(account, "grafanaInviteLink")
+
+    account.grafanaInviteLink = "https://grafana/invite/abc"
+    assert json.loads(repr(account)) == {"uid": "jodoe", "mail": "John.Doe@acme.com", "name": "John Doe",
+                                         "memberOf": account.memberOf, "grafanaInviteLink": "https://grafana/invite/abc"}
+
+
+def test_account_fingerprint_should_change_with_the_attributes():
+    """Tests that the fingerprint only depends on the requested attribute values.
+    """
+    # Given
+    attributes = ["uid", "mail", "name", "memberOf"]
+    raw_attributes = LDAP_ACCOUNT_SEARCH_RESULT[0]["raw_attributes"]
+    reordered_groups = dict(raw_attributes, memberOf=list(reversed(raw_attributes["memberOf"])))
+    renamed = dict(raw_attributes, name=[b"John D."])
+
+    # When
+    fingerprint = AccountManager.Account({"raw_attributes": raw_attributes}, attributes).fingerprint()
+
+    # Then
+    assert fingerprint == AccountManager.Account({"raw_attributes": reordered_groups}, attributes).fingerprint()
+    assert fingerprint != AccountManager.Account({"raw_attributes": renamed}, attributes).fingerprint()
+    assert fingerprint != AccountManager.Account({"raw_attributes": raw_attributes}, attributes[:3]).fingerprint()
+
+
+@patch("ldap3.Server")
+@patch("ldap3.Connection")
+def test_should_only_search_for_modified_accounts_in_delta_mode(mock_ldap_connection, mock_ldap_server):
+    """Tests that a delta search restricts the filter and tracks the high-water mark.
+    """
+    # Given
+    search_result = [dict(entry, raw_attributes=dict(entry["raw_attributes"], uSNChanged=[usn]))
+                     for entry, usn in zip(LDAP_ACCOUNT_SEARCH_RESULT, [b"900", b"1200"])]
+    mock_ldap_connection_instance = mock_ldap_connection.return_value
+    mock_ldap_connection_instance.response = search_result
+
+    query_config = dict(test_config_json()["ldap"]["query"], delta={"attribute": "uSNChanged"})
+    manager = AccountManager(ldap_query_config=query_config,
+                             ldap_user="user", ldap_password="password", ldap_url="ldps://testserver")
+
+    # When
+    accounts = manager.get_accounts(modified_since="800")
+
+    # Then
+    mock_ldap_connection_instance.search.assert_called_once_with(
+        search_base="OU=AC,OU=Employees,O=acme,C=global",
+        search_filter="(&(&(o=SubUnit)(memberOf=CN=AnotherGroup,CN=GroupB,CN=Roles,O=acme,C=global))(uSNChanged>=800))",
+        search_scope=ANY,
+        attributes=["uid", "mail", "name", "msDS-UserAccountDisabled", "memberOf", "uSNChanged"])
+    assert len(accounts) == 2
+    assert not hasattr(accounts[0], "uSNChanged")
+    assert manager.high_water_mark == "1200"
+
+
+def test_newer_value_should_compare_sequence_numbers_and_timestamps():
+    """Tests that update sequence numbers compare numerically and timestamps lexicographically.
+    """
+    assert newer_value(None, "5") == "5"
+    assert newer_value("900", "1200") == "1200"
+    assert newer_value("1200", "900") == "1200"
+    assert newer_value("20190228095235.0Z", "20190301000000.0Z") == "20190301000000.0Z"
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the async_grafana module.
+"""
+
+import asyncio
+from unittest.mock import MagicMock
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from grafana_inviter.async_grafana import AdaptiveSlots, AsyncGrafana
+
+
+def run(coroutine):
+    """Runs the coroutine in a fresh event loop.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class FakeGrafana:
+    """Minimal Grafana invite API keeping track of the received requests.
+    """
+
+    def __init__(self, invites, failures=0):
+        self.invites = invites
+        self.failures = failures
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def handle(self, request):
+        self.requests.append((request.method, request.path, request.headers.get("Authorization")))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+
+        if self.failures:
+            self.failures -= 1
+            return web.Response(status=503, text="Service Unavailable", headers={"Retry-After": "0"})
+        if request.method == "GET":
+            return web.json_response(self.invites)
+        payload = await request.json()
+        self.invites.append({"email": payload["loginOrEmail"], "url": "https://grafana/invite/%s" % payload["name"]})
+        return web.json_response({"message": "Created invite for %s" % payload["loginOrEmail"]})
+
+    def application(self):
+        app = web.Application()
+        app.router.add_route("*", "/api/org/invites", self.handle)
+        return app
+
+
+def serve_and_run(fake_grafana, config, scenario):
+    """Runs the scenario against an AsyncGrafana connected to the fake Grafana.
+    """
+
+    async def main():
+        server = TestServer(fake_grafana.application())
+        await server.start_server()
+        try:
+            async with AsyncGrafana(grafana_config=dict(config, url=str(server.make_url("")).rstrip("/"))) as grafana:
+                return await scenario(grafana)
+        finally:
+            await server.close()
+
+    return run(main())
+
+
+def sample_grafana_config():
+    """Returns a test configuration
+    """
+    return {
+        "token": "my-token",
+        "orgId": 123,
+        "concurrency": 2
+    }
+
+
+def test_should_invite_accounts_concurrently_within_limits():
+    """Test that invites are sent concurrently without exceeding the configured concurrency.
+    """
+
+    # Given
+    fake_grafana = FakeGrafana(invites=[{"email": "Jane.Doe@acme.org", "url": "https://grafana/invite/jane"}])
+    accounts = [MagicMock(mail="jane.doe@acme.org")] + [MagicMock(mail="user%d@acme.org" % i) for i in range(6)]
+    for account in accounts:
+        account.name = account.mail
+
+    # When
+    results = serve_and_run(fake_grafana, sample_grafana_config(),
+                            lambda grafana: grafana.invite_all(accounts, send_mail=True))
+
+    # Then
+    assert results[0] == (False, "User already invited")
+    assert results[1:] == [(True, "Created invite for user%d@acme.org" % i) for i in range(6)]
+    assert [method for method, _, _ in fake_grafana.requests].count("GET") == 1
+    assert all(authorization == "Bearer my-token" for _, _, authorization in fake_grafana.requests)
+    assert fake_grafana.max_in_flight == 2
+
+
+def test_should_populate_invite_links():
+    """Test that invite links are populated, refetching the invites created during the run.
+    """
+
+    # Given
+    fake_grafana = FakeGrafana(invites=[{"email": "Jane.Doe@acme.org", "url": "https://grafana/invite/jane"}])
+    accounts = [MagicMock(spec=["mail", "name"], mail="jane.doe@acme.org"),
+                MagicMock(spec=["mail", "name"], mail="john.doe@acme.org"),
+                MagicMock(spec=["mail", "name"], mail="nobody@acme.org")]
+    accounts[1].name = "john"
+
+    async def scenario(grafana):
+        await grafana.invite(accounts[1])
+        await grafana.populate_accounts_with_invite_links(accounts)
+
+    # When
+    serve_and_run(fake_grafana, sample_grafana_config(), scenario)
+
+    # Then
+    assert [method for method, _, _ in fake_grafana.requests] == ["GET", "POST", "GET"]
+    assert accounts[0].grafanaInviteLink == "https://grafana/invite/jane"
+    assert accounts[1].grafanaInviteLink == "https://grafana/invite/john"
+    assert not hasattr(accounts[2], "grafanaInviteLink")
+
+
+def test_close_should_be_a_noop_without_session():
+    """Test that closing an unused client doesn't fail.
+    """
+    run(AsyncGrafana(grafana_config=dict(sample_grafana_config(), url="https://grafana")).close())
+
+
+def test_should_retry_throttled_requests_and_report_non_json_errors():
+    """Test that throttled requests are retried and non JSON error bodies are reported.
+    """
+
+    # Given
+    fake_grafana = FakeGrafana(invites=[], failures=2)
+    account = MagicMock(mail="john.doe@acme.org")
+    account.name = "john"
+    config = dict(sample_grafana_config(), rate_limit={"max_retries": 0})
+
+    # When
+    try:
+        serve_and_run(fake_grafana, config, lambda grafana: grafana.refresh_invites())
+        assert False, "Expected the failed invite refresh to raise"
+    except aiohttp.ClientResponseError as error:
+        assert error.status == 503
+    result = serve_and_run(fake_grafana, dict(config, rate_limit={"max_retries": 1}), lambda grafana: grafana.invite(account))
+
+    async def failing_invite(grafana):
+        await grafana.refresh_invites()
+        fake_grafana.failures = 1
+        account.mail = "jane.doe@acme.org"
+        return await grafana.invite(account)
+    error_result = serve_and_run(fake_grafana, config, failing_invite)
+
+    # Then
+    assert result == (True, "Created invite for john.doe@acme.org")
+    assert error_result == (False, "HTTP 503: Service Unavailable")
+
+
+def test_adaptive_slots_should_follow_the_limit_of_the_throttle():
+    """Test that the requests in flight are limited to the current adaptive limit of the throttle.
+    """
+
+    # Given
+    throttle = MagicMock(concurrency=2)
+    in_flight, peaks = [0], []
+
+    async def request(slots):
+        async with slots:
+            in_flight[0] += 1
+            peaks[-1] = max(peaks[-1], in_flight[0])
+            await asyncio.sleep(0.01)
+            in_flight[0] -= 1
+
+    async def scenario():
+        slots = AdaptiveSlots(throttle)
+        for concurrency in (2, 1, 3):
+            throttle.concurrency = concurrency
+            peaks.append(0)
+            await asyncio.gather(*[request(slots) for _ in range(6)])
+
+    # When
+    run(scenario())
+
+    # Then
+    assert peaks == [2, 1, 3]
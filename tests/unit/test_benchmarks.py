@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the benchmarks, keeping them runnable.
+"""
+
+from benchmarks.invite import percentile, run_benchmark
+from benchmarks.startup import BARE, over_budget, startup_seconds
+
+
+def test_percentile_should_use_the_nearest_rank():
+    # Given
+    values = list(range(1, 101))
+
+    # When / Then
+    assert percentile(values, 0.5) == 50
+    assert percentile(values, 0.99) == 99
+    assert percentile([], 0.99) == 0.0
+
+
+def test_benchmark_should_invite_all_accounts_of_the_fake_directory():
+    # When
+    result = run_benchmark(50, error_rate=0.1, invites=10, concurrency=4, page_size=20)
+
+    # Then
+    assert result["accounts"] == 50
+    assert result["invited"] == 50
+    # Reading members and invites, the invites including retries and reading the invite URLs
+    assert result["requests"] >= 53
+    assert result["p50_ms"] <= result["p99_ms"]
+    assert result["rss_growth_mb"] >= 0
+
+
+def test_startup_should_measure_fresh_interpreters():
+    # When / Then
+    assert startup_seconds("pass", 2) > 0
+
+
+def test_startup_should_report_cases_over_budget(capsys):
+    # When
+    exceeded = over_budget([("bare", BARE, 100.0), ("sleeping", "import time\ntime.sleep(0.5)", 1.0)], 1)
+
+    # Then
+    assert exceeded == ["sleeping"]
+    assert "sleeping" in capsys.readouterr().out
@@ -5,11 +5,21 @@ Tests for the cli module.
 """
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
 import requests
 import pytest
 from unittest.mock import ANY, call, MagicMock, patch
 
-from grafana_inviter.cli import configure, assemble, main, parse_args, validate
+from grafana_inviter.config_schema import config_validator, json_config_schema
+from grafana_inviter.metrics import REGISTRY
+from grafana_inviter.state import STATUS_ALREADY_INVITED, STATUS_FAILED, STATUS_INVITED, STATUS_MEMBER, StateStore
+from grafana_inviter.cli import HIGH_WATER_MARK_KEY, LAST_FULL_SYNC_KEY, configure, assemble, daemon, dry_run, serve, fan_out, grafana_instances, invite_accounts, main, org_configs, parse_args, stream, validate
 
 
 def test_config_json():
@@ -46,11 +56,12 @@ def test_parse_args():
     """
 
     # Given & When
-    parser = parse_args(["--ldap-user", "user", "--ldap-password", "password", "--ask-ldap-password", "--ldap-url", "ldp",
+    parser = parse_args(["plan", "--ldap-user", "user", "--ldap-password", "password", "--ask-ldap-password", "--ldap-url", "ldp",
                          "--grafana-url", "grafana", "--grafana-token", "token", "--ask-grafana-token",
-                         "--send-invite-mail", "--config", "config.json"])
+                         "--send-invite-mail", "--concurrency", "8", "--stream", "--state-file", "state.db", "--revoke-invites", "--config", "config.json"])
 
     # Then
+    assert parser.command == "plan"
     assert parser.ldap_user == "user"
     assert parser.ask_ldap_password
     assert parser.ldap_password == "password"
@@ -58,6 +69,10 @@ def test_parse_args():
     assert parser.grafana_token == "token"
     assert parser.ask_grafana_token
     assert parser.send_invite_mail
+    assert parser.concurrency == 8
+    assert parser.stream
+    assert parser.state_file == "state.db"
+    assert parser.revoke_invites
     assert parser.config == "config.json"
 
 
@@ -72,7 +87,7 @@ def test_configure_should_use_overwritten_argparse_values(mock_anyconfig_load):
     dummy_args = parse_args(["--ldap-url", "ldaps://prod-ldap",
                              "--ldap-user", "prod-user", "--ldap-password", "prod-password",
                              "--grafana-url", "https://prod-grafana", "--grafana-token", "prod-token",
-                             "--send-invite-mail",
+                             "--send-invite-mail", "--concurrency", "4", "--state-file", "state.db", "--revoke-invites",
                              "--config", "dummy_config.json"])
 
     # When
@@ -86,6 +101,9 @@ def test_configure_should_use_overwritten_argparse_values(mock_anyconfig_load):
     assert config["grafana"]["url"] == "https://prod-grafana"
     assert config["grafana"]["token"] == "prod-token"
     assert config["grafana"]["send_invite_mail"]
+    assert config["grafana"]["concurrency"] == 4
+    assert config["state"]["path"] == "state.db"
+    assert config["grafana"]["revoke_invites"]
 
 
 @patch("grafana_inviter.cli.getpass")
@@ -109,16 +127,50 @@ def test_configure_should_use_interactively_asked_ldap_password_and_grafana_toke
     assert config["grafana"]["token"] == "interactively-provided-grafana-token"
 
 
-@patch("anyconfig.loads")
-@patch("anyconfig.validate")
-def test_validate_should_raise_system_exit_if_schema_validation_fails(mock_anyconfig_validate, mock_anyconfig_loads):
+def test_validate_should_raise_system_exit_if_schema_validation_fails():
     # Given
-    mock_anyconfig_loads.return_value = MagicMock()
-    mock_anyconfig_validate.return_value = (False, "Missing attribute 'password'")
+    config = test_config_json()
+    config["grafana"]["orgId"] = 1
+    del config["ldap"]["password"]
 
     # When & Then
-    with pytest.raises(SystemExit):
-        validate(test_config_json())
+    with pytest.raises(SystemExit, match="Invalid configuration at ldap: 'password' is a required property"):
+        validate(config)
+
+
+def test_validate_should_compile_the_schema_once():
+    # Given
+    config = test_config_json()
+    config["grafana"]["orgId"] = 1
+
+    # When
+    with patch("grafana_inviter.config_schema.json_config_schema", wraps=json_config_schema) as mock_schema:
+        config_validator.cache_clear()
+        validate(config)
+        validate(config)
+
+    # Then
+    assert mock_schema.call_count == 1
+
+
+@patch("anyconfig.load")
+def test_configure_should_only_parse_changed_config_files(mock_anyconfig_load, tmp_path):
+    # Given
+    path = tmp_path / "config.json"
+    path.write_text("{}")
+    mock_anyconfig_load.side_effect = lambda _: test_config_json()
+    args = parse_args(["--config", str(path)])
+
+    # When
+    first = configure(args)
+    first["ldap"]["user"] = "changed"
+    second = configure(args)
+    path.write_text("{ }")
+    configure(args)
+
+    # Then
+    assert second["ldap"]["user"] == "test-user"
+    assert mock_anyconfig_load.call_count == 2
 
 
 @patch("grafana_inviter.cli.AccountManager")
@@ -139,9 +191,791 @@ def test_assemble(mock_grafana_ctor, mock_account_manager_ctor):
 
     # Then
     mock_account_manager_ctor.assert_called_with(ldap_query_config=test_config_json()["ldap"]["query"],
-                                            ldap_user="test-user", ldap_password="test-password", ldap_url="ldaps://test-ldap")
+                                            ldap_user="test-user", ldap_password="test-password", ldap_url="ldaps://test-ldap",
+                                            pool_config=None)
     mock_grafana_ctor.assert_called_with(grafana_config=test_config_json()["grafana"])
 
     mock_grafana.invite.assert_called_with(account=mock_account, send_mail=False)
 
     mock_grafana.populate_accounts_with_invite_links.assert_called_with([mock_account])
+    mock_grafana.close.assert_called_once_with()
+    mock_account_manager.close.assert_called_once_with()
+
+
+@patch("grafana_inviter.cli.AccountManager")
+@patch("grafana_inviter.cli.Grafana")
+def test_assemble_should_write_ndjson_if_configured(mock_grafana_ctor, mock_account_manager_ctor, capsys):
+    # Given
+    config = dict(test_config_json(), output={"format": "ndjson"})
+    invited_account = mock_account("Jane Doe", "Jane.Doe@acme.org")
+    mock_account_manager_ctor.return_value.get_accounts.return_value = [invited_account]
+    mock_grafana = mock_grafana_ctor.return_value
+    mock_grafana.org_members.return_value = set()
+    mock_grafana.pending_invites.return_value = {}
+    mock_grafana.invite.return_value = (True, "User invited")
+
+    def populate(accounts):
+        accounts[0].grafanaInviteLink = "https://grafana/invite/abc"
+
+    mock_grafana.populate_accounts_with_invite_links.side_effect = populate
+
+    #  When
+    assemble(config)
+
+    # Then
+    output = capsys.readouterr()
+    assert [json.loads(line) for line in output.out.splitlines()] == [
+        {"action": "invite", "name": "Jane Doe", "mail": "Jane.Doe@acme.org", "succeeded": True, "message": "User invited", "url": None,
+         "grafana": None, "org": None},
+        {"action": "link", "name": "Jane Doe", "mail": "Jane.Doe@acme.org", "succeeded": True, "message": None,
+         "url": "https://grafana/invite/abc", "grafana": None, "org": None}
+    ]
+    assert "Available invite URLs: ['https://grafana/invite/abc']" in output.err
+
+
+@patch("sys.argv", ["grafana-inviter", "--config", "config.json", "--metrics-textfile", "metrics.prom", "--metrics-summary"])
+@patch("grafana_inviter.cli.AccountManager")
+@patch("grafana_inviter.cli.Grafana")
+@patch("anyconfig.load")
+def test_main_should_time_the_phases_and_export_the_metrics(mock_anyconfig_load, mock_grafana_ctor, mock_account_manager_ctor,
+                                                            tmp_path, monkeypatch, capsys):
+    # Given
+    monkeypatch.chdir(tmp_path)
+    mock_anyconfig_load.return_value = dict(test_config_json(), grafana=dict(test_config_json()["grafana"], orgId=1))
+    REGISTRY.reset()
+    mock_account_manager_ctor.return_value.get_accounts.return_value = [mock_account("Jane Doe", "Jane.Doe@acme.org")]
+    mock_grafana = mock_grafana_ctor.return_value
+    mock_grafana.org_members.return_value = set()
+    mock_grafana.pending_invites.return_value = {}
+    mock_grafana.invite.return_value = (False, "HTTP 502: Bad Gateway")
+
+    #  When
+    main()
+
+    # Then
+    metrics = (tmp_path / "metrics.prom").read_text()
+    assert 'grafana_inviter_accounts_total{status="failed"} 1' in metrics
+    for phase in ("plan", "invite", "invite_links", "state"):
+        assert 'grafana_inviter_phase_seconds_count{phase="%s"} 1' % phase in metrics
+    assert 'phase{phase="invite"}' in capsys.readouterr().err
+    REGISTRY.reset()
+
+
+@patch("grafana_inviter.cli.AccountManager")
+@patch("grafana_inviter.cli.Grafana")
+def test_stream_should_time_the_phases(mock_grafana_ctor, mock_account_manager_ctor):
+    # Given
+    REGISTRY.reset()
+    mock_account_manager_ctor.return_value.iter_accounts.return_value = iter([mock_account("Jane Doe", "Jane.Doe@acme.org")])
+    mock_grafana = mock_grafana_ctor.return_value
+    mock_grafana.org_members.return_value = set()
+    mock_grafana.invite.return_value = (True, "User invited")
+
+    #  When
+    stream(test_config_json())
+
+    # Then
+    phases = [dict(labels)["phase"] for name, labels, *_ in REGISTRY.timers() if name == "phase"]
+    assert sorted(phases) == ["invite", "invite_links", "plan", "state"]
+    REGISTRY.reset()
+
+
+def test_invite_accounts_should_keep_the_order_of_accounts_when_running_concurrently():
+    """Validate that concurrently sent invites are reported in the order of the accounts.
+    """
+
+    # Given
+    accounts = [MagicMock(mail="user%d@acme.org" % i) for i in range(20)]
+    mock_grafana = MagicMock()
+    mock_grafana.invite.side_effect = lambda account, send_mail: (True, account.mail)
+
+    # When
+    results = list(invite_accounts(mock_grafana, accounts, send_mail=True, concurrency=4))
+
+    # Then
+    assert [account for account, _ in results] == accounts
+    assert [message for _, (_, message) in results] == [account.mail for account in accounts]
+    mock_grafana.invite.assert_has_calls([call(account=account, send_mail=True) for account in accounts], any_order=True)
+
+
+def test_invite_accounts_should_consume_accounts_lazily():
+    """Validate that only a bounded window of accounts is read ahead of the invite results.
+    """
+
+    # Given
+    consumed = []
+
+    def accounts():
+        for i in range(100):
+            consumed.append(i)
+            yield MagicMock(mail="user%d@acme.org" % i)
+
+    mock_grafana = MagicMock()
+    mock_grafana.invite.return_value = (True, "User invited")
+
+    # When
+    results = invite_accounts(mock_grafana, accounts(), send_mail=False, concurrency=4)
+    next(results)
+
+    # Then
+    assert len(consumed) == 8
+    assert len(list(results)) == 99
+
+
+@patch("grafana_inviter.cli.AccountManager")
+@patch("grafana_inviter.cli.Grafana")
+def test_stream(mock_grafana_ctor, mock_account_manager_ctor):
+    # Given
+    mock_invited_account = MagicMock(name="John Doe", mail="John.Doe@acme.org")
+    mock_known_account = MagicMock(name="Jane Doe", mail="Jane.Doe@acme.org")
+    mock_account_manager_ctor.return_value.iter_accounts.return_value = iter([mock_invited_account, mock_known_account])
+
+    mock_grafana = mock_grafana_ctor.return_value
+    mock_grafana.invite.side_effect = [(True, "User invited"), (False, "User already invited")]
+    mock_grafana.invite_link.side_effect = [None, "https://grafana/invite/abc"]
+
+    #  When
+    stream(test_config_json())
+
+    # Then
+    mock_account_manager_ctor.return_value.get_accounts.assert_not_called()
+    mock_grafana.invite.assert_has_calls([call(account=mock_invited_account, send_mail=False),
+                                          call(account=mock_known_account, send_mail=False)])
+    mock_grafana.populate_accounts_with_invite_links.assert_called_once_with([mock_invited_account])
+    mock_grafana.close.assert_called_once_with()
+    mock_account_manager_ctor.return_value.close.assert_called_once_with()
+
+
+@patch("grafana_inviter.cli.AccountManager")
+@patch("grafana_inviter.cli.Grafana")
+def test_stream_should_print_each_result_before_the_next_invite(mock_grafana_ctor, mock_account_manager_ctor, capsys):
+    # Given
+    mock_account_manager_ctor.return_value.iter_accounts.return_value = iter([
+        mock_account("John Doe", "John.Doe@acme.org"), mock_account("Jane Doe", "Jane.Doe@acme.org")
+    ])
+    mock_grafana = mock_grafana_ctor.return_value
+    mock_grafana.org_members.return_value = set()
+    mock_grafana.invite.return_value = (True, "User invited")
+    printed = []
+    mock_grafana.invite_link.side_effect = lambda account: printed.append(capsys.readouterr().out)
+
+    #  When
+    stream(test_config_json())
+
+    # Then
+    assert printed[0] == ""
+    assert "John.Doe@acme.org" in printed[1]
+
+
+@patch("grafana_inviter.cli.AccountManager")
+@patch("grafana_inviter.cli.Grafana")
+def test_stream_should_close_the_clients_if_the_state_cannot_be_opened(mock_grafana_ctor, mock_account_manager_ctor, tmp_path):
+    # Given
+    config = dict(test_config_json(), state={"path": str(tmp_path / "missing" / "state.db")})
+
+    #  When
+    with pytest.raises(sqlite3.OperationalError):
+        stream(config)
+
+    # Then
+    mock_account_manager_ctor.return_value.close.assert_called_once_with()
+    mock_grafana_ctor.return_value.close.assert_called_once_with()
+
+
+def mock_account(name, mail, fingerprint="fingerprint"):
+    """Returns an account as read from LDAP.
+    """
+    account = MagicMock(mail=mail, spec=["name", "mail", "fingerprint"])
+    account.name = name
+    account.fingerprint.return_value = fingerprint
+    return account
+
+
+@patch("grafana_inviter.cli.AccountManager")
+@patch("grafana_inviter.cli.Grafana")
+def test_assemble_should_skip_accounts_unchanged_since_the_last_run(mock_grafana_ctor, mock_account_manager_ctor, tmp_path):
+    # Given
+    config = dict(test_config_json(), state={"path": str(tmp_path / "state.db")})
+    state = StateStore(config["state"]["path"])
+    state.record(mock_account("John Doe", "John.Doe@acme.org"), STATUS_INVITED, "https://grafana/invite/john")
+    state.record(mock_account("Jane Doe", "Jane.Doe@acme.org"), STATUS_INVITED, "https://grafana/invite/jane")
+    state.close()
+
+    unchanged_account = mock_account("John Doe", "John.Doe@acme.org")
+    changed_account = mock_account("Jane Doe", "Jane.Doe@acme.org", fingerprint="changed")
+    new_account = mock_account("Jim Doe", "Jim.Doe@acme.org")
+    failing_account = mock_account("Joe Doe", "Joe.Doe@acme.org")
+    mock_account_manager_ctor.return_value.get_accounts.return_value = [unchanged_account, changed_account, new_account, failing_account]
+
+    mock_grafana = mock_grafana_ctor.return_value
+    mock_grafana.invite.side_effect = [(False, "User already invited"), (True, "Created invite"), (False, "Some error")]
+    mock_grafana.populate_accounts_with_invite_links.side_effect = \
+        lambda accounts: setattr(accounts[1], "grafanaInviteLink", "https://grafana/invite/jim")
+
+    #  When
+    assemble(config)
+
+    # Then
+    mock_grafana.populate_accounts_with_invite_links.assert_called_once_with([changed_account, new_account, failing_account])
+    state = StateStore(config["state"]["path"])
+    assert state.lookup(changed_account).status == STATUS_ALREADY_INVITED
+    assert state.lookup(changed_account).invite_url == "https://grafana/invite/jane"
+    assert state.lookup(new_account).status == STATUS_INVITED
+    assert state.lookup(new_account).invite_url == "https://grafana/invite/jim"
+    assert state.lookup(failing_account).status == STATUS_FAILED
+    state.close()
+
+
+@patch("grafana_inviter.cli.AccountManager")
+@patch("grafana_inviter.cli.Grafana")
+def test_stream_should_skip_accounts_unchanged_since_the_last_run(mock_grafana_ctor, mock_account_manager_ctor, tmp_path):
+    # Given
+    config = dict(test_config_json(), state={"path": str(tmp_path / "state.db")})
+    state = StateStore(config["state"]["path"])
+    state.record(mock_account("John Doe", "John.Doe@acme.org"), STATUS_INVITED)
+    state.close()
+
+    unchanged_account = mock_account("John Doe", "John.Doe@acme.org")
+    new_account = mock_account("Jim Doe", "Jim.Doe@acme.org")
+    mock_account_manager_ctor.return_value.iter_accounts.return_value = iter([unchanged_account, new_account])
+
+    mock_grafana = mock_grafana_ctor.return_value
+    mock_grafana.invite.return_value = (True, "Created invite")
+    mock_grafana.invite_link.return_value = None
+    mock_grafana.populate_accounts_with_invite_links.side_effect = \
+        lambda accounts: setattr(accounts[0], "grafanaInviteLink", "https://grafana/invite/jim")
+
+    #  When
+    stream(config)
+
+    # Then
+    mock_grafana.invite.assert_called_once_with(account=new_account, send_mail=False)
+    state = StateStore(config["state"]["path"])
+    assert state.lookup(new_account).status == STATUS_INVITED
+    assert state.lookup(new_account).invite_url == "https://grafana/invite/jim"
+    state.close()
+
+
+@patch("time.time")
+@patch("grafana_inviter.cli.AccountManager")
+@patch("grafana_inviter.cli.Grafana")
+def test_assemble_should_sync_incrementally_between_full_syncs(mock_grafana_ctor, mock_account_manager_ctor, mock_time, tmp_path):
+    # Given
+    config = test_config_json()
+    config["state"] = {"path": str(tmp_path / "state.db")}
+    config["ldap"]["query"]["delta"] = {"attribute": "modifyTimestamp", "full_resync_interval": 3600}
+    mock_manager = mock_account_manager_ctor.return_value
+    mock_manager.get_accounts.return_value = []
+
+    # When
+    mock_time.return_value = 1000.0
+    mock_manager.high_water_mark = "20190101000000Z"
+    assemble(config)
+    mock_time.return_value = 2000.0
+    mock_manager.high_water_mark = None
+    assemble(config)
+    mock_time.return_value = 5000.0
+    mock_manager.high_water_mark = "20190102000000Z"
+    assemble(config)
+
+    # Then
+    assert mock_manager.get_accounts.call_args_list == [call(modified_since=None), call(modified_since="20190101000000Z"),
+                                                        call(modified_since=None)]
+    state = StateStore(config["state"]["path"])
+    assert state.get_meta(HIGH_WATER_MARK_KEY) == "20190102000000Z"
+    assert state.get_meta(LAST_FULL_SYNC_KEY) == "5000.0"
+    state.close()
+
+
+@patch("time.time")
+@patch("grafana_inviter.cli.AccountManager")
+@patch("grafana_inviter.cli.Grafana")
+def test_assemble_should_retry_failed_invites_in_the_next_incremental_sync(mock_grafana_ctor, mock_account_manager_ctor, mock_time,
+                                                                           tmp_path):
+    # Given
+    config = test_config_json()
+    config["state"] = {"path": str(tmp_path / "state.db")}
+    config["ldap"]["query"]["delta"] = {"attribute": "modifyTimestamp", "full_resync_interval": 3600}
+    mock_time.return_value = 1000.0
+    failing_account = mock_account("John Doe", "John.Doe@acme.org")
+    mock_manager = mock_account_manager_ctor.return_value
+    mock_manager.get_accounts.side_effect = [[], [failing_account], [failing_account]]
+    mock_grafana_ctor.return_value.invite.side_effect = [(False, "HTTP 502: Bad Gateway"), (True, "Created invite")]
+
+    # When
+    mock_manager.high_water_mark = "20190101000000Z"
+    assemble(config)
+    mock_manager.high_water_mark = "20190102000000Z"
+    assemble(config)
+    mock_manager.high_water_mark = "20190103000000Z"
+    assemble(config)
+
+    # Then
+    assert mock_manager.get_accounts.call_args_list == [call(modified_since=None), call(modified_since="20190101000000Z"),
+                                                        call(modified_since="20190101000000Z")]
+    assert mock_grafana_ctor.return_value.invite.call_count == 2
+    state = StateStore(config["state"]["path"])
+    assert state.lookup(failing_account).status == STATUS_INVITED
+    assert state.get_meta(HIGH_WATER_MARK_KEY) == "20190103000000Z"
+    state.close()
+
+
+@patch("grafana_inviter.cli.AccountManager")
+@patch("grafana_inviter.cli.Grafana")
+def test_stream_should_do_a_full_sync_without_state(mock_grafana_ctor, mock_account_manager_ctor):
+    # Given
+    config = test_config_json()
+    config["ldap"]["query"]["delta"] = {"attribute": "modifyTimestamp"}
+    mock_account_manager_ctor.return_value.iter_accounts.return_value = iter([])
+
+    # When
+    stream(config)
+
+    # Then
+    mock_account_manager_ctor.return_value.iter_accounts.assert_called_once_with(modified_since=None)
+
+
+@patch("grafana_inviter.cli.AccountManager")
+@patch("grafana_inviter.cli.Grafana")
+def test_assemble_should_only_invite_accounts_which_are_neither_members_nor_invited(mock_grafana_ctor, mock_account_manager_ctor, tmp_path):
+    # Given
+    config = test_config_json()
+    config["state"] = {"path": str(tmp_path / "state.db")}
+    config["grafana"]["revoke_invites"] = True
+
+    member = mock_account("John Doe", "John.Doe@acme.org")
+    new_account = mock_account("Jim Doe", "Jim.Doe@acme.org")
+    mock_account_manager_ctor.return_value.get_accounts.return_value = [member, new_account]
+
+    stale_invite = {"email": "Left.Company@acme.org", "code": "left"}
+    mock_grafana = mock_grafana_ctor.return_value
+    mock_grafana.org_members.return_value = {"john.doe@acme.org"}
+    mock_grafana.pending_invites.return_value = {"left.company@acme.org": stale_invite}
+    mock_grafana.invite.return_value = (True, "Created invite")
+    mock_grafana.revoke_invite.return_value = (True, "Invite revoked")
+
+    #  When
+    assemble(config)
+
+    # Then
+    mock_grafana.invite.assert_called_once_with(account=new_account, send_mail=False)
+    mock_grafana.revoke_invite.assert_called_once_with(stale_invite)
+    state = StateStore(config["state"]["path"])
+    assert state.lookup(member).status == STATUS_MEMBER
+    assert state.lookup(new_account).status == STATUS_INVITED
+    state.close()
+
+
+@patch("grafana_inviter.cli.AccountManager")
+@patch("grafana_inviter.cli.Grafana")
+def test_assemble_should_not_revoke_invites_during_incremental_syncs(mock_grafana_ctor, mock_account_manager_ctor, tmp_path):
+    # Given
+    config = test_config_json()
+    config["state"] = {"path": str(tmp_path / "state.db")}
+    config["grafana"]["revoke_invites"] = True
+    config["ldap"]["query"]["delta"] = {"attribute": "modifyTimestamp"}
+    state = StateStore(config["state"]["path"])
+    state.set_meta(LAST_FULL_SYNC_KEY, 1e12)
+    state.set_meta(HIGH_WATER_MARK_KEY, "20190101000000Z")
+    state.close()
+
+    mock_account_manager_ctor.return_value.get_accounts.return_value = []
+    mock_grafana = mock_grafana_ctor.return_value
+    mock_grafana.org_members.return_value = set()
+    mock_grafana.pending_invites.return_value = {"left.company@acme.org": {"email": "Left.Company@acme.org", "code": "left"}}
+
+    #  When
+    assemble(config)
+
+    # Then
+    mock_account_manager_ctor.return_value.get_accounts.assert_called_once_with(modified_since="20190101000000Z")
+    mock_grafana.revoke_invite.assert_not_called()
+
+
+@patch("grafana_inviter.cli.AccountManager")
+@patch("grafana_inviter.cli.Grafana")
+def test_stream_should_skip_members(mock_grafana_ctor, mock_account_manager_ctor):
+    # Given
+    member = mock_account("John Doe", "John.Doe@acme.org")
+    new_account = mock_account("Jim Doe", "Jim.Doe@acme.org")
+    mock_account_manager_ctor.return_value.iter_accounts.return_value = iter([member, new_account])
+    mock_grafana = mock_grafana_ctor.return_value
+    mock_grafana.org_members.return_value = {"john.doe@acme.org"}
+    mock_grafana.invite.return_value = (True, "Created invite")
+    mock_grafana.invite_link.return_value = None
+
+    #  When
+    stream(test_config_json())
+
+    # Then
+    mock_grafana.invite.assert_called_once_with(account=new_account, send_mail=False)
+
+
+def test_org_configs_should_override_the_grafana_section_per_org():
+    """Validate that each entry of grafana.orgs inherits the shared settings of the grafana section.
+    """
+
+    # Given
+    grafana_config = dict(test_config_json()["grafana"], orgId=1)
+    orgs_config = dict(test_config_json()["grafana"], role="Editor", orgs=[{"orgId": 2}, {"orgId": 3, "role": "Admin", "token": "org-3-token"}])
+
+    # When & Then
+    assert org_configs(grafana_config) == [grafana_config]
+    assert org_configs(orgs_config) == [dict(test_config_json()["grafana"], role="Editor", orgId=2),
+                                        dict(test_config_json()["grafana"], role="Admin", orgId=3, token="org-3-token")]
+
+
+@patch("grafana_inviter.cli.AccountManager")
+@patch("grafana_inviter.cli.Grafana")
+def test_fan_out_should_search_once_per_filter_and_invite_into_each_org(mock_grafana_ctor, mock_account_manager_ctor, capsys):
+    # Given
+    config = test_config_json()
+    config["grafana"]["orgs"] = [{"orgId": 1}, {"orgId": 2}, {"orgId": 3, "search_filter": "(uid=admin)", "role": "Admin"}]
+
+    john = mock_account("John Doe", "John.Doe@acme.org")
+    admin = mock_account("Admin", "admin@acme.org")
+    mock_manager = mock_account_manager_ctor.return_value
+    mock_manager.get_accounts.side_effect = lambda search_filter: [admin] if search_filter == "(uid=admin)" else [john]
+
+    mock_grafana = mock_grafana_ctor.return_value
+    mock_grafana.org_members.return_value = set()
+    mock_grafana.pending_invites.return_value = {}
+    mock_grafana.invite.return_value = (True, "Created invite")
+    mock_grafana.invite_link.return_value = None
+    mock_grafana.refresh_invites.side_effect = lambda: setattr(mock_grafana.invite_link, "return_value", "https://grafana/invite/1")
+
+    #  When
+    fan_out(config)
+
+    # Then
+    assert mock_manager.get_accounts.call_args_list == [call(search_filter=config["ldap"]["query"]["search_filter"]),
+                                                        call(search_filter="(uid=admin)")]
+    assert sorted(kwargs["grafana_config"]["orgId"] for _, kwargs in mock_grafana_ctor.call_args_list) == [1, 2, 3]
+    assert sorted(mock_grafana.invite.call_args_list, key=str) == sorted([call(account=john, send_mail=False)] * 2 +
+                                                                       [call(account=admin, send_mail=False)], key=str)
+    assert mock_grafana.close.call_count == 3
+    mock_manager.close.assert_called_once_with()
+    output = capsys.readouterr().out
+    assert "[https://test-grafana org 3] Sending invite to Admin (admin@acme.org)" in output
+    assert "Available invite URLs of https://test-grafana org 2: ['https://grafana/invite/1']" in output
+
+
+@patch("concurrent.futures.ProcessPoolExecutor", ThreadPoolExecutor)
+@patch("grafana_inviter.cli.AccountManager")
+@patch("grafana_inviter.cli.Grafana")
+def test_fan_out_should_merge_the_reports_of_several_instances(mock_grafana_ctor, mock_account_manager_ctor, capsys):
+    # Given
+    config = test_config_json()
+    config["grafana"] = [dict(config["grafana"], url="https://grafana-eu", orgId=1),
+                         dict(config["grafana"], url="https://grafana-us", orgs=[{"orgId": 1}, {"orgId": 2}])]
+
+    john = mock_account("John Doe", "John.Doe@acme.org")
+    mock_account_manager_ctor.return_value.get_accounts.return_value = [john]
+    mock_grafana = mock_grafana_ctor.return_value
+    mock_grafana.org_members.return_value = set()
+    mock_grafana.pending_invites.return_value = {}
+    mock_grafana.invite.return_value = (False, "Failed")
+    mock_grafana.invite_link.return_value = None
+
+    #  When
+    fan_out(config)
+
+    # Then
+    mock_account_manager_ctor.return_value.get_accounts.assert_called_once_with(search_filter=config["ldap"]["query"]["search_filter"])
+    assert mock_grafana.invite.call_count == 3
+    # The organizations of an instance share its throttle
+    throttles = [kwargs["throttle"] for _, kwargs in mock_grafana_ctor.call_args_list if kwargs["grafana_config"]["url"] == "https://grafana-us"]
+    assert len(throttles) == 2 and throttles[0] is throttles[1]
+    output = capsys.readouterr().out.splitlines()
+    assert output[-7].split() == ["Grafana", "org", "invited", "skipped", "failed", "revoked"]
+    assert output[-6].split() == ["https://grafana-eu", "1", "0", "0", "1", "0"]
+    assert output[-4].split() == ["https://grafana-us", "2", "0", "0", "1", "0"]
+
+
+@patch("grafana_inviter.cli.AccountManager")
+@patch("grafana_inviter.cli.Grafana")
+def test_fan_out_should_write_the_results_of_each_org_in_the_configured_format(mock_grafana_ctor, mock_account_manager_ctor, capsys):
+    # Given
+    config = test_config_json()
+    config["grafana"]["orgs"] = [{"orgId": 1}, {"orgId": 2}]
+    config["output"] = {"format": "ndjson"}
+
+    john = mock_account("John Doe", "John.Doe@acme.org")
+    mock_account_manager_ctor.return_value.get_accounts.return_value = [john]
+    mock_grafana = mock_grafana_ctor.return_value
+    mock_grafana.org_members.return_value = set()
+    mock_grafana.pending_invites.return_value = {}
+    mock_grafana.invite.return_value = (True, "Created invite")
+    mock_grafana.invite_link.return_value = "https://grafana/invite/1"
+
+    #  When
+    fan_out(config)
+
+    # Then
+    captured = capsys.readouterr()
+    results = sorted((json.loads(line) for line in captured.out.splitlines()), key=lambda result: (result["org"], result["action"]))
+    assert results == [
+        {"action": action, "name": "John Doe", "mail": "John.Doe@acme.org", "succeeded": True, "message": message, "url": url,
+         "grafana": "https://test-grafana", "org": org}
+        for org in (1, 2)
+        for action, message, url in (("invite", "Created invite", None), ("link", None, "https://grafana/invite/1"))
+    ]
+    # The summary goes to standard error, so the output stays machine readable
+    assert "Available invite URLs of https://test-grafana org 1: ['https://grafana/invite/1']" in captured.err
+
+
+@patch("anyconfig.load")
+def test_configure_should_override_all_grafana_instances(mock_anyconfig_load):
+    # Given
+    config = test_config_json()
+    config["grafana"] = [dict(config["grafana"], url="https://grafana-eu"), dict(config["grafana"], url="https://grafana-us")]
+    mock_anyconfig_load.return_value = config
+
+    # When
+    configured = configure(parse_args(["--grafana-token", "prod-token", "--concurrency", "4", "--config", "config.json"]))
+
+    # Then
+    assert [(grafana_config["token"], grafana_config["concurrency"]) for grafana_config in grafana_instances(configured)] == [("prod-token", 4)] * 2
+
+
+def test_parse_args_should_default_to_the_invite_command():
+    """Validate that invites are sent if no command is given.
+    """
+    assert parse_args(["--config", "config.json"]).command == "invite"
+
+
+@patch("grafana_inviter.cli.AccountManager")
+@patch("grafana_inviter.cli.Grafana")
+def test_dry_run_should_only_read(mock_grafana_ctor, mock_account_manager_ctor, capsys):
+    # Given
+    config = test_config_json()
+    config["grafana"]["concurrency"] = 2
+    config["grafana"]["rate_limit"] = {"requests_per_second": 4}
+
+    member = mock_account("John Doe", "John.Doe@acme.org")
+    new_accounts = [mock_account("User %d" % i, "user%d@acme.org" % i) for i in range(7)]
+    mock_account_manager_ctor.return_value.get_accounts.return_value = [member] + new_accounts
+
+    mock_grafana = mock_grafana_ctor.return_value
+    mock_grafana.org_members.return_value = {"john.doe@acme.org"}
+    mock_grafana.pending_invites.return_value = {"left.company@acme.org": {"email": "Left.Company@acme.org", "code": "left"}}
+
+    #  When
+    dry_run(config)
+
+    # Then
+    mock_grafana.invite.assert_not_called()
+    mock_grafana.revoke_invite.assert_not_called()
+    mock_grafana.populate_accounts_with_invite_links.assert_not_called()
+    mock_grafana.close.assert_called_once_with()
+    mock_account_manager_ctor.return_value.close.assert_called_once_with()
+
+    output = capsys.readouterr().out
+    assert " + invite User 0 (user0@acme.org)" in output
+    assert " = skip John Doe (John.Doe@acme.org): User already member of organization" in output
+    assert " - revoke Left.Company@acme.org" in output
+    assert "Invites to create: 7" in output
+    assert "Accounts to skip: 1 (0 unchanged since the last run)" in output
+    assert "Invites to revoke: 1 (not revoked" in output
+    assert "API calls: 2 reads done, 7 writes and 1 reads to go" in output
+    assert "Estimated duration: 2.0s" in output
+
+
+@patch("grafana_inviter.cli.validate")
+@patch("grafana_inviter.cli.configure")
+@patch("grafana_inviter.cli.serve")
+@patch("grafana_inviter.cli.dry_run")
+@patch("grafana_inviter.cli.stream")
+@patch("grafana_inviter.cli.assemble")
+def test_main_should_dispatch_to_the_requested_mode(mock_assemble, mock_stream, mock_dry_run, mock_serve, mock_configure, mock_validate):
+    # Given
+    config = mock_configure.return_value
+
+    # When
+    for argv in (["grafana-inviter", "--config", "c.json"], ["grafana-inviter", "--stream", "--config", "c.json"],
+                 ["grafana-inviter", "plan", "--config", "c.json"], ["grafana-inviter", "serve", "--port", "9000", "--config", "c.json"]):
+        with patch("sys.argv", argv):
+            main()
+
+    # Then
+    mock_validate.assert_called_with(config)
+    mock_assemble.assert_called_once_with(config)
+    mock_stream.assert_called_once_with(config)
+    mock_dry_run.assert_called_once_with(config)
+    mock_serve.assert_called_once_with(config, ("127.0.0.1", 9000))
+
+
+@patch("grafana_inviter.cli.validate")
+@patch("grafana_inviter.cli.configure")
+@patch("grafana_inviter.cli.fan_out")
+def test_main_should_fan_out_if_several_orgs_are_configured(mock_fan_out, mock_configure, mock_validate):
+    # Given
+    config = test_config_json()
+    config["grafana"]["orgs"] = [{"orgId": 1}]
+    mock_configure.return_value = config
+
+    # When
+    with patch("sys.argv", ["grafana-inviter", "--config", "c.json"]):
+        main()
+    with patch("sys.argv", ["grafana-inviter", "plan", "--config", "c.json"]), pytest.raises(SystemExit):
+        main()
+
+    # Then
+    mock_fan_out.assert_called_once_with(config)
+
+
+@patch("grafana_inviter.cli.sync")
+@patch("grafana_inviter.cli.configure")
+@patch("grafana_inviter.cli.AccountManager")
+@patch("grafana_inviter.cli.Grafana")
+def test_daemon_should_keep_clients_open_between_runs_and_reload_on_sighup(mock_grafana_ctor, mock_account_manager_ctor, mock_configure, mock_sync):
+    # Given
+    config = test_config_json()
+    reloaded_config = test_config_json()
+    reloaded_config["grafana"]["orgId"] = 2
+    mock_configure.return_value = reloaded_config
+    args = parse_args(["--daemon", "--interval", "0", "--ask-grafana-token", "--config", "config.json"])
+    runs = [RuntimeError("LDAP connection lost"), None, None, signal.SIGHUP, signal.SIGTERM]
+
+    def run(*_):
+        outcome = runs.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        if outcome is not None:
+            os.kill(os.getpid(), outcome)
+
+    mock_sync.side_effect = run
+    previous_handler = signal.getsignal(signal.SIGHUP)
+
+    # When
+    daemon(args, config)
+
+    # Then
+    assert not runs
+    assert [call_args[0][0] for call_args in mock_sync.call_args_list] == [config] * 4 + [reloaded_config]
+    # Reconnected after the failed run and after the reload, otherwise the clients were reused
+    assert mock_account_manager_ctor.call_count == 3
+    assert mock_account_manager_ctor.return_value.close.call_count == 3
+    assert mock_grafana_ctor.return_value.clear_cache.call_count == 5
+    assert not args.ask_grafana_token and args.grafana_token == "test-token"
+    assert signal.getsignal(signal.SIGHUP) == previous_handler
+
+
+@patch("grafana_inviter.cli.sync")
+@patch("grafana_inviter.cli.configure")
+@patch("grafana_inviter.cli.AccountManager")
+@patch("grafana_inviter.cli.Grafana")
+def test_daemon_should_keep_the_previous_config_if_the_reload_fails(mock_grafana_ctor, mock_account_manager_ctor, mock_configure, mock_sync,
+                                                                    caplog):
+    # Given
+    config = test_config_json()
+    mock_configure.side_effect = SystemExit("Invalid configuration at grafana/orgId: 'two' is not of type 'integer'")
+    args = parse_args(["--daemon", "--interval", "0", "--config", "config.json"])
+    runs = [signal.SIGHUP, signal.SIGTERM]
+    mock_sync.side_effect = lambda *_: os.kill(os.getpid(), runs.pop(0))
+
+    # When
+    daemon(args, config)
+
+    # Then
+    assert not runs
+    assert [call_args[0][0] for call_args in mock_sync.call_args_list] == [config] * 2
+    assert mock_account_manager_ctor.call_count == 1
+    assert "Reloading the configuration failed, keeping the previous one: Invalid configuration at grafana/orgId" in caplog.text
+
+
+@patch("grafana_inviter.server.InviteServer")
+@patch("grafana_inviter.cli.AccountManager")
+@patch("grafana_inviter.cli.Grafana")
+def test_serve_should_close_the_clients_when_interrupted(mock_grafana_ctor, mock_account_manager_ctor, mock_server_ctor):
+    # Given
+    mock_server = mock_server_ctor.return_value
+    mock_server.server_address = ("127.0.0.1", 8080)
+    mock_server.serve_forever.side_effect = KeyboardInterrupt()
+
+    # When
+    serve(test_config_json(), ("127.0.0.1", 8080))
+
+    # Then
+    mock_server_ctor.assert_called_once_with(("127.0.0.1", 8080), mock_account_manager_ctor.return_value, mock_grafana_ctor.return_value,
+                                             send_mail=False)
+    mock_server.server_close.assert_called_once_with()
+    mock_grafana_ctor.return_value.close.assert_called_once_with()
+    mock_account_manager_ctor.return_value.close.assert_called_once_with()
+
+
+@patch("anyconfig.load")
+def test_configure_should_select_users_from_arguments_and_file(mock_anyconfig_load, tmp_path):
+    # Given
+    mock_anyconfig_load.return_value = test_config_json()
+    users_file = tmp_path / "users.txt"
+    users_file.write_text("# New hires\njadoe\n\nJim.Doe@acme.org\n")
+
+    # When
+    config = configure(parse_args(["--user", "jodoe", "--users-file", str(users_file), "--config", "config.json"]))
+
+    # Then
+    assert config["ldap"]["users"] == ["jodoe", "jadoe", "Jim.Doe@acme.org"]
+
+
+@patch("grafana_inviter.cli.AccountManager")
+@patch("grafana_inviter.cli.Grafana")
+def test_assemble_should_only_look_up_selected_users_and_never_revoke(mock_grafana_ctor, mock_account_manager_ctor, tmp_path):
+    # Given
+    config = test_config_json()
+    config["ldap"]["users"] = ["jodoe", "Jim.Doe@acme.org"]
+    config["ldap"]["query"]["delta"] = {"attribute": "modifyTimestamp"}
+    config["grafana"]["revoke_invites"] = True
+    config["state"] = {"path": str(tmp_path / "state.db")}
+
+    new_account = mock_account("Jim Doe", "Jim.Doe@acme.org")
+    mock_manager = mock_account_manager_ctor.return_value
+    mock_manager.get_accounts_by.return_value = [new_account]
+    mock_grafana = mock_grafana_ctor.return_value
+    mock_grafana.org_members.return_value = set()
+    mock_grafana.pending_invites.return_value = {"left.company@acme.org": {"email": "Left.Company@acme.org", "code": "left"}}
+    mock_grafana.invite.return_value = (True, "Created invite")
+
+    #  When
+    assemble(config)
+
+    # Then
+    mock_manager.get_accounts_by.assert_called_once_with(uids=["jodoe"], mails=["Jim.Doe@acme.org"])
+    mock_manager.get_accounts.assert_not_called()
+    mock_grafana.invite.assert_called_once_with(account=new_account, send_mail=False)
+    mock_grafana.revoke_invite.assert_not_called()
+    state = StateStore(config["state"]["path"])
+    assert state.get_meta(LAST_FULL_SYNC_KEY) is None
+    state.close()
+
+
+HEAVY_MODULES = ["aiohttp", "anyconfig", "jsonschema", "ldap3", "requests"]
+
+
+def imported_heavy_modules(code):
+    """Returns the heavy modules imported by the code in a fresh interpreter.
+    """
+
+    script = "import sys\n%s\nprint(','.join(m for m in %r if m in sys.modules))" % (code, HEAVY_MODULES)
+    output = subprocess.run([sys.executable, "-c", script], check=True, stdout=subprocess.PIPE, universal_newlines=True,
+                            cwd=os.path.join(os.path.dirname(__file__), "..", "..")).stdout
+    return output.splitlines()[-1]
+
+
+def test_help_should_start_without_heavy_dependencies():
+    # When
+    imported = imported_heavy_modules("import grafana_inviter.cli\n"
+                                      "sys.argv = ['grafana-inviter', '--help']\n"
+                                      "try:\n    grafana_inviter.cli.main()\nexcept SystemExit:\n    pass")
+
+    # Then
+    assert imported == ""
+
+
+def test_validate_should_only_import_the_config_dependencies():
+    # When
+    imported = imported_heavy_modules("from grafana_inviter.cli import load_config, validate\n"
+                                      "validate(load_config('example_config.json'))")
+
+    # Then
+    assert imported == "anyconfig,jsonschema"
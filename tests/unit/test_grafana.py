@@ -5,10 +5,13 @@ Tests for the invite module.
 """
 
 import json
+import logging
+import threading
 import requests
 from unittest.mock import ANY, call, MagicMock, patch
 
-from grafana_inviter.grafana import Grafana
+from grafana_inviter.grafana import Grafana, InviteResult
+from grafana_inviter.metrics import REGISTRY
 
 
 def test_grafana_config_json():
@@ -20,8 +23,8 @@ def test_grafana_config_json():
         "orgId": 123
     }
 
-@patch("requests.get")
-@patch("requests.post")
+@patch("requests.Session.get")
+@patch("requests.Session.post")
 def test_should_generate_successful_invite(mock_requests_post, mock_requests_get):
     """
     """
@@ -41,15 +44,33 @@ def test_should_generate_successful_invite(mock_requests_post, mock_requests_get
     # Then
     mock_requests_post.assert_called_with(
         "https://grafana/api/org/invites",
-        headers={"Authorization": "Bearer my-token"},
         json={"name": "John Doe", "loginOrEmail": "john.doe@acme.org", "role": "Viewer", "sendEmail": False, "orgId": 123 })
 
     assert result == True
     assert message == ""
 
 
-@patch("requests.get")
-@patch("requests.post")
+@patch("requests.Session.get")
+@patch("requests.Session.post")
+def test_should_invite_with_the_configured_role(mock_requests_post, mock_requests_get):
+    """Test that the role of the invited account can be configured.
+    """
+
+    # Given
+    mock_account = MagicMock()
+    mock_account.name = "John Doe"
+    mock_account.mail = "john.doe@acme.org"
+    mock_requests_post.return_value = MagicMock(status_code=requests.codes.ok)
+
+    # When
+    Grafana(grafana_config=dict(test_grafana_config_json(), role="Editor")).invite(mock_account)
+
+    # Then
+    assert mock_requests_post.call_args[1]["json"]["role"] == "Editor"
+
+
+@patch("requests.Session.get")
+@patch("requests.Session.post")
 def test_should_return_false_if_request_failed(mock_requests_post, mock_requests_get):
     """Test that returned tuple in case of an request error is properly set.
     """
@@ -70,8 +91,27 @@ def test_should_return_false_if_request_failed(mock_requests_post, mock_requests
     assert message == "Some error"
 
 
-@patch("requests.get")
-@patch("requests.post")
+@patch("requests.Session.get")
+@patch("requests.Session.post")
+def test_should_return_an_invite_result_and_log_the_payload_at_debug_level(mock_requests_post, mock_requests_get, caplog):
+    # Given
+    mock_account = MagicMock(mail="Jane.Doe@acme.org")
+    mock_account.name = "Jane Doe"
+    mock_requests_get.return_value.json.return_value = []
+    mock_requests_post.return_value = MagicMock(status_code=requests.codes.ok)
+    mock_requests_post.return_value.json.return_value = {"message": "User invited"}
+
+    # When
+    with caplog.at_level(logging.DEBUG, logger="grafana_inviter.grafana"):
+        result = Grafana(grafana_config=test_grafana_config_json()).invite(mock_account)
+
+    # Then
+    assert result == InviteResult(succeeded=True, message="User invited")
+    assert "'loginOrEmail': 'Jane.Doe@acme.org'" in caplog.text
+
+
+@patch("requests.Session.get")
+@patch("requests.Session.post")
 def test_should_not_send_invite_post_request_if_user_was_already_invited(mock_requests_post, mock_requests_get):
     """Test that a user is not invited again if it was already invited.
     """
@@ -114,7 +154,7 @@ def test_should_not_send_invite_post_request_if_user_was_already_invited(mock_re
     assert "User already invited" in message
 
 
-@patch("requests.get")
+@patch("requests.Session.get")
 def test_should_populate_invite_link_to_account(mock_requests_get):
     """[summary]
     """
@@ -145,3 +185,259 @@ def test_should_populate_invite_link_to_account(mock_requests_get):
     account_with_invite = [mock_account for mock_account in mock_accounts if mock_account.mail == "John.Doe@acme.org"]
     assert len(account_with_invite) == 1
     assert hasattr(account_with_invite[0], "grafanaInviteLink")
+
+
+def invite_json(email, code):
+    """Returns a pending invite as returned by the Grafana API.
+    """
+    return {"id": 1, "orgId": 123, "name": email, "email": email, "role": "Viewer", "code": code,
+            "status": "InvitePending", "url": "https://grafana/invite/%s" % code}
+
+
+@patch("requests.Session.get")
+@patch("requests.Session.post")
+def test_should_fetch_pending_invites_only_once(mock_requests_post, mock_requests_get):
+    """Test that the pending invites are fetched once and matched case-insensitively.
+    """
+
+    # Given
+    mock_requests_get.return_value.json.return_value = [invite_json("Jane.Doe@acme.org", "abc")]
+    mock_requests_post.return_value = MagicMock(status_code=requests.codes.ok)
+    mock_requests_post.return_value.json.return_value = {"message": "Created invite"}
+
+    grafana = Grafana(grafana_config=test_grafana_config_json())
+
+    # When
+    already_invited = grafana.invite(MagicMock(mail="jane.doe@ACME.org"))
+    first = grafana.invite(MagicMock(mail="John.Doe@acme.org"))
+    second = grafana.invite(MagicMock(mail="john.doe@acme.org"))
+
+    # Then
+    assert mock_requests_get.call_count == 1
+    assert mock_requests_post.call_count == 1
+    assert already_invited == (False, "User already invited")
+    assert first == (True, "Created invite")
+    assert second == (False, "User already invited")
+
+
+@patch("requests.Session.get")
+def test_should_populate_invite_links_from_index_without_refetching(mock_requests_get):
+    """Test that populating invite links reuses the invites fetched before.
+    """
+
+    # Given
+    mock_requests_get.return_value.json.return_value = [invite_json("John.Doe@acme.org", "abc")]
+    mock_accounts = [MagicMock(spec=["mail"], mail="john.doe@acme.org"), MagicMock(spec=["mail"], mail="Jane.Doe@acme.org")]
+
+    grafana = Grafana(grafana_config=test_grafana_config_json())
+    grafana.refresh_invites()
+
+    # When
+    grafana.populate_accounts_with_invite_links(mock_accounts)
+
+    # Then
+    assert mock_requests_get.call_count == 1
+    assert grafana.invite_link(mock_accounts[0]) == "https://grafana/invite/abc"
+    assert grafana.invite_link(mock_accounts[1]) is None
+    assert mock_accounts[0].grafanaInviteLink == "https://grafana/invite/abc"
+    assert not hasattr(mock_accounts[1], "grafanaInviteLink")
+
+
+@patch("requests.Session.get")
+@patch("requests.Session.post")
+def test_should_refetch_invites_once_if_created_invites_lack_an_url(mock_requests_post, mock_requests_get):
+    """Test that invites created during the run are fetched again to obtain their URL.
+    """
+
+    # Given
+    mock_account = MagicMock(spec=["mail", "name"], mail="John.Doe@acme.org")
+    mock_requests_get.return_value.json.side_effect = [[], [invite_json("John.Doe@acme.org", "abc")]]
+    mock_requests_post.return_value = MagicMock(status_code=requests.codes.ok)
+    mock_requests_post.return_value.json.return_value = {"message": "Created invite"}
+
+    grafana = Grafana(grafana_config=test_grafana_config_json())
+    grafana.invite(mock_account)
+
+    # When
+    grafana.populate_accounts_with_invite_links([mock_account])
+
+    # Then
+    assert mock_requests_get.call_count == 2
+    assert mock_account.grafanaInviteLink == "https://grafana/invite/abc"
+
+
+@patch("requests.adapters.HTTPAdapter")
+@patch("requests.Session")
+def test_should_use_a_pooled_session(mock_session_ctor, mock_adapter_ctor):
+    """Test that all requests share a session with a connection pool and the authorization header.
+    """
+
+    # Given
+    mock_session = mock_session_ctor.return_value
+    config = dict(test_grafana_config_json(), pool_size=32)
+
+    # When
+    grafana = Grafana(grafana_config=config)
+    grafana.refresh_invites()
+    grafana.refresh_invites()
+    grafana.close()
+
+    # Then
+    mock_adapter_ctor.assert_called_once_with(pool_connections=1, pool_maxsize=32)
+    mock_session.mount.assert_has_calls([call("http://", mock_adapter_ctor.return_value),
+                                         call("https://", mock_adapter_ctor.return_value)])
+    mock_session.headers.update.assert_called_once_with({"Authorization": "Bearer my-token", "X-Grafana-Org-Id": "123"})
+    assert mock_session.get.call_args_list == [call("https://grafana/api/org/invites")] * 2
+    mock_session.close.assert_called_once_with()
+
+
+@patch("requests.Session")
+def test_should_close_connections_if_keep_alive_is_disabled(mock_session_ctor):
+    """Test that connections are not kept alive if disabled in the configuration.
+    """
+
+    # When
+    Grafana(grafana_config=dict(test_grafana_config_json(), keep_alive=False))
+
+    # Then
+    mock_session_ctor.return_value.headers.update.assert_called_with({"Connection": "close"})
+
+
+@patch("time.sleep")
+@patch("random.uniform")
+@patch("requests.Session.get")
+@patch("requests.Session.post")
+def test_should_retry_throttled_requests_and_handle_non_json_errors(mock_requests_post, mock_requests_get, mock_uniform, mock_sleep):
+    """Test that throttled requests are retried and non JSON error bodies are reported.
+    """
+
+    # Given
+    mock_uniform.return_value = 0.25
+    mock_requests_get.side_effect = [MagicMock(status_code=429, headers={"Retry-After": "2"}),
+                                     MagicMock(status_code=503, headers={}),
+                                     MagicMock(status_code=requests.codes.ok, headers={}, **{"json.return_value": []})]
+    mock_error_response = MagicMock(status_code=requests.codes.bad_gateway, headers={}, text="<html>Bad Gateway</html>")
+    mock_error_response.json.side_effect = ValueError("No JSON object could be decoded")
+    mock_requests_post.return_value = mock_error_response
+
+    config = dict(test_grafana_config_json(), rate_limit={"max_retries": 2})
+    grafana = Grafana(grafana_config=config)
+
+    # When
+    result, message = grafana.invite(MagicMock(mail="john.doe@acme.org"))
+
+    # Then
+    assert mock_requests_get.call_count == 3
+    # The invite may have been created behind the 502, so it isn't sent again
+    assert mock_requests_post.call_count == 1
+    assert call(2.0) in mock_sleep.call_args_list
+    assert call(0.25) in mock_sleep.call_args_list
+    assert not result
+    assert message == "HTTP 502: <html>Bad Gateway</html>"
+
+
+@patch("time.sleep")
+@patch("requests.Session.get")
+@patch("requests.Session.patch")
+def test_should_record_metrics_of_each_request(mock_requests_patch, mock_requests_get, mock_sleep):
+    # Given
+    REGISTRY.reset()
+    mock_requests_get.return_value = MagicMock(status_code=requests.codes.ok, headers={}, content=b"[]", **{"json.return_value": []})
+    responses = [MagicMock(status_code=503, headers={}, content=b"busy"),
+                 MagicMock(status_code=requests.codes.ok, headers={}, content=b'{"message": "Invite revoked"}')]
+    for response in responses:
+        response.request.body = None
+    mock_requests_patch.side_effect = responses
+    grafana = Grafana(grafana_config=test_grafana_config_json())
+
+    # When
+    grafana.revoke_invite({"email": "Left.Company@acme.org", "code": "abc"})
+
+    # Then
+    counters = {(name, labels): value for name, labels, value in REGISTRY.counters()}
+    revoke = (("endpoint", "org/invites/:code/revoke"), ("method", "PATCH"))
+    assert counters[("grafana_responses", revoke + (("status", "503"),))] == 1
+    assert counters[("grafana_responses", revoke + (("status", "200"),))] == 1
+    assert counters[("grafana_retries", revoke)] == 1
+    assert counters[("grafana_response_bytes", revoke)] == 33
+    assert [(name, labels, count) for name, labels, count, _, _ in REGISTRY.timers()] == [
+        ("grafana_request", (("endpoint", "org/invites"), ("method", "GET")), 1),
+        ("grafana_request", revoke, 2)
+    ]
+    REGISTRY.reset()
+
+
+@patch("requests.Session.get")
+@patch("requests.Session.patch")
+def test_should_fetch_org_members_once_and_revoke_invites(mock_requests_patch, mock_requests_get):
+    """Test that organization members are fetched once and invites are revoked by their code.
+    """
+
+    # Given
+    mock_users_response = MagicMock(status_code=requests.codes.ok)
+    mock_users_response.json.return_value = [{"email": "John.Doe@acme.org", "login": "jodoe"}, {"email": "", "login": "admin"}]
+    mock_invites_response = MagicMock(status_code=requests.codes.ok)
+    mock_invites_response.json.return_value = [invite_json("Jane.Doe@acme.org", "abc")]
+    mock_requests_get.side_effect = lambda url: mock_users_response if url.endswith("org/users") else mock_invites_response
+    mock_requests_patch.return_value = MagicMock(status_code=requests.codes.ok)
+    mock_requests_patch.return_value.json.return_value = {"message": "Invite revoked"}
+
+    grafana = Grafana(grafana_config=test_grafana_config_json())
+
+    # When
+    members = grafana.org_members()
+    grafana.org_members()
+    result = grafana.revoke_invite(grafana.pending_invites()["jane.doe@acme.org"])
+
+    # Then
+    assert members == {"john.doe@acme.org", "jodoe", "admin"}
+    assert mock_requests_get.call_args_list == [call("https://grafana/api/org/users"), call("https://grafana/api/org/invites")]
+    mock_requests_patch.assert_called_once_with("https://grafana/api/org/invites/abc/revoke")
+    assert result == (True, "Invite revoked")
+    assert grafana.pending_invites() == {}
+
+
+@patch("requests.Session.get")
+def test_should_refetch_members_and_invites_after_clearing_the_cache(mock_requests_get):
+    """Test that a long running process sees the current state of the organization after clearing the cache.
+    """
+
+    # Given
+    mock_requests_get.return_value = MagicMock(status_code=requests.codes.ok)
+    mock_requests_get.return_value.json.return_value = []
+    grafana = Grafana(grafana_config=test_grafana_config_json())
+
+    # When
+    for _ in range(2):
+        grafana.org_members()
+        grafana.pending_invites()
+        grafana.clear_cache()
+
+    # Then
+    assert mock_requests_get.call_args_list == [call("https://grafana/api/org/users"), call("https://grafana/api/org/invites")] * 2
+
+
+@patch("requests.Session.get")
+def test_should_not_lose_the_members_if_the_cache_is_cleared_while_fetching_them(mock_requests_get):
+    """Test that clearing the cache from another thread waits for a running fetch of the members.
+    """
+
+    # Given
+    grafana = Grafana(grafana_config=test_grafana_config_json())
+    clearing = threading.Thread(target=grafana.clear_cache)
+
+    def fetch_members(*_, **__):
+        clearing.start()
+        clearing.join(0.1)
+        return MagicMock(status_code=requests.codes.ok, **{"json.return_value": [{"email": "Jane.Doe@acme.org"}]})
+
+    mock_requests_get.side_effect = fetch_members
+
+    # When
+    members = grafana.org_members()
+    clearing_blocked = clearing.is_alive()
+    clearing.join()
+
+    # Then
+    assert members == {"jane.doe@acme.org"}
+    assert clearing_blocked
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the metrics module.
+"""
+
+import socket
+from unittest.mock import patch
+
+from grafana_inviter.metrics import Metrics, export, prometheus_text, statsd_lines, summary_table
+
+
+def sample_metrics():
+    """Returns metrics of a small run
+    """
+    metrics = Metrics()
+    metrics.increment("grafana_responses", method="POST", endpoint="org/invites", status=200)
+    metrics.increment("grafana_responses", method="POST", endpoint="org/invites", status=200)
+    metrics.increment("grafana_responses", method="POST", endpoint="org/invites", status=503)
+    metrics.increment("accounts", 3, status="already invited")
+    metrics.observe("grafana_request", 0.25, method="POST", endpoint="org/invites")
+    metrics.observe("grafana_request", 0.75, method="POST", endpoint="org/invites")
+    return metrics
+
+
+def test_should_aggregate_counters_and_timers_by_labels():
+    # Given
+    metrics = sample_metrics()
+
+    # When
+    with patch("time.perf_counter", side_effect=[10.0, 12.5]):
+        with metrics.timer("phase", phase="invite"):
+            pass
+
+    # Then
+    assert metrics.counters() == [
+        ("accounts", (("status", "already invited"),), 3),
+        ("grafana_responses", (("endpoint", "org/invites"), ("method", "POST"), ("status", "200")), 2),
+        ("grafana_responses", (("endpoint", "org/invites"), ("method", "POST"), ("status", "503")), 1)
+    ]
+    assert metrics.timers() == [
+        ("grafana_request", (("endpoint", "org/invites"), ("method", "POST")), 2, 1.0, 0.75),
+        ("phase", (("phase", "invite"),), 1, 2.5, 2.5)
+    ]
+    metrics.reset()
+    assert metrics.counters() == [] and metrics.timers() == []
+
+
+def test_timed_should_only_record_the_time_spent_producing_the_items():
+    # Given
+    metrics = Metrics()
+    closed = []
+
+    def produce():
+        try:
+            yield "first"
+            yield "second"
+            yield "third"
+        finally:
+            closed.append(True)
+
+    # When
+    with patch("time.perf_counter", side_effect=[0.0, 1.0, 10.0, 12.0]):
+        for item in metrics.timed("ldap_search", produce(), base="o=acme"):
+            if item == "second":
+                break
+
+    # Then
+    assert metrics.timers() == [("ldap_search", (("base", "o=acme"),), 1, 3.0, 3.0)]
+    assert closed == [True]
+
+
+def test_should_expose_the_prometheus_text_format():
+    # When
+    text = prometheus_text(sample_metrics())
+
+    # Then
+    assert text.splitlines() == [
+        'grafana_inviter_accounts_total{status="already invited"} 3',
+        'grafana_inviter_grafana_responses_total{endpoint="org/invites",method="POST",status="200"} 2',
+        'grafana_inviter_grafana_responses_total{endpoint="org/invites",method="POST",status="503"} 1',
+        'grafana_inviter_grafana_request_seconds_count{endpoint="org/invites",method="POST"} 2',
+        'grafana_inviter_grafana_request_seconds_sum{endpoint="org/invites",method="POST"} 1.000000'
+    ]
+
+
+def test_should_append_the_labels_to_statsd_names():
+    # When
+    lines = statsd_lines(sample_metrics())
+
+    # Then
+    assert lines[0] == "grafana_inviter.accounts_total.already_invited:3|g"
+    assert lines[1] == "grafana_inviter.grafana_responses_total.org_invites.POST.200:2|g"
+    assert lines[-1] == "grafana_inviter.grafana_request_seconds.org_invites.POST:1.000000|g"
+
+
+def test_export_should_write_the_textfile_send_statsd_and_print_the_summary(tmp_path, capsys):
+    # Given
+    metrics = sample_metrics()
+    path = tmp_path / "grafana_inviter.prom"
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as statsd:
+        statsd.bind(("127.0.0.1", 0))
+        statsd.settimeout(5)
+
+        # When
+        export(metrics, {"textfile": str(path), "statsd": "127.0.0.1:%d" % statsd.getsockname()[1], "summary": True})
+
+        # Then
+        assert statsd.recv(1024) == b"grafana_inviter.accounts_total.already_invited:3|g"
+    assert path.read_text() == prometheus_text(metrics)
+    assert list(tmp_path.iterdir()) == [path]
+    assert capsys.readouterr().err == summary_table(metrics)
+
+
+@patch("urllib.request.urlopen")
+def test_export_should_push_to_the_pushgateway_and_only_log_failures(mock_urlopen, tmp_path, caplog):
+    # Given
+    metrics = sample_metrics()
+    mock_urlopen.side_effect = OSError("Connection refused")
+
+    # When
+    export(metrics, {"pushgateway": "http://pushgateway:9091/", "job": "inviter", "textfile": str(tmp_path / "missing" / "file.prom")})
+
+    # Then
+    request = mock_urlopen.call_args[0][0]
+    assert request.full_url == "http://pushgateway:9091/metrics/job/inviter"
+    assert request.get_method() == "PUT"
+    assert request.data == prometheus_text(metrics).encode("utf-8")
+    assert "Exporting the metrics to pushgateway http://pushgateway:9091/ failed: Connection refused" in caplog.text
+    assert "Exporting the metrics to textfile" in caplog.text
+
+
+def test_summary_table_should_list_timers_and_counters():
+    # When
+    lines = summary_table(sample_metrics()).splitlines()
+
+    # Then
+    assert lines[1].split() == ['grafana_request{endpoint="org/invites",method="POST"}', "2", "1.000", "500.0", "750.0"]
+    assert lines[2].split() == ["Counter", "value"]
+    assert lines[3].split() == ['accounts{status="already', 'invited"}', "3"]
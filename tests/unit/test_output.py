@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the output module.
+"""
+
+import io
+import json
+from unittest.mock import patch
+
+from grafana_inviter.output import ACTION_INVITE, ACTION_LINK, ACTION_REVOKE, ACTION_SKIP, Result, create_writer
+
+
+def sample_results():
+    """Returns one result of each action
+    """
+    return [
+        Result(ACTION_SKIP, "John Doe", "John.Doe@acme.org", False, "User is already a member"),
+        Result(ACTION_INVITE, "Jane Doe", "Jane.Doe@acme.org", True, "Created invite", "https://grafana/invite/abc"),
+        Result(ACTION_REVOKE, "Left Company", "Left.Company@acme.org", True, "Invite revoked"),
+        Result(ACTION_LINK, "Jane Doe", "Jane.Doe@acme.org", True, None, "https://grafana/invite/abc")
+    ]
+
+
+def test_text_writer_should_keep_the_human_readable_lines():
+    # Given
+    stream = io.StringIO()
+    writer = create_writer("text", stream)
+
+    # When
+    for result in sample_results():
+        writer.write(result)
+    writer.note("Available invite URLs: ['https://grafana/invite/abc']")
+    writer.flush()
+
+    # Then
+    assert stream.getvalue().splitlines() == [
+        "Skipping John Doe (John.Doe@acme.org)",
+        " > User is already a member",
+        "Sending invite to Jane Doe (Jane.Doe@acme.org)",
+        " > Created invite",
+        " > https://grafana/invite/abc",
+        "Revoking invite of Left.Company@acme.org",
+        " > Invite revoked",
+        "Available invite URLs: ['https://grafana/invite/abc']"
+    ]
+
+
+def test_ndjson_writer_should_write_a_json_object_per_result(capsys):
+    # Given
+    stream = io.StringIO()
+    writer = create_writer("ndjson", stream)
+
+    # When
+    for result in sample_results():
+        writer.write(result)
+    writer.note("Skipped 3 accounts unchanged since the last run")
+
+    # Then
+    assert stream.getvalue() == ""
+    writer.flush()
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [line["action"] for line in lines] == ["skip", "invite", "revoke", "link"]
+    assert lines[1] == {"action": "invite", "name": "Jane Doe", "mail": "Jane.Doe@acme.org", "succeeded": True,
+                        "message": "Created invite", "url": "https://grafana/invite/abc", "grafana": None, "org": None}
+    assert capsys.readouterr().err == "Skipped 3 accounts unchanged since the last run\n"
+
+
+def test_csv_writer_should_write_a_header_and_a_row_per_result():
+    # Given
+    stream = io.StringIO()
+    writer = create_writer("csv", stream)
+
+    # When
+    writer.write(Result(ACTION_INVITE, "Doe, Jane", "Jane.Doe@acme.org", False, "HTTP 502: Bad Gateway"))
+    writer.flush()
+
+    # Then
+    assert stream.getvalue().splitlines() == [
+        "action,name,mail,succeeded,message,url,grafana,org",
+        'invite,"Doe, Jane",Jane.Doe@acme.org,False,HTTP 502: Bad Gateway,,,'
+    ]
+
+
+@patch("grafana_inviter.output.FLUSH_SIZE", 200)
+def test_writer_should_write_once_the_buffer_is_full():
+    # Given
+    stream = io.StringIO()
+    writer = create_writer("ndjson", stream)
+
+    # When
+    writer.write(sample_results()[0])
+
+    # Then
+    assert stream.getvalue() == ""
+    writer.write(sample_results()[1])
+    assert len(stream.getvalue().splitlines()) == 2
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the reconcile module.
+"""
+
+from unittest.mock import MagicMock
+
+from grafana_inviter.grafana import ALREADY_INVITED
+from grafana_inviter.reconcile import ALREADY_MEMBER, estimate_duration, reconcile
+
+
+def test_should_plan_invites_skips_and_revokes():
+    """Validate that accounts are split into invites and skips and unknown pending invites are revoked.
+    """
+
+    # Given
+    member = MagicMock(mail="John.Doe@acme.org")
+    invited = MagicMock(mail="jane.doe@acme.org")
+    new = MagicMock(mail="Jim.Doe@acme.org")
+    duplicate = MagicMock(mail="jim.doe@ACME.org")
+    invites = {"jane.doe@acme.org": {"email": "Jane.Doe@acme.org", "code": "jane"},
+               "left.company@acme.org": {"email": "Left.Company@acme.org", "code": "left"}}
+
+    # When
+    plan = reconcile([member, invited, new, duplicate], {"john.doe@acme.org", "admin"}, invites)
+
+    # Then
+    assert plan.add == [new]
+    assert plan.skip == [(member, ALREADY_MEMBER), (invited, ALREADY_INVITED)]
+    assert plan.revoke == [invites["left.company@acme.org"]]
+
+
+def test_should_not_revoke_invites_of_accounts_known_from_the_directory():
+    """Validate that invites of accounts found in LDAP but not planned are kept.
+    """
+
+    # Given
+    invites = {"jane.doe@acme.org": {"email": "Jane.Doe@acme.org", "code": "jane"}}
+
+    # When
+    plan = reconcile([], set(), invites, directory_mails={"jane.doe@acme.org"})
+
+    # Then
+    assert plan == ([], [], [])
+
+
+def test_estimate_duration_should_account_for_concurrency_and_rate_limit():
+    """Validate that the estimation is bound by the concurrency or the rate limit, whichever is slower.
+    """
+
+    assert estimate_duration(100, 0.2, 1) == 20
+    assert estimate_duration(100, 0.2, 4) == 5
+    assert estimate_duration(100, 0.2, 4, requests_per_second=10) == 10
+    assert estimate_duration(0, 0.2, 4) == 0
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the server module.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+import requests
+
+from grafana_inviter.grafana import Grafana
+from grafana_inviter.reconcile import ALREADY_MEMBER
+from grafana_inviter.server import Coalescer, InviteServer
+from tests.fake_grafana import FakeGrafana
+
+
+def mock_account(name, mail):
+    """Returns an account as found in LDAP.
+    """
+    account = MagicMock(spec=["name", "mail"])
+    account.name = name
+    account.mail = mail
+    return account
+
+
+def serve(grafana_url, manager):
+    """Starts an invite server in the background and returns it.
+    """
+    grafana = Grafana(grafana_config={"url": grafana_url, "token": "my-token", "orgId": 1})
+    server = InviteServer(("127.0.0.1", 0), manager, grafana)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://%s:%d" % server.server_address[:2]
+
+
+def test_coalescer_should_share_the_outcome_of_concurrent_calls():
+    """Validate that concurrent calls with the same key only run once.
+    """
+
+    # Given
+    coalescer = Coalescer()
+    calls = []
+
+    def slow_call(value):
+        calls.append(value)
+        time.sleep(0.1)
+        return value * 2
+
+    # When
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: coalescer.run("key", slow_call, 21), range(4)))
+
+    # Then
+    assert results == [42] * 4
+    assert calls == [21]
+
+
+def test_should_invite_the_requested_account_and_return_its_invite_url():
+    """Validate that a POST looks up the account, invites it and returns the invite URL.
+    """
+
+    # Given
+    manager = MagicMock()
+    manager.find_account.side_effect = lambda attribute, value: mock_account("John Doe", "john.doe@acme.org") if value == "jdoe" else None
+
+    with FakeGrafana() as fake_grafana:
+        server, url = serve(fake_grafana.url, manager)
+        try:
+            # When
+            response = requests.post(url + "/invite", json={"uid": "jdoe"})
+            unknown = requests.post(url + "/invite", json={"uid": "nobody"})
+            again = requests.post(url + "/invite", json={"uid": "jdoe"})
+            invalid = requests.post(url + "/invite", data="not json")
+            wrong_path = requests.post(url + "/other", json={"uid": "jdoe"})
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    # Then
+    assert response.status_code == 200
+    assert response.json() == {"name": "John Doe", "mail": "john.doe@acme.org", "invited": True,
+                               "message": "Created invite for john.doe@acme.org", "url": fake_grafana.url + "/invite/code0"}
+    manager.find_account.assert_any_call("uid", "jdoe")
+    assert unknown.status_code == 404
+    assert again.json()["invited"] is False
+    assert again.json()["url"] == fake_grafana.url + "/invite/code0"
+    assert invalid.status_code == 400
+    assert wrong_path.status_code == 404
+    assert [request for request in fake_grafana.requests if request[0] == "POST"] == [("POST", "/api/org/invites")]
+
+
+def test_should_coalesce_concurrent_requests_and_report_failures():
+    """Validate that concurrent requests for the same account share one lookup and failures are answered with 502.
+    """
+
+    # Given
+    manager = MagicMock()
+
+    def find_account(attribute, value):
+        time.sleep(0.1)
+        if value == "broken@acme.org":
+            raise RuntimeError("LDAP unavailable")
+        return mock_account("John Doe", value)
+
+    manager.find_account.side_effect = find_account
+
+    with FakeGrafana() as fake_grafana:
+        server, url = serve(fake_grafana.url, manager)
+        try:
+            # When
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                responses = list(executor.map(lambda _: requests.post(url + "/invite", json={"mail": "John.Doe@acme.org"}), range(4)))
+            failure = requests.post(url + "/invite", json={"mail": "broken@acme.org"})
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    # Then
+    assert [response.status_code for response in responses] == [200] * 4
+    assert manager.find_account.call_count == 2
+    assert [request for request in fake_grafana.requests if request[0] == "POST"] == [("POST", "/api/org/invites")]
+    assert failure.status_code == 502
+    assert failure.json() == {"message": "LDAP unavailable"}
+
+
+@patch("grafana_inviter.server.CACHE_TTL", 0)
+def test_should_skip_members_and_see_invites_revoked_since_the_last_request():
+    """Validate that members aren't invited and expired invites and members are fetched again.
+    """
+
+    # Given
+    manager = MagicMock()
+    manager.find_account.side_effect = lambda attribute, value: mock_account(value, value)
+
+    with FakeGrafana(members=[{"email": "jane.doe@acme.org", "login": "jdoe"}]) as fake_grafana:
+        server, url = serve(fake_grafana.url, manager)
+        try:
+            # When
+            member = requests.post(url + "/invite", json={"mail": "Jane.Doe@acme.org"})
+            invited = requests.post(url + "/invite", json={"mail": "john.doe@acme.org"})
+            fake_grafana.invites = []
+            invited_again = requests.post(url + "/invite", json={"mail": "john.doe@acme.org"})
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    # Then
+    assert member.json() == {"name": "Jane.Doe@acme.org", "mail": "Jane.Doe@acme.org", "invited": False, "message": ALREADY_MEMBER,
+                             "url": None}
+    assert invited.json()["invited"] is True
+    assert invited_again.json()["invited"] is True
+    assert [request for request in fake_grafana.requests if request[0] == "POST"] == [("POST", "/api/org/invites")] * 2
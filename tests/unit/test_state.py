@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the state module.
+"""
+
+from unittest.mock import MagicMock, patch
+
+from grafana_inviter.state import STATUS_ALREADY_INVITED, STATUS_FAILED, STATUS_INVITED, StateStore
+
+
+def mock_account(mail, fingerprint="fingerprint"):
+    """Returns an account with the given mail and attributes fingerprint.
+    """
+    account = MagicMock(mail=mail)
+    account.fingerprint.return_value = fingerprint
+    return account
+
+
+def test_should_remember_processed_accounts_between_runs(tmp_path):
+    """Validate that the state survives reopening the store and mails are matched case-insensitively.
+    """
+
+    # Given
+    path = str(tmp_path / "state.db")
+    state = StateStore(path)
+
+    # When
+    state.record(mock_account("John.Doe@acme.org"), STATUS_INVITED, "https://grafana/invite/abc")
+    state.record(mock_account("Jane.Doe@acme.org"), STATUS_ALREADY_INVITED)
+    state.record(mock_account("Jim.Doe@acme.org"), STATUS_FAILED)
+    state.close()
+    state = StateStore(path)
+
+    # Then
+    john = state.lookup(mock_account("john.doe@acme.org"))
+    assert john.status == STATUS_INVITED
+    assert john.invite_url == "https://grafana/invite/abc"
+    assert state.is_unchanged(mock_account("john.doe@acme.org"))
+    assert state.is_unchanged(mock_account("jane.doe@acme.org"))
+    assert not state.is_unchanged(mock_account("jim.doe@acme.org"))
+    assert not state.is_unchanged(mock_account("john.doe@acme.org", fingerprint="changed"))
+    assert not state.is_unchanged(mock_account("new.user@acme.org"))
+    assert state.lookup(mock_account("new.user@acme.org")) is None
+    state.close()
+
+
+def test_should_keep_known_invite_url_if_none_is_given(tmp_path):
+    """Validate that recording an account without invite URL keeps the stored one.
+    """
+
+    # Given
+    state = StateStore(str(tmp_path / "state.db"))
+    state.record(mock_account("John.Doe@acme.org"), STATUS_INVITED, "https://grafana/invite/abc")
+
+    # When
+    state.record(mock_account("John.Doe@acme.org"), STATUS_ALREADY_INVITED)
+
+    # Then
+    assert state.lookup(mock_account("John.Doe@acme.org")).invite_url == "https://grafana/invite/abc"
+    state.close()
+
+
+@patch("grafana_inviter.state.COMMIT_INTERVAL", 2)
+def test_should_commit_periodically(tmp_path):
+    """Validate that records are committed in batches.
+    """
+
+    # Given
+    path = str(tmp_path / "state.db")
+    state = StateStore(path)
+
+    # When
+    state.record(mock_account("user1@acme.org"), STATUS_INVITED)
+    state.record(mock_account("user2@acme.org"), STATUS_INVITED)
+    state.record(mock_account("user3@acme.org"), STATUS_INVITED)
+
+    # Then
+    other_reader = StateStore(path)
+    assert other_reader.lookup(mock_account("user2@acme.org")) is not None
+    assert other_reader.lookup(mock_account("user3@acme.org")) is None
+    state.set_meta("ldap_high_water_mark", 1200)
+    state.commit()
+    assert other_reader.lookup(mock_account("user3@acme.org")) is not None
+    assert other_reader.get_meta("ldap_high_water_mark") == "1200"
+    other_reader.close()
+    state.close()
+
+
+def test_should_store_run_wide_settings(tmp_path):
+    """Validate that run wide settings are stored as text.
+    """
+
+    # Given
+    state = StateStore(str(tmp_path / "state.db"))
+
+    # When
+    state.set_meta("ldap_high_water_mark", 1200)
+
+    # Then
+    assert state.get_meta("ldap_high_water_mark") == "1200"
+    assert state.get_meta("unknown") is None
+    state.close()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the throttle module.
+"""
+
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+import threading
+from unittest.mock import patch
+
+from grafana_inviter.throttle import AdaptiveConcurrency, Throttle, TokenBucket, retry_after
+
+
+class FakeClock:
+    """Clock which only advances when told to.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket_should_allow_bursts_and_then_pace_requests():
+    """Validate that the bucket allows a burst and then one request per 1/rate seconds.
+    """
+
+    # Given
+    clock = FakeClock()
+    bucket = TokenBucket(rate=10, burst=2, clock=clock)
+
+    # When
+    delays = [bucket.reserve() for _ in range(4)]
+    clock.now = 1.0
+    delay_after_refill = bucket.reserve()
+
+    # Then
+    assert delays == [0.0, 0.0, 0.1, 0.2]
+    assert delay_after_refill == 0.0
+
+
+def test_adaptive_concurrency_should_halve_on_throttling_and_grow_on_success():
+    """Validate the AIMD behaviour of the concurrency limit.
+    """
+
+    # Given
+    concurrency = AdaptiveConcurrency(maximum=8)
+
+    # When & Then
+    concurrency.record(throttled=True)
+    assert concurrency.limit == 4
+    concurrency.record(throttled=True)
+    concurrency.record(throttled=True)
+    concurrency.record(throttled=True)
+    assert concurrency.limit == 1
+
+    for _ in range(20):
+        concurrency.record(throttled=False)
+    assert 1 < concurrency.limit < 8
+
+    for _ in range(100):
+        concurrency.record(throttled=False)
+    assert concurrency.limit == 8
+
+
+def test_adaptive_concurrency_should_block_when_limit_is_reached():
+    """Validate that acquire blocks until a slot is released.
+    """
+
+    # Given
+    concurrency = AdaptiveConcurrency(maximum=1)
+    concurrency.acquire()
+    acquired = threading.Event()
+
+    def acquire():
+        concurrency.acquire()
+        acquired.set()
+
+    # When
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    blocked = not acquired.wait(0.05)
+    concurrency.release()
+    thread.join(1)
+
+    # Then
+    assert blocked
+    assert acquired.is_set()
+
+
+def test_retry_after_should_support_seconds_and_http_dates():
+    """Validate parsing of the Retry-After header.
+    """
+
+    in_ten_seconds = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=10), usegmt=True)
+
+    assert retry_after({"Retry-After": "3"}) == 3.0
+    assert 8 < retry_after({"Retry-After": in_ten_seconds}) <= 10
+    assert retry_after({"Retry-After": "soon"}) is None
+    assert retry_after({}) is None
+
+
+@patch("random.uniform")
+def test_throttle_should_retry_throttled_requests_with_backoff(mock_uniform):
+    """Validate that only throttled requests are retried, honouring Retry-After and the maximum of retries.
+    """
+
+    # Given
+    mock_uniform.side_effect = lambda low, high: high
+    throttle = Throttle({"concurrency": 4, "rate_limit": {"max_retries": 3, "backoff_base": 1, "backoff_max": 3}})
+
+    # When & Then
+    assert throttle.retry_delay(0, 200, {}) is None
+    assert throttle.retry_delay(0, 400, {}) is None
+    assert throttle.retry_delay(0, 503, {}) == 1
+    assert throttle.retry_delay(1, 502, {}) == 2
+    assert throttle.retry_delay(2, 429, {}) == 3
+    assert throttle.retry_delay(2, 429, {"Retry-After": "7"}) == 7
+    assert throttle.retry_delay(3, 429, {}) is None
+    assert throttle.concurrency == 1
+
+
+def test_throttle_should_only_retry_unprocessed_requests_which_arent_idempotent():
+    """Validate that invites are only retried if Grafana didn't process them and Retry-After is capped.
+    """
+
+    # Given
+    throttle = Throttle({"rate_limit": {"backoff_base": 0, "max_retry_after": 60}})
+
+    # When & Then
+    assert throttle.retry_delay(0, 502, {}, idempotent=False) is None
+    assert throttle.retry_delay(0, 504, {}, idempotent=False) is None
+    assert throttle.retry_delay(0, 503, {}, idempotent=False) == 0
+    assert throttle.retry_delay(0, 429, {"Retry-After": "30"}, idempotent=False) == 30
+    assert throttle.retry_delay(0, 429, {"Retry-After": "86400"}) == 60
+
+
+def test_throttle_should_only_delay_requests_if_rate_limited():
+    """Validate that requests are only delayed if a rate is configured.
+    """
+
+    assert Throttle({}).delay_before_request() == 0.0
+    assert Throttle({"rate_limit": {"requests_per_second": 1}}).delay_before_request() == 0.0